@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Benchmark pgindexrebuild against a throwaway local PostgreSQL.
+
+Starts a new PostgreSQL instance (initdb in a temporary directory), creates
+tables with a controlled amount of index bloat, runs pgindexrebuild on them,
+and reports how long it took, how long the catalog scan & bloat estimate
+took, how close the estimated space savings were to the real ones, and how
+long the locks on the renamed/dropped indexes were held.
+
+The results are printed as JSON, and with --output, appended as one JSON line
+to a file, so runs can be compared over time.
+
+Arguments after -- are passed to pgindexrebuild, e.g.:
+
+    python benchmark.py --tables 100 --output bench.jsonl -- --engine legacy -j 4
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+import psycopg2.extras
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import pgindexrebuild
+
+DATABASE = 'bench'
+
+
+def find_bindir(pg_bin):
+    """The directory with initdb & pg_ctl."""
+    if pg_bin is not None:
+        return pg_bin
+    pg_ctl = shutil.which('pg_ctl')
+    if pg_ctl is not None:
+        return os.path.dirname(pg_ctl)
+    try:
+        return subprocess.check_output(['pg_config', '--bindir'], universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        raise SystemExit("Cannot find initdb/pg_ctl. Put them on the PATH, or use --pg-bin")
+
+
+def start_postgres(bindir, tmpdir, port):
+    """initdb & start a PostgreSQL instance, only listening on a unix socket in tmpdir."""
+    datadir = os.path.join(tmpdir, 'data')
+    subprocess.check_call([os.path.join(bindir, 'initdb'), '-D', datadir, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--no-sync'], stdout=subprocess.DEVNULL)
+    # Durability doesn't matter, and autovacuum would change the bloat
+    options = "-c listen_addresses='' -k {} -p {} -c fsync=off -c synchronous_commit=off -c full_page_writes=off -c autovacuum=off".format(tmpdir, port)
+    subprocess.check_call([os.path.join(bindir, 'pg_ctl'), '-D', datadir, '-o', options, '-l', os.path.join(tmpdir, 'postgresql.log'), '-w', 'start'], stdout=subprocess.DEVNULL)
+    return datadir
+
+
+def stop_postgres(bindir, datadir):
+    subprocess.call([os.path.join(bindir, 'pg_ctl'), '-D', datadir, '-m', 'immediate', '-w', 'stop'], stdout=subprocess.DEVNULL)
+
+
+def connect(tmpdir, port, database):
+    conn = psycopg2.connect(host=tmpdir, port=port, user='postgres', database=database)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+def table_bloat(args, table_num):
+    """The fraction of rows deleted from table table_num. Spread evenly from --min-bloat to --max-bloat."""
+    if args.tables == 1:
+        return args.max_bloat
+    return args.min_bloat + (args.max_bloat - args.min_bloat) * table_num / (args.tables - 1)
+
+
+def create_bloat(args, cursor):
+    """Create the tables & indexes, and bloat them by deleting rows."""
+    for table_num in range(args.tables):
+        table = "bench_{}".format(table_num)
+        columns = ["c{}".format(i) for i in range(args.indexes_per_table)]
+        cursor.execute("CREATE TABLE {} (id int, {});".format(table, ", ".join("{} int".format(c) for c in columns)))
+        # Each column is a different permutation of the ids, so the indexes
+        # are filled in a random order, like real indexes
+        cursor.execute("INSERT INTO {} SELECT i, {} FROM generate_series(1, %s) AS i;".format(table, ", ".join("(i * {}) %% %s".format(7919 + 2 * n) for n in range(len(columns)))), [args.rows] * len(columns) + [args.rows])
+        for c in columns:
+            cursor.execute("CREATE INDEX {t}_{c} ON {t} ({c});".format(t=table, c=c))
+        # Deterministic, so every run gets the same bloat
+        cursor.execute("DELETE FROM {} WHERE (id * 104729) %% 1000 < %s;".format(table), (int(table_bloat(args, table_num) * 1000),))
+        cursor.execute("VACUUM ANALYZE {};".format(table))
+
+
+def index_sizes(cursor):
+    cursor.execute("SELECT c.relname, pg_relation_size(c.oid) FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind = 'i' AND n.nspname = 'public';")
+    return dict(cursor.fetchall())
+
+
+def time_snapshot(cursor):
+    """How long loading the catalog snapshot takes."""
+    start = time.time()
+    snapshot = pgindexrebuild.CatalogSnapshot()
+    snapshot.load(cursor)
+    return time.time() - start
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+def read_events(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def run_benchmark(args, tmpdir):
+    conn = connect(tmpdir, args.port, 'postgres')
+    conn.cursor().execute("CREATE DATABASE {};".format(DATABASE))
+    server_version = conn.server_version
+    conn.close()
+
+    conn = connect(tmpdir, args.port, DATABASE)
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    start = time.time()
+    create_bloat(args, cursor)
+    setup_time = time.time() - start
+
+    sizes_before = index_sizes(cursor)
+    snapshot_time = time_snapshot(cursor)
+
+    events_path = os.path.join(tmpdir, 'events.jsonl')
+    log_path = os.path.join(tmpdir, 'pgindexrebuild.log')
+    command = [sys.executable, os.path.join(HERE, 'pgindexrebuild.py'), '-d', DATABASE, '--hostname', tmpdir, '-U', 'postgres', '--no-log-syslog', '--metrics-json', events_path] + args.pgindexrebuild_args
+    env = dict(os.environ, PGPORT=str(args.port))
+    start = time.time()
+    with open(log_path, 'w') as log:
+        returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+    wall_time = time.time() - start
+    if returncode != 0:
+        raise SystemExit("pgindexrebuild failed (exit code {}), see {}".format(returncode, log_path))
+
+    sizes_after = index_sizes(cursor)
+    conn.close()
+
+    events = read_events(events_path)
+    index_events = [e for e in events if e['event'] == 'index']
+    rebuilt = [e for e in index_events if e['rebuilt']]
+
+    # Estimated (by whichever estimator pgindexrebuild used) vs. actual space
+    # saved, for the indexes which were rebuilt
+    errors = []
+    estimated_saving = actual_saving = 0
+    for e in rebuilt:
+        actual = sizes_before[e['index']] - sizes_after.get(e['index'], 0)
+        estimate = e['wasted']
+        estimated_saving += estimate
+        actual_saving += actual
+        errors.append(abs(estimate - actual))
+
+    # The bloat estimate, by the estimator pgindexrebuild was run with
+    estimates = [e['duration'] for e in events if e['event'] == 'estimate']
+
+    phases = {}
+    lock_statements = {}
+    for e in events:
+        if e['event'] == 'phase':
+            phases.setdefault(e['phase'], []).append(e['duration'])
+        elif e['event'] == 'lock' and e['kind'] is not None:
+            lock_statements.setdefault(e['kind'], []).append(e['duration'])
+
+    return {
+        'timestamp': time.time(),
+        'pgindexrebuild_version': pgindexrebuild.version(),
+        'postgresql_version': server_version,
+        'parameters': {
+            'tables': args.tables,
+            'indexes_per_table': args.indexes_per_table,
+            'rows': args.rows,
+            'min_bloat': args.min_bloat,
+            'max_bloat': args.max_bloat,
+            'pgindexrebuild_args': args.pgindexrebuild_args,
+        },
+        'setup_time': setup_time,
+        'wall_time': wall_time,
+        'catalog_scan': {'snapshot': snapshot_time, 'estimate': sum(estimates) if estimates else None},
+        'indexes': {
+            'total': len(sizes_before),
+            'rebuilt': len(rebuilt),
+            'failed': len(index_events) - len(rebuilt),
+        },
+        'space': {
+            'before': sum(sizes_before.values()),
+            'after': sum(sizes_after.values()),
+            'estimated_saving': estimated_saving,
+            'actual_saving': actual_saving,
+            'estimate_error': estimated_saving - actual_saving,
+            'estimate_error_per_index': percentiles(errors),
+        },
+        # The statements which take a strong lock on the table (in autocommit
+        # mode, so the lock is held for as long as the statement runs). Only
+        # the attempt which got the lock, without waiting for earlier ones &
+        # backing off. null where the engine has no such statements
+        'lock_hold': dict((kind, percentiles(lock_statements[kind]) if kind in lock_statements else None) for kind in ('rename', 'constraint_swap', 'drop')),
+        'estimated_by': sorted(set(e['estimated_by'] for e in rebuilt if e['estimated_by'] is not None)),
+        'phases': dict((phase, percentiles(durations)) for phase, durations in phases.items()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pgindexrebuild against a throwaway local PostgreSQL. Arguments after -- are passed to pgindexrebuild")
+    parser.add_argument("--pg-bin", required=False, metavar="DIR", help="Directory with initdb & pg_ctl (default: from the PATH, or pg_config --bindir)")
+    parser.add_argument("--port", type=int, default=5432, help="Port of the temporary PostgreSQL. It only listens on a unix socket in the temporary directory, so this won't clash with other servers (default: 5432)")
+    parser.add_argument("--tables", type=int, default=200, metavar="N", help="Number of tables (default: 200)")
+    parser.add_argument("--indexes-per-table", type=int, default=10, metavar="N", help="Number of indexes on each table (default: 10)")
+    parser.add_argument("--rows", type=int, default=5000, metavar="N", help="Number of rows in each table, before deleting (default: 5000)")
+    parser.add_argument("--min-bloat", type=float, default=0.1, metavar="FRACTION", help="Fraction of rows deleted from the least bloated table (default: 0.1)")
+    parser.add_argument("--max-bloat", type=float, default=0.9, metavar="FRACTION", help="Fraction of rows deleted from the most bloated table (default: 0.9)")
+    parser.add_argument("--output", required=False, metavar="PATH", help="Append the results as one JSON line to this file")
+    parser.add_argument("--keep", action="store_true", help="Don't delete the temporary directory (with the database, and pgindexrebuild's log) at the end")
+
+    argv = sys.argv[1:]
+    if '--' in argv:
+        pgindexrebuild_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    else:
+        pgindexrebuild_args = []
+    args = parser.parse_args(argv)
+    args.pgindexrebuild_args = pgindexrebuild_args
+
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        parser.error("initdb cannot be run as root. Run this as an unprivileged user")
+    bindir = find_bindir(args.pg_bin)
+    tmpdir = tempfile.mkdtemp(prefix="pgindexrebuild-bench-")
+    datadir = None
+    try:
+        datadir = start_postgres(bindir, tmpdir, args.port)
+        results = run_benchmark(args, tmpdir)
+    finally:
+        if datadir is not None:
+            stop_postgres(bindir, datadir)
+        if args.keep:
+            print("Kept {}".format(tmpdir), file=sys.stderr)
+        else:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output is not None:
+        with open(args.output, 'a') as fp:
+            fp.write(json.dumps(results, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    main()
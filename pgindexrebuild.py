@@ -7,6 +7,7 @@ This recovers space from index bloat.
 import argparse
 import psycopg2
 import psycopg2.extras
+import psycopg2.errorcodes
 import math
 import sys
 from decimal import Decimal
@@ -14,58 +15,134 @@ import logging, logging.handlers
 import humanfriendly
 import os
 import fcntl
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 import time
 import subprocess
+import threading
+import json
+import random
+import re
+import heapq
+import signal
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 MAX_INDEX_ATTEMPTS = 10
+# Back off between attempts, for a random time up to 1s, 2s, 4s... (at most a minute)
+RETRY_BACKOFF = 1
+RETRY_MAX_BACKOFF = 60
 
 def version():
     """Returns the version installed via pip"""
+    # importlib.metadata is much quicker to import than pkg_resources, which
+    # matters when running every few minutes from cron
     try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8
         import pkg_resources
-        return pkg_resources.require("pgindexrebuild")[0].version
-    except pkg_resources.DistributionNotFound:
+        try:
+            return pkg_resources.require("pgindexrebuild")[0].version
+        except pkg_resources.DistributionNotFound:
+            return "source"
+    try:
+        return metadata.version("pgindexrebuild")
+    except metadata.PackageNotFoundError:
         # Happens when running directly
         return "source"
 
+
+class VersionAction(argparse.Action):
+    """Like argparse's version action, but only looks up the version when it's asked for."""
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help="show program's version number and exit"):
+        super(VersionAction, self).__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print("{} {}".format(parser.prog, version()))
+        parser.exit()
+
 def make_indexdef_concurrent(indexdef):
     """Turn an index creation statement into a concurrent index creationstatement."""
     if indexdef.startswith("CREATE INDEX "):
         indexdef = indexdef.replace("CREATE INDEX ", "CREATE INDEX CONCURRENTLY ", 1)
     elif indexdef.startswith("CREATE UNIQUE INDEX "):
-        indexdef = indexdef.replace("CREATE UNQUE INDEX ", "CREATE UNQUE INDEX CONCURRENTLY ", 1)
+        indexdef = indexdef.replace("CREATE UNIQUE INDEX ", "CREATE UNIQUE INDEX CONCURRENTLY ", 1)
     else:
         raise ValueError("Unknown index creation: {}".format(indexdef))
 
     return indexdef
 
 
-def index_size(cursor, iname):
-    cursor.execute("select pg_relation_size(pg_class.oid) FROM pg_class WHERE relname = %s;", (iname,))
-    size = cursor.fetchone()[0]
-    return size
-
-
 def get_all_tablespaces(cursor):
     cursor.execute("select spcname from pg_tablespace;")
     result = [x[0] for x in cursor.fetchall()]
     return result
 
 
-def does_index_exist(cursor, iname):
-    cursor.execute("select 1 from pg_indexes where schemaname = 'public' and indexname = %s limit 1;", (iname,))
-    result = cursor.fetchone()
-    return result == [1]
-
-def is_index_valid(cursor, iname):
-    """Returns True iff the index is valid. Don't call on non-existant index"""
-    cursor.execute("SELECT i.indisvalid FROM pg_catalog.pg_class c, pg_catalog.pg_namespace n, pg_catalog.pg_index i WHERE i.indexrelid = c.oid AND c.relnamespace = n.oid and c.relname = %s;", (iname,))
-    result = cursor.fetchone()[0]
-    return result
+class CatalogSnapshot(object):
+    """
+    In memory copy of the catalog details of every index in a database,
+    loaded with one query, rather than a query per index per question.
+    Indexes are keyed by oid, and can be looked up by (schema, name). Call
+    refresh() for the indexes which have been changed.
+    """
+    SQL = """SELECT c.oid, c.relfilenode, c.relkind, n.nspname AS schemaname, c.relname AS name, t.relname AS table, i.indrelid AS table_oid,
+            pg_relation_size(c.oid) AS size, ts.spcname AS tablespace, i.indisvalid, i.indisprimary, i.indisunique,
+            con.contype, con.condeferrable, con.condeferred,
+            EXISTS (SELECT 1 FROM pg_catalog.pg_constraint fk WHERE fk.contype = 'f' AND fk.conindid = c.oid) AS referenced_by_fk,
+            pn.nspname AS parent_schema, pc.relname AS parent_index
+        FROM pg_catalog.pg_index i
+        JOIN pg_catalog.pg_class c ON c.oid = i.indexrelid
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_catalog.pg_class t ON t.oid = i.indrelid
+        LEFT JOIN pg_catalog.pg_tablespace ts ON ts.oid = c.reltablespace
+        -- The partitioned index which an index on a partition is attached to
+        LEFT JOIN pg_catalog.pg_inherits inh ON inh.inhrelid = c.oid
+        LEFT JOIN pg_catalog.pg_class pc ON pc.oid = inh.inhparent
+        LEFT JOIN pg_catalog.pg_namespace pn ON pn.oid = pc.relnamespace
+        LEFT JOIN LATERAL (SELECT con.contype, con.condeferrable, con.condeferred FROM pg_catalog.pg_constraint con WHERE con.conindid = c.oid AND con.conrelid = i.indrelid AND con.contype IN ('p', 'u', 'x') LIMIT 1) con ON true
+        WHERE n.nspname <> 'information_schema' AND n.nspname !~ '^pg_'"""
+
+    def __init__(self):
+        self.by_oid = {}
+        self.by_name = {}
+        self.lock = threading.Lock()
+
+    def load(self, cursor):
+        cursor.execute(self.SQL + ";")
+        rows = cursor.fetchall()
+        with self.lock:
+            self.by_oid = {}
+            self.by_name = {}
+            for row in rows:
+                self._add(row)
+
+    def refresh(self, cursor, schemaname, names):
+        """Reload the details of these indexes, e.g. after they've been created, renamed or dropped."""
+        cursor.execute(self.SQL + " AND n.nspname = %s AND c.relname = ANY(%s);", (schemaname, list(names)))
+        rows = cursor.fetchall()
+        with self.lock:
+            for name in names:
+                entry = self.by_name.pop((schemaname, name), None)
+                if entry is not None:
+                    self.by_oid.pop(entry['oid'], None)
+            for row in rows:
+                self._add(row)
+
+    def _add(self, row):
+        entry = dict(row)
+        self.by_oid[entry['oid']] = entry
+        self.by_name[(entry['schemaname'], entry['name'])] = entry
+
+    def get(self, schemaname, name):
+        """The details of this index, or None if it doesn't exist."""
+        with self.lock:
+            return self.by_name.get((schemaname, name))
+
+    def entries(self):
+        with self.lock:
+            return list(self.by_oid.values())
 
 def format_size(b):
     b = int(b)
@@ -74,9 +151,39 @@ def format_size(b):
     else:
         return "{} ({:,} bytes)".format(humanfriendly.format_size(b), b)
 
-def indexsizes(cursor):
-    """Return the sizes of all the indexes."""
-    sql = """SELECT                       
+def indexsizes(cursor, estimator=None, schemas=('public',), min_bloat=0, table_cache=None):
+    """
+    Return the sizes of the indexes in schemas with more than min_bloat bytes
+    wasted, least bloated first. If estimator is given, it's used to replace
+    the (rough) wasted space estimate from the SQL query. With table_cache (a
+    TableEstimateCache), only the tables which have changed are estimated
+    again.
+    """
+    # The estimator can find bloat which the SQL estimate doesn't, so can only
+    # filter on the SQL estimate without one.
+    min_wasted = min_bloat if estimator is None else -1
+
+    if table_cache is None:
+        objs = sql_estimates(cursor, schemas, min_wasted)
+    else:
+        objs = [o for o in table_cache.estimates(cursor, schemas) if o['wasted'] > min_wasted]
+        objs.sort(key=lambda o: (o['wasted'], o['name']))
+
+    if estimator is not None:
+        estimator.estimate(cursor, objs)
+        objs.sort(key=lambda t: t['wasted'])
+        objs = [o for o in objs if o['wasted'] > min_bloat]
+
+    return objs
+
+
+def sql_estimates(cursor, schemas, min_wasted, tables=None):
+    """
+    The rough, SQL, estimate of the indexes in schemas with more than
+    min_wasted bytes wasted, least bloated first. tables, a list of (oid,
+    name), only estimates those tables.
+    """
+    sql = """SELECT * FROM (SELECT
           current_database(), schemaname, tablename, reltuples::bigint, relpages::bigint, otta,
           ROUND(CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages/otta::numeric END,1) AS tbloat,
           CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::bigint END AS wastedbytes,
@@ -84,19 +191,20 @@ def indexsizes(cursor):
           ROUND(CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages/iotta::numeric END,1) AS ibloat,
           CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END AS wastedibytes,
           indisprimary,
-          indexdef
+          indexdef, indexoid, irelfilenode, ireloptions, iamname, tableoid
         FROM (
           SELECT
-            rs.schemaname, rs.tablename, cc.reltuples, cc.relpages, bs, indisprimary, indexdef,
+            rs.schemaname, rs.tablename, cc.oid AS tableoid, cc.reltuples, cc.relpages, bs, indisprimary, pg_get_indexdef(c2.oid) AS indexdef,
+            c2.oid AS indexoid, c2.relfilenode AS irelfilenode, c2.reloptions AS ireloptions, am.amname AS iamname,
             CEIL((cc.reltuples*((datahdr+ma-
-              (CASE WHEN datahdr%ma=0 THEN ma ELSE datahdr%ma END))+nullhdr2+4))/(bs-20::float)) AS otta,
+              (CASE WHEN datahdr%%ma=0 THEN ma ELSE datahdr%%ma END))+nullhdr2+4))/(bs-20::float)) AS otta,
             COALESCE(c2.relname,'?') AS iname, COALESCE(c2.reltuples,0) AS ituples, COALESCE(c2.relpages,0) AS ipages,
             COALESCE(CEIL((c2.reltuples*(datahdr-12))/(bs-20::float)),0) AS iotta -- very rough approximation, assumes all cols
           FROM (
             SELECT
               ma,bs,schemaname,tablename,
-              (datawidth+(hdr+ma-(case when hdr%ma=0 THEN ma ELSE hdr%ma END)))::numeric AS datahdr,
-              (maxfracsum*(nullhdr+ma-(case when nullhdr%ma=0 THEN ma ELSE nullhdr%ma END))) AS nullhdr2
+              (datawidth+(hdr+ma-(case when hdr%%ma=0 THEN ma ELSE hdr%%ma END)))::numeric AS datahdr,
+              (maxfracsum*(nullhdr+ma-(case when nullhdr%%ma=0 THEN ma ELSE nullhdr%%ma END))) AS nullhdr2
             FROM (
               SELECT
                 schemaname, tablename, hdr, ma, bs,
@@ -114,66 +222,419 @@ def indexsizes(cursor):
                   CASE WHEN v ~ 'mingw32' THEN 8 ELSE 4 END AS ma
                 FROM (SELECT version() AS v) AS foo
               ) AS constants
+              WHERE s.schemaname = ANY(%(schemas)s) AND (%(tablenames)s::name[] IS NULL OR s.tablename = ANY(%(tablenames)s::name[]))
               GROUP BY 1,2,3,4,5
             ) AS foo
           ) AS rs
           JOIN pg_class cc ON cc.relname = rs.tablename
           JOIN pg_namespace nn ON cc.relnamespace = nn.oid AND nn.nspname = rs.schemaname AND nn.nspname <> 'information_schema'
-          LEFT JOIN pg_index i ON indrelid = cc.oid
-          LEFT JOIN pg_class c2 ON c2.oid = i.indexrelid
-          LEFT JOIN pg_indexes on pg_indexes.indexname = c2.relname
+          JOIN pg_index i ON indrelid = cc.oid
+          -- Not the indexes of partitioned tables, which have no storage
+          JOIN pg_class c2 ON c2.oid = i.indexrelid AND c2.relkind = 'i'
+          JOIN pg_am am ON am.oid = c2.relam
+          WHERE %(tableoids)s::oid[] IS NULL OR cc.oid = ANY(%(tableoids)s::oid[])
         ) AS sml
-        ORDER BY wastedbytes DESC;"""
-
-    cursor.execute(sql)
+        ) AS bloat
+        WHERE wastedibytes > %(min_wasted)s
+        ORDER BY wastedibytes, iname;"""
 
-    #raw_results = cursor.fetchall()
+    params = {'schemas': list(schemas), 'min_wasted': min_wasted, 'tablenames': None, 'tableoids': None}
+    if tables is not None:
+        params['tableoids'] = [oid for oid, name in tables]
+        params['tablenames'] = list(set(name for oid, name in tables))
+    cursor.execute(sql, params)
 
-    objs = {}
+    objs = []
     for row in cursor.fetchall():
-        if row['indexdef']:
-            objs["{}.{}".format(row['schemaname'], row['iname'])] = {
-                'schemaname': row['schemaname'],
-                'iname': row['iname'],
-                'name': row['iname'],
-                'size': row['ipages'] * 8192,
-                'type': 'index',
-                'table': row['tablename'],
-                'primary': row['indisprimary'],
-                'def': row['indexdef'],
-                'wasted': row['wastedibytes'],
-                'indexdef': row['indexdef'],
-                'invalid_index': False,
-            }
+        objs.append({
+            'schemaname': row['schemaname'],
+            'iname': row['iname'],
+            'name': row['iname'],
+            'size': row['ipages'] * 8192,
+            'type': 'index',
+            'table': row['tablename'],
+            'primary': row['indisprimary'],
+            'def': row['indexdef'],
+            'wasted': row['wastedibytes'],
+            'indexdef': row['indexdef'],
+            'invalid_index': False,
+            'oid': row['indexoid'],
+            'relfilenode': row['irelfilenode'],
+            'reloptions': row['ireloptions'],
+            'amname': row['iamname'],
+            'table_oid': row['tableoid'],
+            'estimated_by': 'sql',
+        })
 
-    objs = list(objs.values())
-    objs.sort(key=lambda t: t['wasted'])
+    return objs
 
-    # TODO should probably do this in the SQL query above.
-    objs = [o for o in objs if o['schemaname'] == 'public' and o['wasted'] > 0]
+def has_extension(cursor, name):
+    """Returns True iff the extension is installed in the current database."""
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = %s;", (name,))
+    return cursor.fetchone() is not None
+
+
+def index_fillfactor(reloptions):
+    """The fillfactor (as a fraction) from an index's reloptions. btree defaults to 90%."""
+    for option in (reloptions or []):
+        if option.startswith("fillfactor="):
+            return int(option.split("=", 1)[1]) / 100.0
+    return 0.9
+
+
+def index_deduplicate_items(reloptions):
+    """Whether deduplicate_items is on in an index's reloptions. It's on by default."""
+    for option in (reloptions or []):
+        if option.startswith("deduplicate_items="):
+            return option.split("=", 1)[1].lower() not in ('off', 'false', 'no', '0', 'of', 'f', 'n')
+    return True
+
+
+def expected_index_bytes(leaf_pages, leaf_density, internal_pages, fillfactor, block_size):
+    """How big this btree index would be after a rebuild, given the live data in the leaf pages."""
+    # +1 for the metapage
+    return int(math.ceil(leaf_pages * leaf_density / fillfactor) + internal_pages + 1) * block_size
+
+
+class PgstattupleEstimator(object):
+    """
+    Measures the bloat of btree indexes with the pgstattuple extension,
+    rather than the rough estimate in indexsizes().
+
+    Indexes up to max_exact_size are measured exactly with pgstatindex(),
+    which reads the whole index. Bigger indexes have sample_pages random pages
+    read with pageinspect's bt_page_stats(), so the cost is bounded. Anything
+    which can't be measured (no extension, no permission, not btree) keeps
+    the SQL estimate.
+
+    Results are cached (per index oid & relfilenode, and only while the index
+    size is unchanged) in cache_path, if given, for up to cache_max_age seconds.
+    """
+    def __init__(self, max_exact_size, sample_pages, cache_path=None, cache_max_age=86400):
+        self.max_exact_size = max_exact_size
+        self.sample_pages = sample_pages
+        self.cache_path = cache_path
+        self.cache_max_age = cache_max_age
+        self.cache = {}
+        self.lock = threading.Lock()
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as fp:
+                    self.cache = json.load(fp)
+            except (IOError, ValueError) as ex:
+                logger.warning("Could not read estimate cache {}, ignoring it: {!r}".format(cache_path, ex))
+
+    def save(self):
+        if not self.cache_path:
+            return
+        with self.lock:
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.cache, fp)
+            os.rename(tmp_path, self.cache_path)
+
+    def cached(self, key, obj):
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if entry['relfilenode'] != obj['relfilenode'] or entry['size'] != obj['size']:
+            return None
+        if time.time() - entry['timestamp'] > self.cache_max_age:
+            return None
+        return entry
+
+    def estimate(self, cursor, objs):
+        if not has_extension(cursor, 'pgstattuple'):
+            logger.warning("pgstattuple extension is not installed in this database, falling back to the SQL estimate. Install it with: CREATE EXTENSION pgstattuple;")
+            return
+        # The extensions' functions are called by their schema, which may not
+        # be on the search_path
+        cursor.execute("""SELECT current_database(), current_setting('block_size')::int, current_setting('is_superuser') = 'on',
+                (SELECT quote_ident(n.nspname) FROM pg_extension e JOIN pg_namespace n ON n.oid = e.extnamespace WHERE e.extname = 'pgstattuple'),
+                (SELECT quote_ident(n.nspname) FROM pg_extension e JOIN pg_namespace n ON n.oid = e.extnamespace WHERE e.extname = 'pageinspect'),
+                (SELECT bool_or(has_function_privilege(p.oid, 'EXECUTE')) FROM pg_proc p JOIN pg_depend d ON d.classid = 'pg_proc'::regclass AND d.objid = p.oid AND d.deptype = 'e'
+                    JOIN pg_extension e ON e.oid = d.refobjid AND e.extname = 'pgstattuple' WHERE p.proname = 'pgstatindex' AND p.proargtypes = '2205'::oidvector);""")
+        database, block_size, is_superuser, pgstattuple_schema, pageinspect_schema, can_measure = cursor.fetchone()
+        if not can_measure:
+            logger.warning("Not allowed to use pgstatindex() in database {}, falling back to the SQL estimate. It needs the pg_stat_scan_tables role".format(database))
+            return
+        # pageinspect's functions are only for superusers
+        can_sample = pageinspect_schema is not None and is_superuser
+        warned = False
+
+        num_exact = num_sampled = num_cached = 0
+        for obj in objs:
+            if obj['amname'] != 'btree':
+                continue
+
+            key = "{}/{}".format(database, obj['oid'])
+            entry = self.cached(key, obj)
+            if entry is not None:
+                obj['wasted'] = entry['wasted']
+                obj['estimated_by'] = entry['estimated_by'] + " (cached)"
+                num_cached += 1
+                continue
+
+            try:
+                if obj['size'] <= self.max_exact_size:
+                    wasted = self.pgstatindex_wasted(cursor, obj, block_size, pgstattuple_schema)
+                    estimated_by = 'pgstatindex'
+                elif can_sample:
+                    wasted = self.sampled_wasted(cursor, obj, block_size, pageinspect_schema)
+                    estimated_by = 'sampled'
+                else:
+                    continue
+            except psycopg2.Error as ex:
+                # e.g. no permission, or the index was dropped meanwhile
+                if not warned:
+                    logger.warning("Could not measure the bloat of some indexes in database {}, using the SQL estimate for them. First error: {!r}".format(database, ex))
+                    warned = True
+                logger.debug("Could not measure the bloat of {}: {!r}".format(obj['name'], ex))
+                continue
+            obj['estimated_by'] = estimated_by
+            if estimated_by == 'pgstatindex':
+                num_exact += 1
+            else:
+                num_sampled += 1
+
+            obj['wasted'] = wasted
+            with self.lock:
+                self.cache[key] = {'relfilenode': obj['relfilenode'], 'size': obj['size'], 'wasted': wasted, 'estimated_by': obj['estimated_by'], 'timestamp': time.time()}
+
+        logger.info("Measured bloat of {} indexes exactly, {} by sampling, {} from the cache".format(num_exact, num_sampled, num_cached))
+
+    def pgstatindex_wasted(self, cursor, obj, block_size, schema):
+        cursor.execute("SELECT index_size, internal_pages, leaf_pages, avg_leaf_density FROM {}.pgstatindex(%s::oid::regclass);".format(schema), (obj['oid'],))
+        row = cursor.fetchone()
+        if row['avg_leaf_density'] != row['avg_leaf_density']:
+            # NaN, i.e. no leaf pages
+            return 0
+        expected = expected_index_bytes(row['leaf_pages'], row['avg_leaf_density'] / 100.0, row['internal_pages'], index_fillfactor(obj['reloptions']), block_size)
+        return max(0, row['index_size'] - expected)
+
+    def sampled_wasted(self, cursor, obj, block_size, schema):
+        """Estimate from sample_pages random pages of the index, using bt_page_stats."""
+        num_pages = obj['size'] // block_size
+        # Page 0 is the metapage
+        blocks = random.sample(range(1, num_pages), min(self.sample_pages, num_pages - 1))
+        cursor.execute("""SELECT s.type, s.free_size, s.page_size
+            FROM unnest(%s::int[]) AS blkno, LATERAL {}.bt_page_stats(%s::oid::regclass::text, blkno) AS s;""".format(schema), (blocks, obj['oid']))
+        rows = cursor.fetchall()
+
+        leaf = [r for r in rows if r['type'] == 'l']
+        internal = [r for r in rows if r['type'] in ('i', 'r')]
+        if len(leaf) == 0:
+            return 0
+        # Same maths as pgstatindex: page header (24) & btree special space (16) aren't usable
+        max_avail = leaf[0]['page_size'] - 40
+        leaf_density = 1 - sum(r['free_size'] for r in leaf) / float(len(leaf) * max_avail)
+
+        scale = float(num_pages) / len(rows)
+        expected = expected_index_bytes(len(leaf) * scale, leaf_density, len(internal) * scale, index_fillfactor(obj['reloptions']), block_size)
+        return max(0, obj['size'] - expected)
+
+
+class ColumnEstimator(object):
+    """
+    Estimates the bloat of btree indexes from the statistics of only the
+    columns they index, rather than the rough estimate in indexsizes(), which
+    treats every index as if it had all the table's columns (so a small index
+    on a wide table looks very bloated).
+
+    The widths & null fractions (from pg_stats), types and alignment (from
+    pg_attribute) of every index's columns are fetched in one query, and the
+    expected size of each index after a rebuild is worked out from them, its
+    number of tuples and its fillfactor. btree deduplication (PostgreSQL 13+)
+    isn't taken into account, which can only make the estimated bloat
+    smaller. Indexes without statistics (never analysed) keep the SQL
+    estimate.
+    """
+    SQL = """SELECT i.indexrelid, c.reltuples, a.attnum, a.attlen, a.attalign,
+            coalesce(ts.null_frac, xs.null_frac) AS null_frac,
+            -- Expressions' widths are measured with a 4 byte varlena header, but short ones are stored with 1 byte
+            coalesce(ts.avg_width, xs.avg_width - CASE WHEN a.attlen = -1 AND xs.avg_width <= 130 THEN 3 ELSE 0 END) AS avg_width
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        -- The index's own columns, including expressions & INCLUDE columns
+        JOIN pg_attribute a ON a.attrelid = i.indexrelid AND a.attnum > 0
+        LEFT JOIN pg_attribute ta ON ta.attrelid = i.indrelid AND ta.attnum = i.indkey[a.attnum - 1] AND ta.attnum > 0
+        LEFT JOIN pg_stats ts ON ts.schemaname = n.nspname AND ts.tablename = t.relname AND ts.attname = ta.attname AND NOT ts.inherited
+        -- Expressions have their statistics under the index
+        LEFT JOIN pg_stats xs ON xs.schemaname = n.nspname AND xs.tablename = c.relname AND xs.attname = a.attname AND NOT xs.inherited
+        WHERE i.indexrelid = ANY(%s)
+        ORDER BY i.indexrelid, a.attnum;"""
+
+    # MAXALIGN on 64 bit platforms
+    MAXALIGN = 8
+    ALIGNMENT = {'c': 1, 's': 2, 'i': 4, 'd': 8}
+    # Page header & btree special space
+    PAGE_OVERHEAD = 24 + 16
+    # Line pointer for each tuple
+    ITEM_ID = 4
+    # Fillfactor of btree internal pages
+    INTERNAL_FILLFACTOR = 0.7
+
+    def save(self):
+        pass
+
+    def estimate(self, cursor, objs):
+        btree = dict((obj['oid'], obj) for obj in objs if obj['amname'] == 'btree')
+        if len(btree) == 0:
+            return
+        cursor.execute("SELECT current_setting('block_size')::int;")
+        block_size = cursor.fetchone()[0]
+        cursor.execute(self.SQL, (list(btree),))
+
+        columns = {}
+        reltuples = {}
+        for row in cursor.fetchall():
+            reltuples[row['indexrelid']] = row['reltuples']
+            columns.setdefault(row['indexrelid'], []).append(row)
+
+        num_estimated = 0
+        for oid, obj in btree.items():
+            cols = columns.get(oid, [])
+            # reltuples is -1 before the first vacuum or analyse (PostgreSQL 14+)
+            if len(cols) == 0 or reltuples[oid] < 0 or any(col['avg_width'] is None for col in cols):
+                continue
+            tuple_bytes = self.tuple_bytes(cols)
+            expected = self.expected_bytes(reltuples[oid], tuple_bytes, index_fillfactor(obj['reloptions']), block_size)
+            obj['wasted'] = max(0, obj['size'] - expected)
+            obj['estimated_by'] = 'columns'
+            num_estimated += 1
+
+        logger.info("Estimated bloat of {} btree index(es) from their columns' statistics, {} without statistics use the SQL estimate".format(num_estimated, len(btree) - num_estimated))
+
+    def tuple_bytes(self, cols):
+        """The average size of a leaf tuple with these columns, including its line pointer."""
+        null_frac = max(col['null_frac'] for col in cols)
+        size = self.layout_bytes(cols, 8)
+        if null_frac > 0:
+            # Tuples with a null have a null bitmap after the IndexTupleData
+            # header, and don't store the null column
+            with_null = self.layout_bytes([col for col in cols if col['null_frac'] < null_frac], self.align(8 + 4, self.MAXALIGN))
+            size = (1 - null_frac) * size + null_frac * with_null
+        return size + self.ITEM_ID
+
+    def layout_bytes(self, cols, header):
+        """The size of a tuple with a header of header bytes, and these columns, aligned."""
+        offset = header
+        for col in cols:
+            width = col['attlen'] if col['attlen'] > 0 else col['avg_width']
+            # Varlenas up to 127 bytes have a 1 byte header and aren't aligned
+            alignment = 1 if col['attlen'] == -1 and width <= 127 else self.ALIGNMENT[col['attalign']]
+            offset = self.align(offset, alignment) + width
+        return self.align(offset, self.MAXALIGN)
+
+    def expected_bytes(self, reltuples, tuple_bytes, fillfactor, block_size):
+        """How big a btree index of reltuples tuples of tuple_bytes would be after a rebuild."""
+        usable = block_size - self.PAGE_OVERHEAD
+        # Every leaf page but the last has a high key
+        per_leaf = max(1, int(usable * fillfactor // tuple_bytes) - 1)
+        per_internal = max(2, int(usable * self.INTERNAL_FILLFACTOR // tuple_bytes))
+        level = int(math.ceil(reltuples / per_leaf)) or 1
+        pages = level
+        while level > 1:
+            level = int(math.ceil(level / float(per_internal)))
+            pages += level
+        # +1 for the metapage
+        return (pages + 1) * block_size
+
+    @staticmethod
+    def align(offset, alignment):
+        return (offset + alignment - 1) // alignment * alignment
+
+
+class TableEstimateCache(object):
+    """
+    Caches the SQL bloat estimate of each table's indexes in a JSON file,
+    keyed by the table's oid, its write, vacuum & analyse counters from
+    pg_stat_user_tables, and the size of its indexes. Only the tables where
+    any of those have changed are estimated again. Aggregating pg_stats for
+    every table is the slow part in databases with many tables.
+    """
+    SQL = """SELECT s.relid, s.relname,
+            ARRAY[s.n_tup_ins, s.n_tup_upd, s.n_tup_del, s.vacuum_count + s.autovacuum_count, s.analyze_count + s.autoanalyze_count]::text
+              || (SELECT string_agg(i.indexrelid || ':' || c.relfilenode || ':' || c.relpages || ':' || c.reltuples, ',' ORDER BY i.indexrelid) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = s.relid) AS key
+        FROM pg_stat_user_tables s
+        WHERE s.schemaname = ANY(%s);"""
+
+    def __init__(self, path):
+        self.path = path
+        self.databases = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path) as fp:
+                    self.databases = json.load(fp)
+            except (IOError, ValueError) as ex:
+                logger.warning("Could not read table estimate cache {}, ignoring it: {!r}".format(path, ex))
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.databases, fp)
+            os.rename(tmp_path, self.path)
+
+    def estimates(self, cursor, schemas):
+        """The SQL estimate for all the indexes in schemas (whatever their bloat)."""
+        cursor.execute("SELECT current_database();")
+        database = cursor.fetchone()[0]
+        cursor.execute(self.SQL, (list(schemas),))
+        keys = dict((str(row['relid']), (row['relname'], row['key'])) for row in cursor.fetchall())
+        with self.lock:
+            cached = self.databases.get(database, {})
+
+        changed = [(int(oid), name) for oid, (name, key) in keys.items() if oid not in cached or cached[oid]['key'] != key]
+        logger.debug("Estimating {} changed table(s), using the cached estimate for {}".format(len(changed), len(keys) - len(changed)))
+        # Dropped tables are forgotten
+        tables = dict((oid, cached[oid]) for oid in keys if oid in cached)
+        if len(changed) > 0:
+            for oid, name in changed:
+                tables[str(oid)] = {'key': keys[str(oid)][1], 'indexes': []}
+            for obj in sql_estimates(cursor, schemas, -1, None if len(changed) == len(keys) else changed):
+                obj['wasted'] = int(obj['wasted'])
+                table = tables.get(str(obj['table_oid']))
+                if table is not None:
+                    table['indexes'].append(obj)
+        with self.lock:
+            self.databases[database] = tables
+
+        return [dict(obj) for table in tables.values() for obj in table['indexes']]
 
-    return objs
 
 def calculate_invalid_indexes(cursor):
-    cursor.execute("SELECT c.relname as name, pg_get_indexdef(c.oid) as indexdef FROM pg_catalog.pg_class c, pg_catalog.pg_namespace n, pg_catalog.pg_index i WHERE i.indexrelid = c.oid AND c.relnamespace = n.oid and i.indisvalid = False;")
-    results = list({'name': row['name'], 'indexdef': row['indexdef'], 'invalid_index': True} for row in cursor)
+    cursor.execute("SELECT c.relname as name, n.nspname as schemaname, t.relname as table, pg_get_indexdef(c.oid) as indexdef FROM pg_catalog.pg_class c, pg_catalog.pg_namespace n, pg_catalog.pg_index i, pg_catalog.pg_class t WHERE i.indexrelid = c.oid AND c.relnamespace = n.oid AND t.oid = i.indrelid and i.indisvalid = False AND c.relkind = 'i';")
+    results = list({'name': row['name'], 'schemaname': row['schemaname'], 'table': row['table'], 'indexdef': row['indexdef'], 'invalid_index': True} for row in cursor)
     return results
 
 @contextmanager
-def postgres_timeout(cursor, timeout_ms):
-    """During this context, the postgresql statement timeout will be timeout_ms."""
-    cursor.execute("SHOW statement_timeout;")
-    old_timeout = cursor.fetchone()[0]
-
-    cursor.execute("SET statement_timeout = %s;", (timeout_ms,))
+def postgres_setting(cursor, name, value):
+    """During this context, the postgresql setting name will be value. The old value is restored afterwards, even on error."""
+    cursor.execute("SELECT current_setting(%s);", (name,))
+    old_value = cursor.fetchone()[0]
 
-    yield
-
-    # TODO detect timeout
+    cursor.execute("SELECT set_config(%s, %s, false);", (name, str(value)))
+    try:
+        yield
+    finally:
+        cursor.execute("SELECT set_config(%s, %s, false);", (name, old_value))
 
-    # reset timeout
+def postgres_timeout(cursor, timeout_ms):
+    """During this context, the postgresql statement timeout will be timeout_ms."""
+    return postgres_setting(cursor, 'statement_timeout', timeout_ms)
 
-    cursor.execute("SET statement_timeout = %s;", (old_timeout,))
+def backoff_delay(attempt, base, cap):
+    """
+    How long to wait before retry number attempt (starting at 1): a random
+    time up to base * 2^(attempt-1) seconds, but not more than cap. The
+    randomness stops several workers retrying in lockstep.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
 
 @contextmanager
 def log_duration(task_desc):
@@ -185,9 +646,2473 @@ def log_duration(task_desc):
     logger.debug("Finished {}. Took {} ({:.2f} sec)".format(task_desc, duration_string, duration_sec))
 
 
+def choose_engine(engine, server_version, concurrent, always_drop_first):
+    """
+    Which way to rebuild indexes. 'reindex' uses REINDEX INDEX CONCURRENTLY,
+    which needs PostgreSQL 12+. 'legacy' builds a new index beside the old one
+    and swaps them. 'auto' uses reindex where it can.
+    """
+    reindex_possible = server_version >= 120000 and concurrent and not always_drop_first
+    if engine == 'auto':
+        return 'reindex' if reindex_possible else 'legacy'
+    if engine == 'reindex' and not reindex_possible:
+        raise ValueError("--engine reindex needs PostgreSQL 12 or later, --concurrent, and not --always-drop-first")
+    return engine
+
+
+def is_reindex_leftover(snapshot, entry):
+    """
+    Is this invalid index left behind by an interrupted REINDEX CONCURRENTLY?
+    i.e. it's named like one (e.g. foo_ccnew, foo_ccnew1, foo_ccold), and the
+    index it was built for (foo) is still there and valid. PostgreSQL may
+    have truncated the name, so foo only has to start with what's left.
+    """
+    match = re.search(r"^(.+)_cc(new|old)[0-9]*$", entry['name'])
+    if entry['indisvalid'] or match is None:
+        return False
+    base = match.group(1)
+    return any(e['indisvalid'] and e['name'].startswith(base) and e['name'] != entry['name']
+               and e['schemaname'] == entry['schemaname'] and e['table_oid'] == entry['table_oid'] for e in snapshot.entries())
+
+
+def reindex_in_progress(cursor, entry):
+    """
+    Is another session maybe still building this _ccnew/_ccold index? i.e.
+    an index is being built or reindexed on its table. (REINDEX CONCURRENTLY
+    needs PostgreSQL 12+, so before that, never.)
+    """
+    if cursor.connection.server_version < 120000:
+        return False
+    cursor.execute("""SELECT EXISTS (SELECT 1 FROM pg_stat_progress_create_index p WHERE p.pid <> pg_backend_pid() AND (p.index_relid = %(index)s OR p.relid = %(table)s));""",
+                   {'index': entry['oid'], 'table': entry['table_oid']})
+    return cursor.fetchone()[0]
+
+
+def drop_reindex_leftovers(cursor, snapshot, dry_run, lock_retry, database, schemaname=None, table=None):
+    """
+    Drop the invalid indexes left behind by an interrupted REINDEX
+    CONCURRENTLY, with lock_retry. Optionally only those on one table.
+    Indexes which another session may still be building are kept.
+    """
+    leftovers = [e for e in snapshot.entries() if is_reindex_leftover(snapshot, e)]
+    if table is not None:
+        leftovers = [e for e in leftovers if e['schemaname'] == schemaname and e['table'] == table]
+
+    for entry in leftovers:
+        if reindex_in_progress(cursor, entry):
+            logger.info("Not dropping invalid index {}.{}, since another session may still be building it".format(entry['schemaname'], entry['name']))
+            continue
+        if dry_run:
+            logger.info("Would drop invalid index {}.{}, left behind by an interrupted REINDEX CONCURRENTLY".format(entry['schemaname'], entry['name']))
+            continue
+        logger.info("Dropping invalid index {}.{}, left behind by an interrupted REINDEX CONCURRENTLY".format(entry['schemaname'], entry['name']))
+        if not lock_retry.execute(cursor, "DROP INDEX CONCURRENTLY IF EXISTS {}.{};".format(entry['schemaname'], entry['name']), database, 'drop'):
+            logger.error("Could not drop the invalid index {s}.{t}. Drop it later with:  DROP INDEX CONCURRENTLY {s}.{t};".format(s=entry['schemaname'], t=entry['name']))
+        snapshot.refresh(cursor, entry['schemaname'], [entry['name']])
+
+
+def reindex_index(cursor, obj, db, old_entry, concurrently=True):
+    """
+    Rebuild one index with REINDEX INDEX CONCURRENTLY. PostgreSQL builds the
+    new index, and swaps it with the old one, including any constraint.
+    Without concurrently, a plain REINDEX, which blocks writes to the table.
+    """
+    args = db.run.args
+    snapshot = db.snapshot
+    qualified_name = "{}.{}".format(obj['schemaname'], obj['name'])
+
+    if args.pre_rebuild_command:
+        logger.debug("About to run pre-rebuild command: {}".format(args.pre_rebuild_command))
+        (status, output) = subprocess.getstatusoutput(args.pre_rebuild_command)
+
+        logger.debug("Pre-rebuild command of {}, status code: {} output: {}".format(args.pre_rebuild_command, status, output))
+
+    try:
+        index_attempt = 1
+        successful_recreation = False
+        while not successful_recreation and index_attempt <= MAX_INDEX_ATTEMPTS:
+            logger.debug("Starting attempt {} of {} for {}".format(index_attempt, MAX_INDEX_ATTEMPTS, obj['name']))
+            try:
+                with db.phase(obj['name'], 'reindex'), log_duration("reindexing index"):
+                    cursor.execute("REINDEX INDEX {}{};".format("CONCURRENTLY " if concurrently else "", qualified_name))
+            except psycopg2.OperationalError as e:
+                # e.g. deadlock, or cancelled. The new index is left behind, invalid
+                logger.error("Error reindexing {}: {!r}. That was attempt {} of {}".format(obj['name'], e, index_attempt, MAX_INDEX_ATTEMPTS))
+                snapshot.load(cursor)
+                if concurrently:
+                    drop_reindex_leftovers(cursor, snapshot, False, db.run.lock_retry, db.name, obj['schemaname'], obj['table'])
+                if isinstance(e, psycopg2.extensions.QueryCanceledError):
+                    # Someone (or the --throttle-cancel) wants this stopped
+                    raise
+                if index_attempt < MAX_INDEX_ATTEMPTS:
+                    db.count('retries')
+                    time.sleep(backoff_delay(index_attempt, RETRY_BACKOFF, RETRY_MAX_BACKOFF))
+                index_attempt += 1
+                continue
+            except psycopg2.Error as e:
+                # e.g. a unique violation. Trying again won't help
+                logger.error("Could not reindex {}: {!r}. Ignoring this index".format(obj['name'], e))
+                snapshot.load(cursor)
+                if concurrently:
+                    drop_reindex_leftovers(cursor, snapshot, False, db.run.lock_retry, db.name, obj['schemaname'], obj['table'])
+                return
+
+            with db.phase(obj['name'], 'validate'):
+                snapshot.refresh(cursor, obj['schemaname'], [obj['name']])
+                successful_recreation = snapshot.get(obj['schemaname'], obj['name'])['indisvalid']
+            if not successful_recreation:
+                logger.error("Reindexed index {} is not valid. Retrying. That was attempt {} of {}".format(obj['name'], index_attempt, MAX_INDEX_ATTEMPTS))
+                if index_attempt < MAX_INDEX_ATTEMPTS:
+                    db.count('retries')
+                    time.sleep(backoff_delay(index_attempt, RETRY_BACKOFF, RETRY_MAX_BACKOFF))
+            index_attempt += 1
+
+        if not successful_recreation:
+            logger.error("Could not reindex {}. Attempted {} times. Ignoring this index".format(obj['name'], MAX_INDEX_ATTEMPTS))
+            return
+    finally:
+        if args.post_rebuild_command:
+            logger.debug("About to run post-rebuild command: {}".format(args.post_rebuild_command))
+            (status, output) = subprocess.getstatusoutput(args.post_rebuild_command)
+
+            logger.debug("Post-rebuild command of {}, status code: {} output: {}".format(args.post_rebuild_command, status, output))
+
+    with db.phase(obj['name'], 'analyse'):
+        cursor.execute("ANALYSE {};".format(qualified_name))
+
+    if old_entry['parent_index'] is not None:
+        reattach_partition_index(cursor, db, obj, old_entry)
+
+    if not obj['invalid_index']:
+        newsize = snapshot.get(obj['schemaname'], obj['name'])['size']
+        db.run.savings_counter.add(old_entry['size'] - newsize, old_entry['size'], db.name)
+
+    return True
+
+
+def reattach_partition_index(cursor, db, obj, old_entry):
+    """
+    The rebuilt index of a partition must still be attached to the
+    partitioned table's index, or that isn't valid. Attach it again if not.
+    """
+    entry = db.snapshot.get(obj['schemaname'], obj['name'])
+    if entry is None or entry['parent_index'] is not None:
+        return
+    sql = "ALTER INDEX {}.{} ATTACH PARTITION {}.{};".format(old_entry['parent_schema'], old_entry['parent_index'], obj['schemaname'], obj['name'])
+    logger.info("Reattaching {} to the partitioned index {}".format(obj['name'], old_entry['parent_index']))
+    with db.phase(obj['name'], 'reattach'):
+        if not db.run.lock_retry.execute(cursor, sql, db.name):
+            logger.error("Could not reattach {} to {}. Run this yourself:  {}".format(obj['name'], old_entry['parent_index'], sql))
+            return
+    db.snapshot.refresh(cursor, obj['schemaname'], [obj['name']])
+
+
+def rebuild_index(cursor, obj, db):
+    """Rebuild (or repair) one index in the database db (a DatabaseRun), adding any space saved to the run's savings."""
+    args = db.run.args
+    snapshot = db.snapshot
+    old_entry = snapshot.get(obj['schemaname'], obj['name'])
+    if old_entry is None:
+        logger.info("Index {} no longer exists. Skipping it".format(obj['name']))
+        return
+
+    budget = db.run.budget
+    if budget is not None and not budget.fits(obj):
+        return
+
+    index_tablespace = old_entry['tablespace'] or db.database_tablespace
+    drop_first = args.always_drop_first
+    build_tablespaces = choose_build_tablespaces(db.run, index_tablespace, drop_first)
+    planned_tablespace = obj.get('planned_tablespace')
+    if planned_tablespace in build_tablespaces:
+        # Where the plan (--apply-plan) said, if there's room
+        build_tablespaces = [planned_tablespace] + [t for t in build_tablespaces if t != planned_tablespace]
+
+    # Roughly how much space the new index will need
+    needed = max(0, old_entry['size'] - int(obj.get('wasted', 0)))
+    free_space = db.run.free_space
+    reserved = False
+    if free_space is None or drop_first or args.dry_run:
+        build_tablespace = build_tablespaces[0]
+    else:
+        build_tablespace = free_space.reserve(build_tablespaces, needed)
+        reserved = build_tablespace is not None
+        if build_tablespace is None and not db.final_pass:
+            # Maybe there will be room after other indexes have been rebuilt
+            logger.info("Not enough free space in {} to rebuild {} (needs about {}). Trying again after the other indexes".format(", ".join(build_tablespaces), obj['name'], format_size(needed)))
+            db.defer_for_space(obj)
+            return
+        elif build_tablespace is None and args.drop_first_if_no_space and can_drop_first(obj, old_entry):
+            logger.info("Not enough free space in {} to rebuild {} (needs about {}). Dropping the old index first".format(", ".join(build_tablespaces), obj['name'], format_size(needed)))
+            drop_first = True
+            build_tablespace = index_tablespace
+        elif build_tablespace is None:
+            logger.error("Not enough free space in {} to rebuild {} (needs about {}). Skipping this index".format(", ".join(build_tablespaces), obj['name'], format_size(needed)))
+            return
+
+    throttle = db.run.throttle
+    if throttle is not None and not args.dry_run and not throttle.wait_until_ok(cursor, obj['name'], needed):
+        if reserved:
+            free_space.release(build_tablespace, needed)
+        return
+
+    if db.prewarm and not args.dry_run:
+        prewarm_table(cursor, db, obj, old_entry)
+
+    revert_options = None
+    if db.run.storage_advisor is not None and not obj['invalid_index']:
+        revert_options = db.run.storage_advisor.run(cursor, db, obj, old_entry)
+
+    start_time = time.time()
+    rebuilt = False
+    try:
+        with db.run.build_tuning.apply(cursor, obj['name'], needed), db.run.progress.watch(db.connect_args, cursor.connection.get_backend_pid(), db.name, obj['name']):
+            if throttle is not None and not args.dry_run:
+                with throttle.watch(db.connect_args, cursor.connection.get_backend_pid(), obj['name']) as watcher, throttle.count_wal(cursor):
+                    try:
+                        rebuilt = _rebuild_index(cursor, obj, db, old_entry, build_tablespace, drop_first)
+                    except psycopg2.extensions.QueryCanceledError:
+                        if not watcher.cancelled:
+                            raise
+                        logger.error("Rebuilding {} was cancelled because the database is overloaded. The old index has been kept".format(obj['name']))
+                        snapshot.load(cursor)
+                        return
+            else:
+                rebuilt = _rebuild_index(cursor, obj, db, old_entry, build_tablespace, drop_first)
+    finally:
+        if reserved:
+            free_space.release(build_tablespace, needed)
+        if revert_options is not None and not rebuilt:
+            db.run.storage_advisor.revert_options(cursor, db, obj, revert_options)
+        metrics = db.run.metrics
+        if metrics is not None and not args.dry_run:
+            db.count('rebuilt' if rebuilt else 'failures')
+            new_entry = snapshot.get(obj['schemaname'], obj['name'])
+            metrics.event('index', database=db.name, index=obj['name'], rebuilt=bool(rebuilt), size=old_entry['size'], wasted=int(obj.get('wasted', 0)), estimated_by=obj.get('estimated_by'), new_size=new_entry['size'] if rebuilt and new_entry is not None else None, duration=time.time() - start_time)
+            metrics.write(db.run)
+    duration = time.time() - start_time
+    if args.dry_run:
+        return
+
+    if not rebuilt:
+        return
+
+    with db.lock:
+        db.rebuilt.add((obj['schemaname'], obj['name']))
+    new_entry = snapshot.get(obj['schemaname'], obj['name'])
+    if budget is not None:
+        budget.record(new_entry['size'], duration)
+    if db.run.history is not None:
+        writes = table_writes(cursor, old_entry['table_oid']).get(old_entry['table_oid'])
+        db.run.history.record_rebuild(db.name, obj, old_entry['size'], new_entry['size'], duration, writes)
+
+
+def choose_build_tablespaces(run, index_tablespace, drop_first):
+    """Where a new index can be built, in order of preference."""
+    if drop_first:
+        return [run.tablespace]
+    elif run.args.engine == 'reindex':
+        return [index_tablespace]
+    else:
+        return run.tablespaces
+
+
+def can_drop_first(obj, old_entry):
+    """
+    Can this index be dropped before the new one is built? Not if a
+    constraint depends on it, since the constraint would have to be dropped
+    too, nor if it's unique, since duplicates could be added meanwhile, nor
+    if it's a partition's index attached to a partitioned index.
+    """
+    return old_entry['contype'] is None and not old_entry['indisunique'] and old_entry['parent_index'] is None
+
+
+def constraint_swap_sql(obj, old_entry, old_index_name):
+    """
+    SQL to move the primary key or unique constraint from the old index to
+    the new one, in one statement, so the table always has the constraint.
+    Dropping the old constraint drops the old index.
+    """
+    kind = "PRIMARY KEY" if old_entry['contype'] == 'p' else "UNIQUE"
+    deferrable = ""
+    if old_entry['condeferrable']:
+        deferrable = " DEFERRABLE INITIALLY DEFERRED" if old_entry['condeferred'] else " DEFERRABLE"
+    return "ALTER TABLE {table} DROP CONSTRAINT {old}, ADD CONSTRAINT {t} {kind} USING INDEX {t}{deferrable};".format(table=obj['table'], old=old_index_name, t=obj['name'], kind=kind, deferrable=deferrable)
+
+
+def _rebuild_index(cursor, obj, db, old_entry, tablespace, drop_first):
+    """
+    Rebuild the index, building the new one in tablespace. drop_first drops
+    the old index before building the new one, (see --always-drop-first)
+    """
+    args = db.run.args
+    snapshot = db.snapshot
+    lock_retry = db.run.lock_retry
+
+    if args.engine == 'reindex' and not drop_first:
+        if obj['invalid_index']:
+            logger.info("Reindexing invalid index {}".format(obj['name']))
+        else:
+            logger.info("Reindexing {} size {} wasted {} {:.0%} (estimated by {})".format(obj['name'], format_size(obj['size']), format_size(obj['wasted']), float(obj['wasted']) / obj['size'], obj.get('estimated_by', 'sql')))
+        if not args.dry_run:
+            return reindex_index(cursor, obj, db, old_entry)
+        return
+
+    if obj['invalid_index']:
+        logger.info("Reindexing invalid index {}".format(obj['name']))
+    else:
+        oldsize = old_entry['size']
+        logger.info("Reindexing {} size {} wasted {} {:.0%} (estimated by {})".format(obj['name'], format_size(obj['size']), format_size(obj['wasted']), float(obj['wasted']) / obj['size'], obj.get('estimated_by', 'sql')))
+
+    if drop_first and not can_drop_first(obj, old_entry):
+        logger.info("Skipping index {} because it is unique, or has a constraint, so can't be dropped first".format(obj['name']))
+        return
+
+    # An exclusion constraint can't be moved to a new index (and can't be
+    # rebuilt concurrently), so that needs a plain REINDEX (--no-concurrent)
+    constraint = old_entry['contype']
+    if constraint == 'x':
+        if args.concurrent:
+            logger.info("Skipping index {} because it has an exclusion constraint, which can't be rebuilt concurrently (see --no-concurrent)".format(obj['name']))
+            return
+        if not args.dry_run:
+            return reindex_index(cursor, obj, db, old_entry, concurrently=False)
+        return
+
+    # A partition's index which is attached to the partitioned table's index
+    # can't be dropped, nor another attached in its place, so REINDEX it
+    if old_entry['parent_index'] is not None:
+        if not args.dry_run:
+            return reindex_index(cursor, obj, db, old_entry, concurrently=args.concurrent)
+        return
+
+    # The old index can't be dropped while a foreign key depends on it
+    if old_entry['referenced_by_fk']:
+        logger.info("Skipping index {} because foreign keys depend on it (see --engine reindex)".format(obj['name']))
+        return
+
+    # what's the tablespace for this index?
+    index_tablespace = old_entry['tablespace'] or db.database_tablespace
+    logger.info("index {} is on tablespace {}".format(obj['name'], index_tablespace));
+
+    if not args.dry_run:
+        old_index_name = "{t}_old".format(t=obj['name'])
+
+        if snapshot.get(obj['schemaname'], old_index_name) is not None:
+            logger.info("The index {old} already exists. This can happen when a previous run of this has been interrupted. You can delete this old index with:  DROP INDEX {old};  Processing will continue with the rest of the indexes".format(old=old_index_name))
+            return
+
+        # TODO For invalid indexes, you could drop the old one
+        # first, since it's invalid and unusable. However that
+        # means if there's a problem later, you have lost the
+        # information that something is wrong with your
+        # database
+        if not drop_first:
+            # Move old index out of the way
+            # Waiting for the lock blocks all other queries on the table (and
+            # sometimes this statement has been blocked for days), so only
+            # wait briefly, and retry later
+            with db.phase(obj['name'], 'rename'):
+                renamed = lock_retry.execute(cursor, "ALTER INDEX {t} RENAME TO {old};".format(t=obj['name'], old=old_index_name), db.name, 'rename')
+            if not renamed:
+                logger.error("Could not rename {t} to {old}. Skipping this index".format(t=obj['name'], old=old_index_name))
+                return
+            logger.debug("Renamed index {t} to {t}_old".format(t=obj['name']))
+        else:
+            # Super slim mode, delete it
+            with db.phase(obj['name'], 'drop'):
+                dropped = lock_retry.execute(cursor, "DROP INDEX {t};".format(t=obj['name']), db.name, 'drop')
+            if not dropped:
+                logger.error("Could not drop {t}. Skipping this index".format(t=obj['name']))
+                return
+            logger.debug("Dropped index {t}".format(t=obj['name']))
+
+        # (Re-)Create the new index
+        cursor.execute("SET default_tablespace = %s;", (tablespace,))
+        logger.debug("Index creation SQL: {}".format(obj['indexdef']))
+        if args.pre_rebuild_command:
+            logger.debug("About to run pre-rebuild command: {}".format(args.pre_rebuild_command))
+            (status, output) = subprocess.getstatusoutput(args.pre_rebuild_command)
+
+            logger.debug("Pre-rebuild command of {}, status code: {} output: {}".format(args.pre_rebuild_command, status, output))
+        try:
+
+            index_attempt = 1
+            successful_recreation = False
+            while not successful_recreation and index_attempt <= MAX_INDEX_ATTEMPTS:
+                logger.debug("Starting attempt {} of {} for {}".format(index_attempt, MAX_INDEX_ATTEMPTS, obj['name']))
+
+                if args.concurrent:
+                    index_creation_sql = make_indexdef_concurrent(obj['indexdef'])
+                else:
+                    index_creation_sql = obj['indexdef']
+
+
+                # Create the new index
+                with db.phase(obj['name'], 'create'), log_duration("recreating index"):
+                    cursor.execute(index_creation_sql)
+
+
+                # check if the new index is valid
+                with db.phase(obj['name'], 'validate'):
+                    snapshot.refresh(cursor, obj['schemaname'], [obj['name'], old_index_name])
+                    new_index_is_valid = snapshot.get(obj['schemaname'], obj['name'])['indisvalid']
+                if not new_index_is_valid:
+                    logger.error("New index {} is not valid. Deleting and retrying. That was attempt {} of {}".format(obj['name'], index_attempt, MAX_INDEX_ATTEMPTS))
+                    if not lock_retry.execute(cursor, "DROP INDEX {};".format(obj['name']), db.name):
+                        logger.error("Could not drop the invalid index {t}. Drop it, and rename the old index back, with:  DROP INDEX {t}; ALTER INDEX {old} RENAME TO {t};".format(t=obj['name'], old=old_index_name))
+                        return
+                    successful_recreation = False
+                    if index_attempt < MAX_INDEX_ATTEMPTS:
+                        db.count('retries')
+                        time.sleep(backoff_delay(index_attempt, RETRY_BACKOFF, RETRY_MAX_BACKOFF))
+                else:
+                    # Index is valid, so break out
+                    logger.debug("New index {} is valid. That was attempt {} of {}".format(obj['name'], index_attempt, MAX_INDEX_ATTEMPTS))
+                    successful_recreation = True
+
+                index_attempt += 1
+
+            # Could not recreate index successfully after MAX_INDEX_ATTEMPTS attempts
+            if not successful_recreation:
+                logger.error("Could not recreate {}. Attempted {} times. Ignoring this index".format(obj['name'], MAX_INDEX_ATTEMPTS))
+                # Remame _old index back to new name
+                logger.debug("Renaming old index ({old}) back to original name ({t})".format(old=old_index_name, t=obj['name']))
+                rename_back(cursor, lock_retry, obj['name'], old_index_name, db.name)
+
+                # bailout
+                return
+
+        except psycopg2.Error as e:
+            logger.error("Error occured: {!r}".format(e))
+            # drop newly created, and invalid index
+            logger.debug("Deleting the invalid index {}".format(obj['name']))
+            if lock_retry.execute(cursor, "DROP INDEX IF EXISTS {t};".format(t=obj['name']), db.name):
+                logger.debug("Renaming old index ({old}) back to original name ({t})".format(old=old_index_name, t=obj['name']))
+                rename_back(cursor, lock_retry, obj['name'], old_index_name, db.name)
+            else:
+                logger.error("Could not drop the invalid index {t}. Drop it, and rename the old index back, with:  DROP INDEX {t}; ALTER INDEX {old} RENAME TO {t};".format(t=obj['name'], old=old_index_name))
+            snapshot.refresh(cursor, obj['schemaname'], [obj['name'], old_index_name])
+            if isinstance(e, psycopg2.OperationalError):
+                raise
+            # e.g. a unique violation. Trying again won't help
+            logger.error("Could not recreate {}. Ignoring this index".format(obj['name']))
+            return
+
+        finally:
+            if args.post_rebuild_command:
+                logger.debug("About to run post-rebuild command: {}".format(args.post_rebuild_command))
+                (status, output) = subprocess.getstatusoutput(args.post_rebuild_command)
+
+                logger.debug("Post-rebuild command of {}, status code: {} output: {}".format(args.post_rebuild_command, status, output))
+
+
+        # Analyze the new index.
+        with db.phase(obj['name'], 'analyse'):
+            cursor.execute("ANALYSE {t};".format(t=obj['name']))
+
+        if constraint is not None:
+            # Renaming the old index renamed its constraint too
+            swap_sql = constraint_swap_sql(obj, old_entry, old_index_name)
+            with db.phase(obj['name'], 'constraint_swap'):
+                swapped = lock_retry.execute(cursor, swap_sql, db.name, 'constraint_swap')
+            if not swapped:
+                logger.error("Could not swap the constraint {t} of {table} to the new index. Do it later with:  {sql}".format(t=obj['name'], table=obj['table'], sql=swap_sql))
+                snapshot.refresh(cursor, obj['schemaname'], [obj['name'], old_index_name])
+                return
+            logger.debug("Swapped the constraint {t} to the new index".format(t=obj['name']))
+
+        if not drop_first:
+
+            if tablespace != index_tablespace:
+                with db.phase(obj['name'], 'tablespace_move'), log_duration("moving new index to the proper tablespace ({}) from the working tablespace {}".format(index_tablespace, tablespace)):
+                    cursor.execute("ALTER INDEX {new} SET TABLESPACE {t};".format(new=obj['name'], t=index_tablespace))
+
+            if constraint is None:
+                try:
+                    with db.phase(obj['name'], 'drop'):
+                        dropped = lock_retry.execute(cursor, "DROP INDEX {old};".format(old=old_index_name), db.name, 'drop')
+                except psycopg2.Error as e:
+                    if isinstance(e, psycopg2.OperationalError):
+                        raise
+                    # e.g. something else depends on it
+                    logger.error("Error dropping the old index {}: {!r}".format(old_index_name, e))
+                    dropped = False
+                if dropped:
+                    logger.debug("Dropped index {old}".format(old=old_index_name))
+                else:
+                    logger.error("Could not drop the old index {old}. The new index {t} is in use. Drop the old one later with:  DROP INDEX {old};".format(t=obj['name'], old=old_index_name))
+
+        snapshot.refresh(cursor, obj['schemaname'], [obj['name'], old_index_name])
+
+        if snapshot.get(obj['schemaname'], old_index_name) is not None:
+            # No space saved (yet)
+            return True
+
+        if not obj['invalid_index']:
+            newsize = snapshot.get(obj['schemaname'], obj['name'])['size']
+            savings = oldsize - newsize
+            db.run.savings_counter.add(savings, oldsize, db.name)
+
+        return True
+
+
+def rename_back(cursor, lock_retry, name, old_index_name, database):
+    """After a failed rebuild, give the old index its name back."""
+    if not lock_retry.execute(cursor, "ALTER INDEX {old} RENAME TO {t};".format(t=name, old=old_index_name), database):
+        logger.error("Could not rename the old index {old} back to {t}. Do it later with:  ALTER INDEX {old} RENAME TO {t};".format(t=name, old=old_index_name))
+
+
+class Plan(object):
+    """
+    What to do with each index: rebuild it (where, and roughly how long it
+    will take), or skip it (and why). --plan-out writes this to a JSON file,
+    which can be reviewed, and then run with --apply-plan, without estimating
+    the bloat again. Indexes to rebuild are in the order they'll be rebuilt.
+    """
+    VERSION = 1
+
+    def __init__(self, entries=None):
+        self.entries = entries or []
+        self.lock = threading.Lock()
+
+    def add(self, database, obj, entry, skip_reason=None, tablespace=None, estimated_seconds=None, storage_advice=None):
+        """
+        entry is the index's CatalogSnapshot entry (if it exists).
+        storage_advice is the --storage-advice for it, and whether to apply it.
+        """
+        plan_entry = {
+            'database': database,
+            'oid': entry['oid'] if entry is not None else None,
+            'relfilenode': entry['relfilenode'] if entry is not None else None,
+            'schemaname': obj['schemaname'],
+            'name': obj['name'],
+            'table': obj['table'],
+            'indexdef': obj['indexdef'],
+            'size': int(obj.get('size', entry['size'] if entry is not None else 0)),
+            'wasted': int(obj.get('wasted', 0)),
+            'estimated_by': obj.get('estimated_by'),
+            'invalid_index': obj['invalid_index'],
+            'primary': obj.get('primary', False),
+            'action': 'skip' if skip_reason is not None else 'rebuild',
+            'skip_reason': skip_reason,
+            'tablespace': tablespace,
+            'estimated_seconds': estimated_seconds,
+            'storage_advice': storage_advice,
+        }
+        with self.lock:
+            self.entries.append(plan_entry)
+
+    def databases(self):
+        """The databases in the plan, in order."""
+        databases = []
+        for entry in self.entries:
+            if entry['database'] not in databases:
+                databases.append(entry['database'])
+        return databases
+
+    def save(self, path):
+        with self.lock:
+            plan = {'version': self.VERSION, 'created': time.time(), 'pgindexrebuild_version': version(), 'indexes': self.entries}
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, 'w') as fp:
+            json.dump(plan, fp, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fp:
+            plan = json.load(fp)
+        if plan.get('version') != cls.VERSION:
+            raise ValueError("Unknown plan version {!r}".format(plan.get('version')))
+        return cls(plan['indexes'])
+
+    def to_rebuild(self, database, snapshot, exclude_index=None):
+        """
+        The indexes to rebuild in database, as objs, after a cheap check that
+        each one is still the same index (same oid, and not rebuilt since)
+        and still needs rebuilding.
+        """
+        objs = []
+        for entry in self.entries:
+            if entry['database'] != database or entry['action'] != 'rebuild':
+                continue
+            if exclude_index is not None and (entry['name'] in exclude_index or database + "." + entry['name'] in exclude_index):
+                logger.info("Skipping index {} because it has been excluded".format(entry['name']))
+                continue
+            current = snapshot.get(entry['schemaname'], entry['name'])
+            if current is None:
+                logger.info("Skipping index {} from the plan because it no longer exists".format(entry['name']))
+                continue
+            if current['oid'] != entry['oid'] or current['relfilenode'] != entry['relfilenode']:
+                logger.info("Skipping index {} from the plan because it has been recreated or rebuilt since the plan was made".format(entry['name']))
+                continue
+            if entry['invalid_index'] and current['indisvalid']:
+                logger.info("Skipping index {} from the plan because it is no longer invalid".format(entry['name']))
+                continue
+
+            obj = {
+                'schemaname': entry['schemaname'],
+                'name': entry['name'],
+                'table': entry['table'],
+                'indexdef': entry['indexdef'],
+                'invalid_index': entry['invalid_index'],
+                'primary': entry['primary'],
+                'oid': entry['oid'],
+                'planned_tablespace': entry['tablespace'],
+                # Plans from before --storage-advice was planned have none
+                'storage_advice': entry.get('storage_advice'),
+            }
+            if not entry['invalid_index']:
+                obj.update(size=current['size'], wasted=entry['wasted'], estimated_by=entry['estimated_by'])
+            objs.append(obj)
+        return objs
+
+
+def add_to_plan(cursor, db, objs):
+    """
+    Add the indexes which would be rebuilt to the --plan-out plan, with where
+    and roughly how long, and any --storage-advice.
+    """
+    run = db.run
+    for obj in objs:
+        entry = db.snapshot.get(obj['schemaname'], obj['name'])
+        index_tablespace = (entry['tablespace'] if entry is not None else None) or db.database_tablespace
+        build_tablespaces = choose_build_tablespaces(run, index_tablespace, run.args.always_drop_first)
+        tablespace = build_tablespaces[0]
+        if run.free_space is not None and not run.args.always_drop_first:
+            # Which one has room now. Rebuilding other indexes may free up space
+            needed = max(0, obj.get('size', 0) - int(obj.get('wasted', 0)))
+            with_room = run.free_space.reserve(build_tablespaces, needed)
+            if with_room is not None:
+                run.free_space.release(with_room, needed)
+                tablespace = with_room
+        if run.budget is not None:
+            estimate = run.budget.estimate_seconds(obj)
+        else:
+            estimate = estimate_build_seconds(obj, run.args.build_rate)
+        storage_advice = None
+        if run.storage_advisor is not None and entry is not None and not obj['invalid_index']:
+            storage_advice = run.storage_advisor.advice(cursor, db, obj, entry)
+            if storage_advice is not None:
+                storage_advice = dict(storage_advice, apply=run.storage_advisor.apply)
+        run.plan.add(db.name, obj, entry, tablespace=tablespace, estimated_seconds=estimate, storage_advice=storage_advice)
+
+
+class RunHistory(object):
+    """
+    A local SQLite file recording what was seen and done to each index, on
+    every run. Every run records an 'observed' row for each bloated index
+    (size & estimated waste), and a 'rebuilt' row for each successful rebuild
+    (old & new size, duration). From that we know how fast each index
+    re-bloats, and how long it takes to rebuild.
+    """
+    SCHEMA = """CREATE TABLE IF NOT EXISTS index_history (
+            id INTEGER PRIMARY KEY,
+            timestamp REAL NOT NULL,
+            database TEXT NOT NULL,
+            schemaname TEXT NOT NULL,
+            indexname TEXT NOT NULL,
+            tablename TEXT,
+            event TEXT NOT NULL,
+            size INTEGER,
+            wasted INTEGER,
+            new_size INTEGER,
+            savings INTEGER,
+            duration REAL,
+            table_writes INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS index_history_index ON index_history (database, schemaname, indexname, timestamp);"""
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.executescript(self.SCHEMA)
+            # Added later
+            columns = [row['name'] for row in self.conn.execute("PRAGMA table_info(index_history);")]
+            if 'table_writes' not in columns:
+                self.conn.execute("ALTER TABLE index_history ADD COLUMN table_writes INTEGER;")
+
+    def close(self):
+        self.conn.close()
+
+    INSERT = "INSERT INTO index_history (timestamp, database, schemaname, indexname, tablename, event, size, wasted, new_size, savings, duration, table_writes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+
+    def _insert(self, database, obj, event, size, wasted=None, new_size=None, duration=None, table_writes=None):
+        savings = None if new_size is None else size - new_size
+        with self.lock, self.conn:
+            self.conn.execute(self.INSERT, (time.time(), database, obj['schemaname'], obj['name'], obj.get('table'), event, size, wasted, new_size, savings, duration, table_writes))
+
+    def record_observations(self, database, objs):
+        """Record all of a database's bloated indexes, in one transaction."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(self.INSERT, [(now, database, obj['schemaname'], obj['name'], obj.get('table'), 'observed', obj['size'], int(obj['wasted']), None, None, None, None) for obj in objs])
+
+    def record_rebuild(self, database, obj, size, new_size, duration, table_writes=None):
+        self._insert(database, obj, 'rebuilt', size, wasted=int(obj.get('wasted', 0)), new_size=new_size, duration=duration, table_writes=table_writes)
+
+    def _rows(self, sql, params):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def last_rebuild(self, database, schemaname, indexname):
+        """The row of the most recent successful rebuild of this index, or None."""
+        rows = self._rows("SELECT * FROM index_history WHERE database = ? AND schemaname = ? AND indexname = ? AND event = 'rebuilt' ORDER BY timestamp DESC LIMIT 1;", (database, schemaname, indexname))
+        return rows[0] if rows else None
+
+    def build_rate(self, database, schemaname, indexname):
+        """Bytes per second this index was rebuilt at in the past, or None if it's never been rebuilt."""
+        rows = self._rows("SELECT SUM(new_size), SUM(duration) FROM index_history WHERE database = ? AND schemaname = ? AND indexname = ? AND event = 'rebuilt' AND duration > 0;", (database, schemaname, indexname))
+        new_size, duration = rows[0]
+        if not new_size or not duration:
+            return None
+        return new_size / duration
+
+    def growth_rate(self, database, schemaname, indexname):
+        """
+        Bytes of bloat per second this index has gained since it was last
+        rebuilt (which is assumed to leave no bloat), or None if unknown.
+        """
+        last_rebuild = self.last_rebuild(database, schemaname, indexname)
+        if last_rebuild is None:
+            return None
+        rows = self._rows("SELECT timestamp, wasted FROM index_history WHERE database = ? AND schemaname = ? AND indexname = ? AND event = 'observed' AND timestamp > ? ORDER BY timestamp DESC LIMIT 1;", (database, schemaname, indexname, last_rebuild['timestamp']))
+        if len(rows) == 0:
+            return None
+        latest = rows[0]
+        return latest['wasted'] / max(latest['timestamp'] - last_rebuild['timestamp'], 1)
+
+    def report(self, min_bloat):
+        """
+        One dict per index which has been rebuilt, with how often it's been
+        rebuilt, how fast it re-bloats, and when it's predicted to have more
+        than min_bloat of bloat again.
+        """
+        results = []
+        for row in self._rows("SELECT database, schemaname, indexname, COUNT(*) AS rebuilds, MAX(timestamp) AS last_rebuilt, SUM(savings) AS total_savings, AVG(duration) AS avg_duration FROM index_history WHERE event = 'rebuilt' GROUP BY 1, 2, 3 ORDER BY 1, 2, 3;", ()):
+            growth_rate = self.growth_rate(row['database'], row['schemaname'], row['indexname'])
+            if growth_rate:
+                next_rebuild = row['last_rebuilt'] + min_bloat / growth_rate
+            else:
+                next_rebuild = None
+            results.append(dict(row, growth_rate=growth_rate, next_rebuild=next_rebuild))
+        return results
+
+
+def skip_from_history(history, database, obj, args, writes=None):
+    """
+    Returns why (and logs it) if the run history says this index shouldn't be
+    rebuilt now, otherwise None. writes is the number of rows written to its
+    table so far (see table_writes()).
+    """
+    reason = None
+    last_rebuild = history.last_rebuild(database, obj['schemaname'], obj['name'])
+    if writes is not None and last_rebuild is not None and last_rebuild['table_writes'] == writes:
+        # e.g. an old partition. The estimate will be the same as last time,
+        # but there can't be any new bloat
+        reason = "its table hasn't been written to since it was rebuilt"
+
+    if reason is None and args.skip_rebuilt_within is not None and last_rebuild is not None:
+        ago = time.time() - last_rebuild['timestamp']
+        if ago < args.skip_rebuilt_within:
+            reason = "it was rebuilt {} ago".format(humanfriendly.format_timespan(ago))
+
+    if reason is None and args.min_bloat_growth is not None:
+        growth_rate = history.growth_rate(database, obj['schemaname'], obj['name'])
+        if growth_rate is not None and growth_rate * 86400 < args.min_bloat_growth:
+            reason = "its bloat only grows by {} per day".format(format_size(growth_rate * 86400))
+
+    if reason is not None:
+        logger.info("Skipping Index {} because {}".format(obj['name'], reason))
+    return reason
+
+
+def table_writes(cursor, table_oid=None):
+    """
+    The number of rows written (inserted, updated & deleted) to each table
+    (or only table_oid) since the statistics were reset, by table oid.
+    """
+    sql = "SELECT relid, n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables"
+    if table_oid is None:
+        cursor.execute(sql + ";")
+    else:
+        cursor.execute(sql + " WHERE relid = %s;", (table_oid,))
+    return dict((row[0], row[1]) for row in cursor.fetchall())
+
+
+def print_history_report(history, min_bloat):
+    """Print the history report, as a table, to stdout."""
+    def format_timestamp(t):
+        return "-" if t is None else time.strftime("%Y-%m-%d %H:%M", time.localtime(t))
+
+    rows = [("DATABASE", "INDEX", "REBUILDS", "LAST REBUILT", "AVG DURATION", "TOTAL SAVED", "BLOAT GROWTH/DAY", "NEXT REBUILD")]
+    for row in history.report(min_bloat):
+        rows.append((
+            row['database'],
+            "{}.{}".format(row['schemaname'], row['indexname']),
+            str(row['rebuilds']),
+            format_timestamp(row['last_rebuilt']),
+            humanfriendly.format_timespan(row['avg_duration'] or 0),
+            humanfriendly.format_size(row['total_savings'] or 0),
+            "-" if row['growth_rate'] is None else humanfriendly.format_size(row['growth_rate'] * 86400),
+            format_timestamp(row['next_rebuild']),
+        ))
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    for r in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(r, widths)).rstrip())
+
+
+class StorageAdvisor(object):
+    """
+    --storage-advice: recommends a fillfactor and deduplicate_items for each
+    btree index before it's rebuilt, from how its table is written to, so
+    it doesn't re-bloat within days. With apply, they're set on the index
+    before the rebuild, so the new index is built with them.
+
+    Every non-HOT update & insert adds an entry to the index. Where they land
+    all over the index (the leading column isn't correlated with the table's
+    order), pages split once their free space is used up, leaving two half
+    empty pages. A lower fillfactor leaves more room for them. An index on
+    an ever increasing column which is only inserted into only ever adds to
+    its last page, so is best completely full. Deduplication (PostgreSQL 13+)
+    stores duplicates, including the versions left by non-HOT updates, once.
+
+    The predicted time to re-bloat past --min-bloat is how long the free
+    space lasts at the current rate of new entries, plus how long the bloat
+    takes to grow past --min-bloat after that, at the rate from the run
+    history if there is one, otherwise about one entry's size per new entry.
+    For an index which is only appended to, it's how long until the free
+    space left by the fillfactor, which is never used, passes --min-bloat.
+    It's a rough guide.
+    """
+    SQL = """SELECT c.reloptions, am.amname, c.reltuples, i.indisunique, {has_include} AS has_include,
+            s.n_tup_ins, s.n_tup_upd, s.n_tup_hot_upd, s.n_tup_del,
+            extract(epoch FROM now() - coalesce(d.stats_reset, pg_postmaster_start_time())) AS stats_age,
+            st.correlation, st.n_distinct
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = c.relam
+        JOIN pg_stat_user_tables s ON s.relid = i.indrelid
+        JOIN pg_stat_database d ON d.datname = current_database()
+        -- The leading column's statistics (none for an expression)
+        LEFT JOIN pg_attribute ta ON ta.attrelid = i.indrelid AND ta.attnum = i.indkey[0] AND ta.attnum > 0
+        LEFT JOIN pg_stats st ON st.schemaname = s.schemaname AND st.tablename = s.relname AND st.attname = ta.attname AND NOT st.inherited
+        WHERE i.indexrelid = %s;"""
+
+    # Leading columns at least this correlated are treated as ever increasing
+    # (or decreasing)
+    SEQUENTIAL_CORRELATION = 0.9
+    # Size of a heap tuple pointer in a deduplicated posting list
+    TID_BYTES = 6
+
+    def __init__(self, apply, min_bloat, server_version, history=None):
+        self.apply = apply
+        self.min_bloat = min_bloat
+        self.server_version = server_version
+        self.history = history
+
+    def stats(self, cursor, index_oid):
+        has_include = "i.indnkeyatts < i.indnatts" if self.server_version >= 110000 else "false"
+        cursor.execute(self.SQL.format(has_include=has_include), (index_oid,))
+        return cursor.fetchone()
+
+    def advise(self, database, obj, stats):
+        """
+        The recommended storage parameters for obj (as a dict), and why, and
+        the predicted time to re-bloat before & after. None if there's
+        nothing to change.
+        """
+        if stats is None or stats['amname'] != 'btree' or stats['reltuples'] <= 0:
+            return None
+        new_entries = stats['n_tup_ins'] + stats['n_tup_upd'] - stats['n_tup_hot_upd']
+        writes = stats['n_tup_ins'] + stats['n_tup_upd'] + stats['n_tup_del']
+        if new_entries == 0:
+            return None
+        churn = float(stats['n_tup_upd'] - stats['n_tup_hot_upd']) / new_entries
+        sequential = stats['correlation'] is not None and abs(stats['correlation']) >= self.SEQUENTIAL_CORRELATION
+
+        fillfactor = index_fillfactor(stats['reloptions'])
+        new_fillfactor = fillfactor
+        reasons = []
+        # A fillfactor set on purpose is only raised if nothing but inserts
+        # have been seen
+        fillfactor_set = any(option.startswith("fillfactor=") for option in (stats['reloptions'] or []))
+        max_changes = 0 if fillfactor_set else writes * 0.01
+        if sequential and stats['n_tup_upd'] + stats['n_tup_del'] <= max_changes:
+            new_fillfactor = 1.0
+            reasons.append("it's only appended to, so the free space in its pages would never be used")
+        elif not sequential and churn >= 0.2:
+            # Only ever lowered
+            new_fillfactor = min(fillfactor, 0.7 if churn >= 0.5 else 0.8)
+            reasons.append("{:.0%} of its new entries are from non-HOT updates, all over the index".format(churn))
+        if new_fillfactor == fillfactor:
+            reasons = []
+
+        # How many times each value is in the index
+        if stats['indisunique'] or stats['n_distinct'] is None or stats['n_distinct'] == 0:
+            duplicates = 1.0
+        elif stats['n_distinct'] > 0:
+            duplicates = max(1.0, stats['reltuples'] / stats['n_distinct'])
+        else:
+            duplicates = 1.0 / -stats['n_distinct']
+        deduplicate = index_deduplicate_items(stats['reloptions'])
+        new_deduplicate = deduplicate
+        if self.server_version >= 130000 and not stats['has_include'] and not deduplicate and (duplicates >= 2 or churn >= 0.2):
+            new_deduplicate = True
+            reasons.append("it has {} (deduplication is off)".format("about {:.0f} entries per value".format(duplicates) if duplicates >= 2 else "many versions from non-HOT updates"))
+
+        if new_fillfactor == fillfactor and new_deduplicate == deduplicate:
+            return None
+
+        # The predicted time to re-bloat, before & after. None is never
+        rate = new_entries / max(float(stats['stats_age']), 1)
+        entry_bytes = max(1.0, (obj['size'] - int(obj.get('wasted', 0))) / stats['reltuples'])
+        if sequential:
+            # Appended entries never go in the free space which the
+            # fillfactor leaves in each page, so that's wasted from the
+            # rebuild on, and grows as pages are added (at the fillfactor)
+            def rebloat_seconds(fillfactor, dedup):
+                unused = stats['reltuples'] * entry_bytes * (1 - fillfactor) / fillfactor
+                growth_rate = rate * entry_bytes * (1 - fillfactor) / fillfactor
+                if unused >= self.min_bloat:
+                    return 0
+                return None if growth_rate == 0 else (self.min_bloat - unused) / growth_rate
+        else:
+            growth_rate = None
+            if self.history is not None:
+                growth_rate = self.history.growth_rate(database, obj['schemaname'], obj['name'])
+            if not growth_rate:
+                # A split leaves about as much free space as the entry needed
+                growth_rate = rate * entry_bytes
+
+            def rebloat_seconds(fillfactor, dedup):
+                # New entries go in the free space left by the fillfactor
+                # before pages split
+                headroom = stats['reltuples'] * (1 - fillfactor) / fillfactor
+                rebloat_rate = growth_rate
+                if dedup and not deduplicate and duplicates >= 2:
+                    # Each duplicate is a TID in a posting list, rather than an entry
+                    rebloat_rate *= min(1.0, (entry_bytes + (duplicates - 1) * self.TID_BYTES) / (duplicates * entry_bytes))
+                return headroom / rate + self.min_bloat / rebloat_rate
+
+        return {
+            'fillfactor': int(round(new_fillfactor * 100)),
+            'deduplicate_items': new_deduplicate,
+            'old_fillfactor': int(round(fillfactor * 100)),
+            'old_deduplicate_items': deduplicate,
+            'reasons': reasons,
+            'rebloat_seconds': rebloat_seconds(fillfactor, deduplicate),
+            'new_rebloat_seconds': rebloat_seconds(new_fillfactor, new_deduplicate),
+        }
+
+    def set_options(self, cursor, db, obj, old_entry, advice):
+        """
+        Set the advised storage parameters on the index (only those which
+        differ from its current ones), so its rebuild uses them. Returns the
+        SQL to put the old ones back, or None if nothing was set.
+        """
+        cursor.execute("SELECT reloptions FROM pg_class WHERE oid = %s;", (old_entry['oid'],))
+        reloptions = cursor.fetchone()[0] or []
+        options = []
+        if advice['fillfactor'] != int(round(index_fillfactor(reloptions) * 100)):
+            options.append(('fillfactor', str(advice['fillfactor'])))
+        if self.server_version >= 130000 and advice['deduplicate_items'] != index_deduplicate_items(reloptions):
+            options.append(('deduplicate_items', "on" if advice['deduplicate_items'] else "off"))
+        if len(options) == 0:
+            return None
+
+        qualified_name = "{}.{}".format(obj['schemaname'], obj['name'])
+        set_options = ", ".join("{} = {}".format(name, value) for name, value in options)
+        if not db.run.lock_retry.execute(cursor, "ALTER INDEX {t} SET ({options});".format(t=qualified_name, options=set_options), db.name):
+            logger.error("Could not set {} on index {}. Rebuilding it with its current storage parameters".format(set_options, obj['name']))
+            return None
+        # The legacy engine builds the new index from its definition
+        cursor.execute("SELECT pg_get_indexdef(%s);", (old_entry['oid'],))
+        obj['indexdef'] = cursor.fetchone()[0]
+
+        # Back to how they were: the ones which were set, set again, the others reset to the default
+        current = dict(option.split("=", 1) for option in reloptions)
+        reset = [name for name, _ in options if name not in current]
+        restore = ["{} = {}".format(name, current[name]) for name, _ in options if name in current]
+        revert = []
+        if len(reset) > 0:
+            revert.append("ALTER INDEX {t} RESET ({options});".format(t=qualified_name, options=", ".join(reset)))
+        if len(restore) > 0:
+            revert.append("ALTER INDEX {t} SET ({options});".format(t=qualified_name, options=", ".join(restore)))
+        return " ".join(revert)
+
+    def revert_options(self, cursor, db, obj, revert):
+        """The rebuild failed (or was skipped): put back the index's old storage parameters, with the SQL from set_options()."""
+        logger.info("Putting back the old storage parameters of index {}, since it wasn't rebuilt".format(obj['name']))
+        try:
+            reverted = db.run.lock_retry.execute(cursor, revert, db.name)
+        except psycopg2.Error as ex:
+            logger.error("Could not put back the old storage parameters of index {}: {!r}".format(obj['name'], ex))
+            reverted = False
+        if not reverted:
+            logger.error("Index {} still has the advised storage parameters. Put them back with:  {}".format(obj['name'], revert))
+
+    def advice(self, cursor, db, obj, old_entry):
+        """Log the advice for obj, and return it (or None)."""
+        advice = self.advise(db.name, obj, self.stats(cursor, old_entry['oid']))
+        if advice is None:
+            return None
+        def describe(fillfactor, deduplicate):
+            if deduplicate == advice['old_deduplicate_items'] == advice['deduplicate_items']:
+                return "fillfactor {}".format(fillfactor)
+            return "fillfactor {}, deduplicate_items {}".format(fillfactor, "on" if deduplicate else "off")
+        def describe_time(seconds):
+            return "never" if seconds is None else "in about {}".format(humanfriendly.format_timespan(seconds))
+        logger.info("Index {}: {} is advised (currently {}), because {}. Predicted to have {} of bloat again {}, rather than {}".format(
+            obj['name'], describe(advice['fillfactor'], advice['deduplicate_items']), describe(advice['old_fillfactor'], advice['old_deduplicate_items']), " and ".join(advice['reasons']),
+            format_size(self.min_bloat), describe_time(advice['new_rebloat_seconds']), describe_time(advice['rebloat_seconds'])))
+        return advice
+
+    def run(self, cursor, db, obj, old_entry):
+        """
+        Log the advice for obj, and with --storage-advice apply, set it. With
+        --apply-plan, the advice in the plan is used instead. Returns the SQL
+        to put the old storage parameters back, or None if none were set.
+        """
+        if 'storage_advice' in obj:
+            advice = obj['storage_advice']
+            if advice is None:
+                return None
+            apply = advice['apply']
+            logger.info("Index {}: fillfactor {}, deduplicate_items {} was advised in the plan".format(obj['name'], advice['fillfactor'], "on" if advice['deduplicate_items'] else "off"))
+        else:
+            advice = self.advice(cursor, db, obj, old_entry)
+            if advice is None:
+                return None
+            apply = self.apply
+        revert = None
+        if apply and not db.run.args.dry_run:
+            revert = self.set_options(cursor, db, obj, old_entry, advice)
+        if db.run.metrics is not None:
+            db.run.metrics.event('storage_advice', database=db.name, index=obj['name'], fillfactor=advice['fillfactor'], deduplicate_items=advice['deduplicate_items'], rebloat_seconds=advice['rebloat_seconds'], new_rebloat_seconds=advice['new_rebloat_seconds'], applied=revert is not None)
+        return revert
+
+
+class ChangeTracker(object):
+    """
+    --skip-unchanged: a JSON file recording, for each database, how many rows
+    had been written (inserted, updated & deleted) when its bloat was last
+    estimated, and how much bloat was left in the index closest to
+    --min-bloat. Each row written since can add at most about one index entry
+    of bloat to an index (twice that, allowing for page splits), so when too
+    few rows have been written for any index to have crossed --min-bloat, the
+    (slow) estimate is skipped.
+    """
+    SQL = """SELECT
+            (SELECT stats_reset::text FROM pg_stat_database WHERE datname = current_database()) AS stats_reset,
+            (SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables)::bigint AS changes,
+            (SELECT count(*) FROM pg_index WHERE NOT indisvalid) AS invalid_indexes,
+            -- The biggest index entry (leaf pages, i.e. without the metapage, per tuple)
+            (SELECT coalesce(max((relpages - 1)::float8 * current_setting('block_size')::int / reltuples), 0) FROM pg_class WHERE relkind = 'i' AND relpages > 1 AND reltuples > 0) AS max_entry_bytes;"""
+
+    def __init__(self, path):
+        self.path = path
+        self.databases = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path) as fp:
+                    self.databases = json.load(fp)
+            except (IOError, ValueError) as ex:
+                logger.warning("Could not read {}, checking all databases: {!r}".format(path, ex))
+
+    def counters(self, cursor):
+        cursor.execute(self.SQL)
+        return dict(cursor.fetchone())
+
+    def unchanged(self, database, counters, min_bloat, repair_invalid=False):
+        """
+        If database can't have any index over min_bloat now (nor, with
+        repair_invalid, any invalid index), a description of why. Otherwise None.
+        """
+        with self.lock:
+            last = self.databases.get(database)
+        if last is None:
+            return None
+        if counters['stats_reset'] != last['stats_reset'] or counters['changes'] < last['changes']:
+            # The statistics were reset, so we don't know what changed
+            return None
+        if repair_invalid and counters['invalid_indexes'] > 0:
+            return None
+        changes = counters['changes'] - last['changes']
+        possible_bloat = last['bloat_left'] + 2 * changes * counters['max_entry_bytes']
+        if possible_bloat > min_bloat:
+            return None
+        return "{:,} rows written since the last check, so no index can have more than {} of bloat".format(changes, format_size(int(possible_bloat)))
+
+    def record(self, database, counters, bloat_left):
+        with self.lock:
+            self.databases[database] = {'stats_reset': counters['stats_reset'], 'changes': counters['changes'], 'bloat_left': int(bloat_left), 'timestamp': time.time()}
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.databases, fp)
+            os.rename(tmp_path, self.path)
+
+
+class Run(object):
+    """The settings and state shared by the whole run, across all databases."""
+    def __init__(self, args, connect_args, tablespaces):
+        self.args = args
+        self.connect_args = connect_args
+        # Where new indexes can be built, in order of preference
+        self.tablespaces = tablespaces
+        self.tablespace = tablespaces[0]
+        self.server_version = 0
+        self.free_space = None
+        self.savings_counter = SavingsCounter()
+        self.estimator = None
+        self.table_cache = None
+        self.budget = None
+        self.history = None
+        self.throttle = None
+        self.lock_retry = None
+        self.metrics = None
+        self.progress = ProgressMonitor(None)
+        self.build_tuning = BuildTuning()
+        self.storage_advisor = None
+        # --plan-out: the plan being made. --apply-plan: the plan being run
+        self.plan = None
+        self.plan_to_apply = None
+        # Idle connections (lists, by database name), which are reused rather
+        # than connecting again. Only the daemon keeps connections once
+        # they're released, otherwise there's only the one main() opened.
+        self.spare_connections = {}
+        self.keep_connections = False
+        self.connections_lock = threading.Lock()
+        self.change_tracker = None
+        # The daemon records the history & --skip-unchanged state once a
+        # database's queued rebuilds have finished, not every estimate
+        self.daemon = False
+
+    def connect_database(self, database, tablespace):
+        with self.connections_lock:
+            spare = self.spare_connections.get(database)
+            conn = spare.pop() if spare else None
+        return connect_database(dict(self.connect_args, database=database), tablespace, conn)
+
+    def release_connection(self, database, conn):
+        """Finished with conn for now. Keep it for next time (in the daemon), or close it."""
+        if self.keep_connections and not conn.closed:
+            with self.connections_lock:
+                self.spare_connections.setdefault(database, []).append(conn)
+        else:
+            conn.close()
+
+    def close_spare_connections(self, database=None):
+        """Close the idle connections (to database, or to all databases)."""
+        with self.connections_lock:
+            for name in list(self.spare_connections):
+                if database is None or name == database:
+                    for conn in self.spare_connections.pop(name):
+                        conn.close()
+
+
+class DatabaseRun(object):
+    """The state for processing one database."""
+    def __init__(self, run, name, database_tablespace, snapshot):
+        self.run = run
+        self.name = name
+        self.connect_args = dict(run.connect_args, database=name)
+        self.database_tablespace = database_tablespace
+        self.snapshot = snapshot
+        # Indexes which there wasn't space for. They're tried again at the
+        # end, in the final pass, after other rebuilds have freed up space.
+        self.final_pass = False
+        self.deferred_for_space = []
+        self.lock = threading.Lock()
+        # For --skip-unchanged: the database's write counters, the
+        # (schemaname, name) of the indexes which were rebuilt, and the most
+        # bloat in an index not chosen to be rebuilt
+        self.counters = None
+        self.rebuilt = set()
+        self.bloat_left = 0
+        # The daemon: the bloated indexes seen by the estimate, and those
+        # chosen to be rebuilt
+        self.observed = []
+        self.candidates = []
+        # --prewarm: whether pg_prewarm is installed, and the oids of the
+        # tables which have been prewarmed
+        self.prewarm = False
+        self.prewarmed = set()
+
+    def defer_for_space(self, obj):
+        with self.lock:
+            self.deferred_for_space.append(obj)
+
+    def count(self, name, value=1):
+        """Add to one of the run's metrics counters for this database."""
+        if self.run.metrics is not None:
+            self.run.metrics.inc(name, self.name, value)
+
+    @contextmanager
+    def phase(self, index, name):
+        """Time one phase (e.g. 'create') of rebuilding index, for the metrics."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            if self.run.metrics is not None:
+                self.run.metrics.observe_phase(self.name, index, name, time.time() - start_time)
+
+
+def estimate_build_seconds(obj, build_rate):
+    """
+    Roughly how long rebuilding obj will take. The new index is roughly the
+    old size, without the bloat. Use how fast this index was rebuilt in the
+    past, if we know that, otherwise build_rate (bytes per second).
+    """
+    rate = obj.get('past_build_rate') or build_rate
+    return max(0, obj.get('size', 0) - obj.get('wasted', 0)) / float(rate)
+
+
+class TimeBudget(object):
+    """
+    Keeps the run inside a maintenance window of `seconds`.
+
+    How long an index takes to rebuild is estimated from its size and a build
+    rate (bytes per second). The rate starts at default_build_rate, and is
+    replaced by the rate actually seen, once some indexes have been rebuilt.
+    """
+    def __init__(self, seconds, default_build_rate):
+        self.deadline = time.time() + seconds
+        self.default_build_rate = default_build_rate
+        self.built_bytes = 0
+        self.build_seconds = 0
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return max(0, self.deadline - time.time())
+
+    def build_rate(self):
+        with self.lock:
+            if self.build_seconds > 0 and self.built_bytes > 0:
+                return self.built_bytes / self.build_seconds
+        return self.default_build_rate
+
+    def estimate_seconds(self, obj):
+        return estimate_build_seconds(obj, self.build_rate())
+
+    def record(self, nbytes, seconds):
+        """An index of nbytes (new size) was rebuilt in seconds."""
+        with self.lock:
+            self.built_bytes += nbytes
+            self.build_seconds += seconds
+
+    def plan(self, objs, jobs=1):
+        """
+        Choose which of objs to rebuild, and in what order. Indexes which save
+        the most bytes per second of building go first (greedy knapsack) until
+        the remaining time (for `jobs` workers) is used up. The rest are
+        deferred. Invalid indexes don't save anything, so they go last.
+        """
+        def value(obj):
+            return obj.get('wasted', 0) / max(self.estimate_seconds(obj), 1)
+
+        available = self.remaining() * jobs
+        chosen = []
+        for obj in sorted(objs, key=value, reverse=True):
+            estimate = self.estimate_seconds(obj)
+            if estimate <= available:
+                chosen.append(obj)
+                available -= estimate
+            else:
+                self.defer(obj, estimate)
+        return chosen
+
+    def fits(self, obj):
+        """Can this index be rebuilt in the time left? If not, it's deferred."""
+        estimate = self.estimate_seconds(obj)
+        if estimate > self.remaining():
+            self.defer(obj, estimate)
+            return False
+        return True
+
+    def defer(self, obj, estimate):
+        logger.info("Deferring index {} (estimated to take {}) because it would not finish in the {} left of the time budget".format(obj['name'], humanfriendly.format_timespan(estimate), humanfriendly.format_timespan(self.remaining())))
+        with self.lock:
+            self.deferred.append(obj)
+
+
+def tablespace_paths(cursor):
+    """
+    The directory of each tablespace, as seen on the database server.
+    Reading the data directory needs superuser (or pg_read_all_settings), if
+    that's not possible the built in tablespaces have no path (None).
+    """
+    try:
+        cursor.execute("SELECT current_setting('data_directory');")
+        data_directory = cursor.fetchone()[0]
+    except psycopg2.Error:
+        cursor.connection.rollback()
+        data_directory = None
+
+    cursor.execute("SELECT spcname, pg_tablespace_location(oid) FROM pg_tablespace;")
+    paths = {}
+    for name, location in cursor.fetchall():
+        if location:
+            paths[name] = location
+        elif data_directory and name == 'pg_default':
+            paths[name] = os.path.join(data_directory, "base")
+        elif data_directory and name == 'pg_global':
+            paths[name] = os.path.join(data_directory, "global")
+        else:
+            paths[name] = None
+    return paths
+
+
+class FreeSpace(object):
+    """
+    Checks that there is room for a new index in a tablespace before it's
+    built there. This reads the free disk space of the tablespace's directory,
+    so only works when running on the database server. Space for the builds
+    which are running is reserved, so parallel builds don't all count the same
+    free space. min_free is always left free.
+    """
+    def __init__(self, paths, min_free=0):
+        self.paths = paths
+        self.min_free = min_free
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    def _free(self, tablespace):
+        """(device, free bytes) for the tablespace, or None if we can't tell."""
+        path = self.paths.get(tablespace)
+        if path is None:
+            return None
+        try:
+            stat = os.statvfs(path)
+            device = os.stat(path).st_dev
+        except OSError:
+            return None
+        return device, stat.f_bavail * stat.f_frsize
+
+    def reserve(self, tablespaces, nbytes):
+        """
+        Returns the first of tablespaces with room for nbytes, and reserves
+        that space, or None if there's no room in any of them. Tablespaces
+        whose free space is unknown are assumed to have room.
+        """
+        with self.lock:
+            for tablespace in tablespaces:
+                free = self._free(tablespace)
+                if free is None:
+                    return tablespace
+                device, free_bytes = free
+                if free_bytes - self.reserved.get(device, 0) - self.min_free >= nbytes:
+                    self.reserved[device] = self.reserved.get(device, 0) + nbytes
+                    return tablespace
+        return None
+
+    def release(self, tablespace, nbytes):
+        """The build of nbytes in tablespace has finished (or failed)."""
+        with self.lock:
+            free = self._free(tablespace)
+            if free is not None:
+                device = free[0]
+                self.reserved[device] = max(0, self.reserved.get(device, 0) - nbytes)
+
+
+class BuildTuning(object):
+    """
+    --build-memory & --build-workers: set maintenance_work_mem and
+    max_parallel_maintenance_workers for each build, from the size of the new
+    index. The totals are split evenly between the builds which can run at
+    once (--jobs x --parallel-databases), so they're never overcommitted.
+    """
+    # Enough for small indexes, which don't need the server's default
+    MIN_MEMORY = 16 * 1024 * 1024
+    # PostgreSQL gives each process of a parallel build at least 32MB, or
+    # uses fewer workers
+    WORKER_MEMORY = 32 * 1024 * 1024
+    # Smaller indexes are built without parallel workers
+    MIN_PARALLEL_SIZE = 128 * 1024 * 1024
+
+    def __init__(self, memory=None, workers=None, concurrent_builds=1, server_version=0):
+        # maintenance_work_mem can't be less than 1MB
+        self.memory = None if memory is None else max(memory // concurrent_builds, 1024 * 1024)
+        # Parallel index builds are new in PostgreSQL 11
+        self.workers = None if workers is None or server_version < 110000 else workers // concurrent_builds
+
+    def settings(self, nbytes):
+        """The settings for building an index of about nbytes."""
+        settings = {}
+        memory = None
+        if self.memory is not None:
+            # Sorting the entries needs roughly twice the size of the index
+            memory = min(self.memory, max(self.MIN_MEMORY, 2 * nbytes))
+            settings['maintenance_work_mem'] = "{}kB".format(memory // 1024)
+        if self.workers is not None:
+            workers = 0
+            if nbytes >= self.MIN_PARALLEL_SIZE:
+                # One more worker each time the index doubles in size
+                workers = min(self.workers, int(math.log(nbytes / self.MIN_PARALLEL_SIZE, 2)) + 1)
+                if memory is not None:
+                    workers = min(workers, memory // self.WORKER_MEMORY - 1)
+            settings['max_parallel_maintenance_workers'] = max(0, workers)
+        return settings
+
+    @contextmanager
+    def apply(self, cursor, name, nbytes):
+        """During this context, the settings for building index name, of about nbytes, are used."""
+        settings = self.settings(nbytes)
+        if len(settings) > 0:
+            logger.info("Building {} with {}".format(name, ", ".join("{} = {}".format(k, v) for k, v in sorted(settings.items()))))
+        with ExitStack() as stack:
+            for setting, value in sorted(settings.items()):
+                stack.enter_context(postgres_setting(cursor, setting, value))
+            yield
+
+
+def is_local_connection(hostname):
+    """Is the database on this machine? (so we can look at its disks)"""
+    return hostname is None or hostname.startswith("/") or hostname in ("localhost", "127.0.0.1", "::1")
+
+
+class LoadThrottle(object):
+    """
+    Holds off rebuilding while the database is busy. Before each rebuild the
+    load is sampled, and if it's over any of the limits, we wait (backing off
+    exponentially, up to max_wait in total) for it to drop. With cancel, the
+    load is also sampled while the index is being built, and the build is
+    cancelled if the database stays overloaded.
+
+    The load is: the number of active queries (not counting our own), the
+    number of queries waiting for a lock, the rate of requested (rather than
+    timed) checkpoints per hour, the host's load average (only when running
+    on the database server), and how many bytes of WAL the furthest behind
+    replica (streaming or logical) still has to replay. A limit of None isn't
+    checked.
+
+    With max_wal_per_hour, the WAL written while building indexes is
+    counted, and an index isn't started until the WAL of the last hour, plus
+    about the size of the new index, is under the limit.
+    """
+    def __init__(self, max_active=None, max_lock_waits=None, max_checkpoints_per_hour=None, max_load_average=None, interval=10, max_wait=3600, cancel=False, max_replication_lag=None, max_wal_per_hour=None):
+        self.max_active = max_active
+        self.max_lock_waits = max_lock_waits
+        self.max_checkpoints_per_hour = max_checkpoints_per_hour
+        self.max_load_average = max_load_average
+        self.max_replication_lag = max_replication_lag
+        self.max_wal_per_hour = max_wal_per_hour
+        # (time, bytes) of the WAL written by each build
+        self.wal_written = []
+        self.interval = interval
+        self.max_wait = max_wait
+        self.cancel = cancel
+        self.last_checkpoints = None
+        self.lock = threading.Lock()
+
+    def sample(self, cursor):
+        """Returns a dict of the current load."""
+        if cursor.connection.server_version >= 100000:
+            cursor.execute("""SELECT
+                    count(*) FILTER (WHERE state = 'active') AS active,
+                    count(*) FILTER (WHERE state = 'active' AND wait_event_type = 'Lock') AS lock_waits
+                FROM pg_stat_activity
+                WHERE backend_type = 'client backend' AND pid <> pg_backend_pid() AND application_name <> 'pgindexrebuild';""")
+        else:
+            # Only client backends are listed, and there's no wait_event_type
+            # before 9.6
+            lock_waits = "wait_event_type = 'Lock'" if cursor.connection.server_version >= 90600 else "waiting"
+            cursor.execute("""SELECT
+                    count(*) FILTER (WHERE state = 'active') AS active,
+                    count(*) FILTER (WHERE state = 'active' AND {}) AS lock_waits
+                FROM pg_stat_activity
+                WHERE pid <> pg_backend_pid() AND application_name <> 'pgindexrebuild';""".format(lock_waits))
+        row = cursor.fetchone()
+        load = {'active': row[0], 'lock_waits': row[1]}
+
+        if self.max_checkpoints_per_hour is not None:
+            if cursor.connection.server_version >= 170000:
+                cursor.execute("SELECT num_requested FROM pg_stat_checkpointer;")
+            else:
+                cursor.execute("SELECT checkpoints_req FROM pg_stat_bgwriter;")
+            now, checkpoints = time.time(), cursor.fetchone()[0]
+            with self.lock:
+                if self.last_checkpoints is not None and now > self.last_checkpoints[0]:
+                    load['checkpoints_per_hour'] = (checkpoints - self.last_checkpoints[1]) * 3600 / (now - self.last_checkpoints[0])
+                self.last_checkpoints = (now, checkpoints)
+
+        if self.max_load_average is not None:
+            load['load_average'] = os.getloadavg()[0]
+
+        if self.max_replication_lag is not None:
+            # The lsn columns are NULL without the pg_read_all_stats role
+            if cursor.connection.server_version >= 100000:
+                cursor.execute("SELECT max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)) FROM pg_stat_replication WHERE NOT pg_is_in_recovery();")
+            else:
+                cursor.execute("SELECT max(pg_xlog_location_diff(pg_current_xlog_location(), replay_location)) FROM pg_stat_replication WHERE NOT pg_is_in_recovery();")
+            lag = cursor.fetchone()[0]
+            load['replication_lag'] = None if lag is None else int(lag)
+
+        return load
+
+    def overloaded(self, load):
+        """Returns why the load is too high, or None if it's OK."""
+        limits = [('active', self.max_active, "active queries"), ('lock_waits', self.max_lock_waits, "queries waiting for locks"), ('checkpoints_per_hour', self.max_checkpoints_per_hour, "requested checkpoints per hour"), ('load_average', self.max_load_average, "load average")]
+        for key, limit, desc in limits:
+            if limit is not None and load.get(key) is not None and load[key] > limit:
+                return "{:g} {} (limit {:g})".format(load[key], desc, limit)
+        if self.max_replication_lag is not None and load.get('replication_lag') is not None and load['replication_lag'] > self.max_replication_lag:
+            return "replication lag of {} (limit {})".format(format_size(load['replication_lag']), format_size(self.max_replication_lag))
+        return None
+
+    def wal_last_hour(self):
+        """Bytes of WAL written by the builds which finished in the last hour."""
+        cutoff = time.time() - 3600
+        with self.lock:
+            self.wal_written = [(t, nbytes) for t, nbytes in self.wal_written if t > cutoff]
+            return sum(nbytes for t, nbytes in self.wal_written)
+
+    def wal_over_limit(self, nbytes):
+        """Returns why building an index of about nbytes would write too much WAL, or None if it's OK."""
+        if self.max_wal_per_hour is None:
+            return None
+        written = self.wal_last_hour()
+        # An index bigger than the limit can go once nothing else has been written for an hour
+        if written > 0 and written + nbytes > self.max_wal_per_hour:
+            return "{} of WAL written in the last hour, and this needs about {} more (limit {} per hour)".format(format_size(written), format_size(nbytes), format_size(self.max_wal_per_hour))
+        return None
+
+    @contextmanager
+    def count_wal(self, cursor):
+        """Count the WAL written during this context, for max_wal_per_hour. That's all the WAL, not only ours, so it's an overestimate."""
+        if self.max_wal_per_hour is None:
+            yield
+            return
+        newer = cursor.connection.server_version >= 100000
+        cursor.execute("SELECT pg_current_wal_lsn();" if newer else "SELECT pg_current_xlog_location();")
+        start_lsn = cursor.fetchone()[0]
+        try:
+            yield
+        finally:
+            try:
+                cursor.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s);" if newer else "SELECT pg_xlog_location_diff(pg_current_xlog_location(), %s);", (start_lsn,))
+                nbytes = int(cursor.fetchone()[0])
+            except psycopg2.Error:
+                # e.g. the connection was lost. Don't hide the real error
+                pass
+            else:
+                with self.lock:
+                    self.wal_written.append((time.time(), nbytes))
+
+    def wait_until_ok(self, cursor, name, nbytes=0):
+        """
+        Wait until the load is OK to start rebuilding index name, whose new
+        index will be about nbytes. Returns False if it's still too high
+        after max_wait.
+        """
+        start = time.time()
+        pause = self.interval
+        while True:
+            reason = self.overloaded(self.sample(cursor)) or self.wal_over_limit(nbytes)
+            if reason is None:
+                return True
+            waited = time.time() - start
+            if waited >= self.max_wait:
+                logger.info("Database is still overloaded ({}) after waiting {}. Skipping index {}".format(reason, humanfriendly.format_timespan(waited), name))
+                return False
+            pause = min(pause, self.max_wait - waited)
+            logger.info("Database is overloaded ({}). Waiting {} before rebuilding {}".format(reason, humanfriendly.format_timespan(pause), name))
+            time.sleep(pause)
+            pause = min(pause * 2, 10 * self.interval)
+
+    @contextmanager
+    def watch(self, connect_args, pid, name):
+        """
+        While in this context, with cancel, keep sampling the load (on a
+        separate connection) and cancel the query of backend pid if the
+        database is overloaded twice in a row while it's building an index.
+        The yielded object's cancelled attribute is True if that happened.
+        """
+        watcher = threading.Event()
+        watcher.cancelled = False
+        if not self.cancel:
+            yield watcher
+            return
+
+        def run():
+            conn = None
+            overloaded_before = False
+            try:
+                conn = psycopg2.connect(**connect_args)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                while not watcher.wait(self.interval):
+                    reason = self.overloaded(self.sample(cursor))
+                    if reason is not None and overloaded_before:
+                        # Only cancel the index build itself, not e.g. the
+                        # swap or drop of the old index afterwards
+                        cursor.execute("SELECT pg_cancel_backend(pid) FROM pg_stat_activity WHERE pid = %s AND state = 'active' AND query ~* '^\\s*(CREATE|REINDEX)';", (pid,))
+                        if cursor.fetchone() is not None:
+                            logger.info("Database is overloaded ({}). Cancelling rebuild of {}".format(reason, name))
+                            watcher.cancelled = True
+                            break
+                    overloaded_before = reason is not None
+            except psycopg2.Error as e:
+                logger.warning("Stopped watching the load while {} is rebuilt, so it won't be cancelled if the database is overloaded: {!r}".format(name, e))
+            finally:
+                if conn is not None:
+                    conn.close()
+
+        thread = threading.Thread(target=run, name=threading.current_thread().name + "-watch")
+        thread.start()
+        try:
+            yield watcher
+        finally:
+            watcher.set()
+            thread.join()
+
+
+class LockRetry(object):
+    """
+    Runs the quick statements which need a strong lock on the table (renaming
+    and dropping indexes, swapping constraints) with a short lock_timeout.
+    Waiting for such a lock blocks every other query on the table, so rather
+    than wait a long time, give up quickly, back off for a random,
+    exponentially growing, time, and try again, up to `attempts` times.
+    """
+    def __init__(self, timeout, attempts, max_backoff):
+        self.timeout = timeout
+        self.attempts = attempts
+        self.max_backoff = max_backoff
+        # Seconds spent waiting for locks (including backing off)
+        self.total = 0.0
+        self.by_database = {}
+        self.retries_by_database = {}
+        self.lock = threading.Lock()
+        self.metrics = None
+
+    def add(self, seconds, database=None, retries=0):
+        with self.lock:
+            self.total += seconds
+            if database is not None:
+                self.by_database[database] = self.by_database.get(database, 0) + seconds
+                self.retries_by_database[database] = self.retries_by_database.get(database, 0) + retries
+
+    def execute(self, cursor, sql, database=None, kind=None):
+        """
+        Run sql. Returns True if it was run, False if we gave up waiting for
+        the lock. The time the successful attempt took (roughly how long the
+        lock was held) is sent as a metrics event, with kind (e.g. 'rename').
+        """
+        start_time = time.time()
+        attempt = 1
+        try:
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    attempt_start = time.time()
+                    with postgres_setting(cursor, 'lock_timeout', int(self.timeout * 1000)):
+                        cursor.execute(sql)
+                    if self.metrics is not None:
+                        self.metrics.event('lock', database=database, kind=kind, duration=time.time() - attempt_start, attempts=attempt)
+                    return True
+                except psycopg2.OperationalError as e:
+                    if e.pgcode != psycopg2.errorcodes.LOCK_NOT_AVAILABLE:
+                        raise
+                if attempt < self.attempts:
+                    delay = backoff_delay(attempt, self.timeout, self.max_backoff)
+                    logger.debug("Could not get the lock for {!r} within {}. That was attempt {} of {}. Waiting {:.1f} sec".format(sql, humanfriendly.format_timespan(self.timeout), attempt, self.attempts, delay))
+                    time.sleep(delay)
+            logger.error("Could not get the lock for {!r} after {} attempts ({})".format(sql, self.attempts, humanfriendly.format_timespan(time.time() - start_time)))
+            return False
+        finally:
+            self.add(time.time() - start_time, database, attempt - 1)
+
+
+def prometheus_labels(**labels):
+    """Format labels for the Prometheus text format, e.g. {database="foo"}"""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join('{}="{}"'.format(key, escape(value)) for key, value in sorted(labels.items())) + "}"
+
+
+class Metrics(object):
+    """
+    Counters (per database), and how long each phase of a rebuild takes (as
+    histograms), for monitoring. Written as a Prometheus textfile (e.g. for
+    node_exporter's textfile collector), which is replaced after every index,
+    and/or as a stream of JSON lines, one per event.
+    """
+    # Histogram buckets for the phase durations, in seconds
+    BUCKETS = (0.1, 1, 10, 60, 300, 1800, 3600, 4 * 3600, 12 * 3600)
+
+    # counter -> (metric name, help)
+    COUNTERS = {
+        'rebuilt': ("indexes_rebuilt_total", "Indexes rebuilt"),
+        'failures': ("indexes_failed_total", "Indexes which could not be rebuilt"),
+        'retries': ("build_retries_total", "Index builds which were retried"),
+    }
+
+    def __init__(self, textfile=None, json_stream=None):
+        self.textfile = textfile
+        self.json_stream = json_stream
+        # (name, database) -> count
+        self.counters = {}
+        # (database, phase) -> [count per bucket..., sum, count]
+        self.phases = {}
+        # (database, index) -> fraction of the current build phase done
+        self.progress = {}
+        self.lock = threading.Lock()
+        # Held while replacing the textfile, since every --jobs thread writes it
+        self.write_lock = threading.Lock()
+
+    def event(self, event, **fields):
+        """Write one JSON line to the json stream."""
+        if self.json_stream is None:
+            return
+        fields.update(time=time.time(), event=event)
+        with self.lock:
+            self.json_stream.write(json.dumps(fields, sort_keys=True) + "\n")
+            self.json_stream.flush()
+
+    def inc(self, name, database, value=1):
+        with self.lock:
+            self.counters[(name, database)] = self.counters.get((name, database), 0) + value
+
+    def observe_phase(self, database, index, phase, seconds):
+        with self.lock:
+            histogram = self.phases.setdefault((database, phase), [0] * (len(self.BUCKETS) + 2))
+            for i, bucket in enumerate(self.BUCKETS):
+                if seconds <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        self.event('phase', database=database, index=index, phase=phase, duration=seconds)
+
+    def set_progress(self, database, index, fraction):
+        """fraction of None means the index isn't being built anymore."""
+        with self.lock:
+            if fraction is None:
+                self.progress.pop((database, index), None)
+            else:
+                self.progress[(database, index)] = fraction
+
+    def prometheus(self, run):
+        """The metrics in the Prometheus text format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP pgindexrebuild_{} {}".format(name, help_text))
+            lines.append("# TYPE pgindexrebuild_{} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("pgindexrebuild_{}{} {}".format(name, prometheus_labels(**labels), value))
+
+        with self.lock:
+            for name, (metric_name, help_text) in sorted(self.COUNTERS.items()):
+                metric(metric_name, 'counter', help_text, [({'database': database}, value) for (counter, database), value in sorted(self.counters.items()) if counter == name])
+            metric("bytes_reclaimed_total", 'counter', "Bytes of disk space saved",
+                   [({'database': database}, value) for database, value in sorted(run.savings_counter.by_database.items()) if database is not None])
+            if run.lock_retry is not None:
+                metric("lock_wait_seconds_total", 'counter', "Seconds spent waiting for locks, including backing off",
+                       [({'database': database}, value) for database, value in sorted(run.lock_retry.by_database.items())])
+                metric("lock_retries_total", 'counter', "Statements retried because the lock wasn't granted in time",
+                       [({'database': database}, value) for database, value in sorted(run.lock_retry.retries_by_database.items())])
+
+            samples = []
+            for (database, phase), histogram in sorted(self.phases.items()):
+                for i, bucket in enumerate(self.BUCKETS):
+                    samples.append(({'database': database, 'phase': phase, 'le': bucket}, histogram[i]))
+                samples.append(({'database': database, 'phase': phase, 'le': '+Inf'}, histogram[-1]))
+            lines.append("# HELP pgindexrebuild_phase_duration_seconds How long each phase of rebuilding an index took")
+            lines.append("# TYPE pgindexrebuild_phase_duration_seconds histogram")
+            for labels, value in samples:
+                lines.append("pgindexrebuild_phase_duration_seconds_bucket{} {}".format(prometheus_labels(**labels), value))
+            for (database, phase), histogram in sorted(self.phases.items()):
+                lines.append("pgindexrebuild_phase_duration_seconds_sum{} {}".format(prometheus_labels(database=database, phase=phase), histogram[-2]))
+                lines.append("pgindexrebuild_phase_duration_seconds_count{} {}".format(prometheus_labels(database=database, phase=phase), histogram[-1]))
+
+            metric("build_progress_ratio", 'gauge', "How much of the current phase of an index build is done",
+                   [({'database': database, 'index': index}, value) for (database, index), value in sorted(self.progress.items())])
+            metric("last_update_timestamp_seconds", 'gauge', "When these metrics were written", [({}, time.time())])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, run):
+        """Replace the textfile, atomically, so it's never scraped half written."""
+        if self.textfile is None:
+            return
+        tmp_path = "{}.{}.tmp".format(self.textfile, os.getpid())
+        with self.write_lock:
+            with open(tmp_path, 'w') as fp:
+                fp.write(self.prometheus(run))
+            os.replace(tmp_path, self.textfile)
+
+
+class ProgressMonitor(object):
+    """
+    While an index is being built, polls pg_stat_progress_create_index
+    (PostgreSQL 12+) on a separate connection, and logs the phase, how much
+    of it is done, and an ETA for the phase.
+    """
+    SQL = "SELECT phase, blocks_total, blocks_done, tuples_total, tuples_done FROM pg_stat_progress_create_index WHERE pid = %s;"
+
+    def __init__(self, interval, metrics=None):
+        self.interval = interval
+        self.metrics = metrics
+
+    @contextmanager
+    def watch(self, connect_args, pid, database, name):
+        if not self.interval:
+            yield
+            return
+        stop = threading.Event()
+
+        def run():
+            conn = None
+            phase, phase_start = None, None
+            last_poll = time.time()
+            try:
+                while not stop.wait(self.interval):
+                    if conn is None:
+                        # Only connect once the build has taken a while, so
+                        # small indexes don't need another connection
+                        conn = psycopg2.connect(**connect_args)
+                        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                        cursor = conn.cursor()
+                    cursor.execute(self.SQL, (pid,))
+                    row = cursor.fetchone()
+                    now = time.time()
+                    if row is None:
+                        last_poll = now
+                        continue
+                    row_phase, blocks_total, blocks_done, tuples_total, tuples_done = row
+                    if blocks_total > 0:
+                        unit, total, done = 'blocks', blocks_total, blocks_done
+                    else:
+                        unit, total, done = 'tuples', tuples_total, tuples_done
+                    if row_phase != phase:
+                        # The phase started sometime since the last poll
+                        phase, phase_start = row_phase, (last_poll, 0)
+                    last_poll = now
+
+                    message = "Building {}: {}".format(name, phase)
+                    fraction = None
+                    eta = None
+                    if total > 0:
+                        fraction = float(done) / total
+                        message += ", {:,} of {:,} {} ({:.0%})".format(done, total, unit, fraction)
+                        start, start_done = phase_start
+                        if done > start_done and now > start:
+                            eta = (total - done) * (now - start) / (done - start_done)
+                            message += ", ETA {}".format(humanfriendly.format_timespan(eta))
+                    logger.info(message)
+                    if self.metrics is not None:
+                        self.metrics.set_progress(database, name, fraction)
+                        self.metrics.event('progress', database=database, index=name, phase=phase, unit=unit, total=total, done=done, eta=eta)
+            except psycopg2.Error as e:
+                logger.debug("Stopped monitoring the progress of {}: {!r}".format(name, e))
+            finally:
+                if conn is not None:
+                    conn.close()
+                if self.metrics is not None:
+                    self.metrics.set_progress(database, name, None)
+
+        thread = threading.Thread(target=run, name=threading.current_thread().name + "-progress")
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+class SavingsCounter(object):
+    """Thread safe running total of the space saved."""
+    def __init__(self):
+        self.total = 0
+        self.by_database = {}
+        self.lock = threading.Lock()
+
+    def add(self, savings, oldsize, database=None):
+        with self.lock:
+            self.total += savings
+            self.by_database[database] = self.by_database.get(database, 0) + savings
+            logger.info("Saved {} {:.0%} - Total savings so far: {}".format(format_size(savings), savings/oldsize, format_size(self.total)))
+
+
+def group_by_table(objs):
+    """
+    objs, reordered so each table's indexes are rebuilt back to back, while
+    its heap is still cached. The tables are in the order of their first
+    index.
+    """
+    groups = {}
+    for obj in objs:
+        groups.setdefault((obj['schemaname'], obj['table']), []).append(obj)
+    return [obj for group in groups.values() for obj in group]
+
+
+def heap_io(cursor, table_oids):
+    """The heap blocks of these tables read from disk, and found in shared buffers, so far (from pg_statio_user_tables)."""
+    cursor.execute("SELECT coalesce(sum(heap_blks_read), 0), coalesce(sum(heap_blks_hit), 0) FROM pg_statio_user_tables WHERE relid = ANY(%s);", (list(table_oids),))
+    read, hit = cursor.fetchone()
+    return int(read), int(hit)
+
+
+def prewarm_table(cursor, db, obj, old_entry):
+    """
+    --prewarm: load the heap of the index's table into shared buffers with
+    pg_prewarm, before its first index is built. Only if it's at most half
+    of shared_buffers, otherwise it would just be evicted again.
+    """
+    table_oid = old_entry['table_oid']
+    with db.lock:
+        if table_oid in db.prewarmed:
+            return
+        db.prewarmed.add(table_oid)
+    cursor.execute("SELECT pg_relation_size(%s), pg_size_bytes(current_setting('shared_buffers'));", (table_oid,))
+    size, shared_buffers = cursor.fetchone()
+    if size > shared_buffers / 2:
+        logger.info("Not prewarming table {} ({}), it's more than half of shared_buffers".format(old_entry['table'], format_size(size)))
+        return
+    with db.phase(obj['name'], 'prewarm'), log_duration("prewarming table {} ({})".format(old_entry['table'], format_size(size))):
+        cursor.execute("SELECT pg_prewarm(%s::oid::regclass);", (table_oid,))
+
+
+class TableScheduler(object):
+    """
+    Hands out indexes to worker threads, in order, but never 2 indexes on the
+    same table at the same time. Concurrent index builds on one table wait for
+    each other, so there's no point running them in parallel.
+    """
+    def __init__(self, objs):
+        self.pending = list(objs)
+        self.busy_tables = set()
+        self.cond = threading.Condition()
+
+    def next(self):
+        """Returns the next index to work on, or None when there is nothing left to do."""
+        with self.cond:
+            while True:
+                if len(self.pending) == 0:
+                    return None
+                for i, obj in enumerate(self.pending):
+                    table = (obj['schemaname'], obj['table'])
+                    if table not in self.busy_tables:
+                        self.busy_tables.add(table)
+                        return self.pending.pop(i)
+                # Every remaining index is on a table which is being worked on
+                self.cond.wait()
+
+    def done(self, obj):
+        with self.cond:
+            self.busy_tables.discard((obj['schemaname'], obj['table']))
+            self.cond.notify_all()
+
+    def abort(self):
+        """Don't hand out any more work."""
+        with self.cond:
+            self.pending = []
+            self.cond.notify_all()
+
+
+def get_all_databases(cursor, order):
+    """
+    Names of all the (non-template) databases. order is 'size' (smallest
+    first, so small databases don't wait behind huge ones), 'size-desc'
+    (largest first), or 'name'. Databases which can't be connected to have
+    no size, and are last.
+    """
+    if order == 'name':
+        cursor.execute("SELECT datname from pg_database where datistemplate = false order by datname")
+    else:
+        # pg_database_size() needs the CONNECT privilege
+        cursor.execute("SELECT datname from pg_database where datistemplate = false order by CASE WHEN has_database_privilege(oid, 'CONNECT') THEN pg_database_size(oid) END {} NULLS LAST, datname".format("DESC" if order == 'size-desc' else "ASC"))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def connect(connect_args):
+    conn = psycopg2.connect(**connect_args)
+
+    # Need this transaction isolation level for CREATE INDEX CONCURRENTLY
+    # cf. http://stackoverflow.com/questions/3413646/postgres-raises-a-active-sql-transaction-errcode-25001
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+def connect_database(connect_args, tablespace, conn=None):
+    """Connect to a database (or reuse conn) and return a cursor ready to rebuild indexes."""
+    if conn is None:
+        conn = connect(connect_args)
+
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cursor.execute("SET default_tablespace = %s;", (tablespace,))
+
+    return conn, cursor
+
+
+def rebuild_indexes_parallel(db, objs):
+    """
+    Rebuild objs using args.jobs worker connections at once. If any worker
+    fails, no more indexes are started, and the error is raised once the
+    other workers have finished their current index.
+    """
+    scheduler = TableScheduler(objs)
+    errors = []
+
+    def worker():
+        try:
+            conn, cursor = db.run.connect_database(db.name, db.run.tablespace)
+        except psycopg2.OperationalError as ex:
+            errors.append(ex)
+            scheduler.abort()
+            return
+
+        try:
+            while True:
+                obj = scheduler.next()
+                if obj is None:
+                    break
+                try:
+                    rebuild_index(cursor, obj, db)
+                except Exception as ex:
+                    errors.append(ex)
+                    scheduler.abort()
+                finally:
+                    scheduler.done(obj)
+        finally:
+            db.run.release_connection(db.name, conn)
+
+    threads = [threading.Thread(target=worker, name="{}-{}".format(db.name, i)) for i in range(db.run.args.jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def rebuild_indexes(cursor, db, objs):
+    if db.run.args.jobs > 1:
+        rebuild_indexes_parallel(db, objs)
+    else:
+        for obj in objs:
+            rebuild_index(cursor, obj, db)
+
+
+def process_database(database, run):
+    """Find and rebuild the bloated (and maybe invalid) indexes in one database."""
+    with log_duration("processing database {}".format(database)):
+        _process_database(database, run)
+
+
+def process_database_in_thread(database, run):
+    """Used with --parallel-databases. Names the thread after the database, so the log lines can be told apart."""
+    threading.current_thread().name = database
+    process_database(database, run)
+
+
+def choose_indexes(cursor, db):
+    """
+    Estimate the bloat in the database db (a DatabaseRun), and choose which
+    indexes to rebuild. Returns None if there's nothing to do. With
+    --plan-out, the indexes which are skipped are added to the plan (with the
+    reason).
+    """
+    run = db.run
+    database = db.name
+    snapshot = db.snapshot
+    args = run.args
+    def skip(obj, reason):
+        if run.plan is not None:
+            run.plan.add(database, obj, snapshot.get(obj['schemaname'], obj['name']), skip_reason=reason)
+
+    # --skip-unchanged needs the most bloat left in any index, even those
+    # under --min-bloat, and the plan lists every index, so then get them all
+    fetch_all = run.change_tracker is not None or run.plan is not None
+    start_time = time.time()
+    with log_duration("calculating index sizes"):
+        objs = indexsizes(cursor, run.estimator, min_bloat=-1 if fetch_all else args.min_bloat, table_cache=run.table_cache)
+    if run.metrics is not None:
+        run.metrics.event('estimate', database=database, indexes=len(objs), duration=time.time() - start_time)
+    bloated = [obj for obj in objs if obj['wasted'] > args.min_bloat]
+
+    db.observed = bloated
+    if run.history is not None:
+        if not run.daemon:
+            run.history.record_observations(database, bloated)
+        writes = table_writes(cursor)
+
+    if args.repair_invalid:
+        with log_duration("calculating invalid indexes"):
+            invalid_indexes = calculate_invalid_indexes(cursor)
+    else:
+        invalid_indexes = []
+
+
+    if len(bloated) == 0 and len(invalid_indexes) == 0:
+        logger.info("No bloated or invalid indexes found for database {}. Either you have no permission to read them, or there is no index bloat or invalid indexes in this database.".format(database))
+        db.bloat_left = max([db.bloat_left] + [obj['wasted'] for obj in objs])
+        for obj in objs:
+            skip(obj, "no bloat" if obj['wasted'] == 0 else "less than min bloat")
+        return None
+
+    total_used = sum(Decimal(x['size']) for x in bloated)
+    total_wasted = sum(Decimal(x['wasted']) for x in bloated)
+    percent_wasted = "N/A" if total_used == 0 else "{:.0%}".format(float(total_wasted)/float(total_used))
+    logger.info("DB {}: Used space: {} Wasted space: {} {} wasted space".format(database, format_size(total_used), format_size(total_wasted), percent_wasted))
+    logger.info("DB {}: {} invalid index(es): {}".format(database, len(invalid_indexes), ", ".join(x['name'] for x in invalid_indexes)))
+
+
+    min_bloat = args.min_bloat
+    logger.info("Ignoring all tables with a bloat less than {}".format(format_size(min_bloat)))
+
+    to_rebuild = []
+    for obj in objs+invalid_indexes:
+        if args.exclude_index is not None and ( (obj['name'] in args.exclude_index) or (database+"."+obj['name'] in args.exclude_index) ):
+            logger.info("Skipping index {} because it has been excluded".format(obj['name']))
+            skip(obj, "excluded")
+            continue
+
+        if not obj['invalid_index']:
+            # This is a bloated index
+            if obj['wasted'] == 0:
+                logger.info("Skipping Index {name} size {size} wasted {wasted}".format(name=obj['name'], size=format_size(obj['size']), wasted=format_size(obj['wasted'])))
+                skip(obj, "no bloat")
+                continue
+            if obj['wasted'] <= min_bloat:
+                logger.info("Skipping Index {name} size {size} wasted {wasted} which is less than min bloat {min_bloat}".format(name=obj['name'], size=format_size(obj['size']), wasted=format_size(obj['wasted']), min_bloat=format_size(min_bloat)))
+                skip(obj, "less than min bloat")
+                db.bloat_left = max(db.bloat_left, obj['wasted'])
+                continue
+
+            reason = skip_from_history(run.history, database, obj, args, writes.get(obj.get('table_oid'))) if run.history is not None else None
+            if reason is not None:
+                skip(obj, reason)
+                db.bloat_left = max(db.bloat_left, obj['wasted'])
+                continue
+
+        entry = snapshot.get(obj['schemaname'], obj['name'])
+        reason = None
+        if entry is None:
+            pass
+        elif entry['contype'] == 'x' and args.concurrent:
+            reason = "it has an exclusion constraint, which can't be rebuilt concurrently (see --no-concurrent)"
+        elif entry['parent_index'] is not None and args.engine == 'legacy' and args.concurrent and run.server_version < 120000:
+            reason = "it's attached to the partitioned index {}, so can only be rebuilt with REINDEX, which can't be done concurrently before PostgreSQL 12 (see --no-concurrent)".format(entry['parent_index'])
+        elif args.engine == 'legacy' and entry['referenced_by_fk'] and entry['parent_index'] is None:
+            # The foreign keys would have to be dropped to drop the old index
+            reason = "foreign keys depend on it (see --engine reindex)"
+        elif args.always_drop_first and not can_drop_first(obj, entry):
+            reason = "it is unique, or has a constraint, so can't be dropped first"
+        if reason is not None:
+            logger.info("Skipping Index {} size {} wasted {} because {}".format(obj['name'], format_size(obj.get('size', 0)), format_size(obj.get('wasted', 0)), reason))
+            skip(obj, reason)
+            continue
+
+        to_rebuild.append(obj)
+
+    return to_rebuild
+
+
+def prepare_database(database, run):
+    """
+    Connect to database, load its catalog, and choose the indexes to rebuild.
+    Returns the connection, cursor, DatabaseRun and the indexes, or None if
+    it can't be connected to, or was skipped by --skip-unchanged.
+    """
+    args = run.args
+    try:
+        conn, cursor = run.connect_database(database, run.tablespace)
+    except psycopg2.OperationalError as ex:
+        logger.error("Unable to connect to database {}. Error: {!r}".format(database, ex))
+        return None
+
+    logger.info("Connected to database {}{}".format(database, (" as user {}".format(args.user) if args.user else " as unspecified user")))
+
+    # A quick check, before loading the catalog and estimating the bloat
+    counters = None
+    if run.change_tracker is not None and run.plan_to_apply is None:
+        counters = run.change_tracker.counters(cursor)
+        reason = run.change_tracker.unchanged(database, counters, args.min_bloat, args.repair_invalid)
+        if reason is not None:
+            logger.info("DB {}: Skipping, only {}".format(database, reason))
+            run.release_connection(database, conn)
+            return None
+
+    # what's the default tablespace for this database?
+    cursor.execute("select t.spcname from pg_database d join pg_tablespace t ON t.oid = d.dattablespace where datname = %s;", (database,))
+    database_tablespace = cursor.fetchone()[0]
+    logger.info("Default tablespace for database {} is {}".format(database, database_tablespace))
+
+    with log_duration("loading catalog snapshot"):
+        snapshot = CatalogSnapshot()
+        snapshot.load(cursor)
+
+    if args.engine == 'reindex':
+        drop_reindex_leftovers(cursor, snapshot, args.dry_run, run.lock_retry, database)
+
+    db = DatabaseRun(run, database, database_tablespace, snapshot)
+    db.counters = counters
+    if args.prewarm and run.plan is None:
+        db.prewarm = has_extension(cursor, 'pg_prewarm')
+        if not db.prewarm:
+            logger.info("DB {}: The pg_prewarm extension isn't installed, so tables won't be prewarmed".format(database))
+    if run.plan_to_apply is not None:
+        to_rebuild = run.plan_to_apply.to_rebuild(database, snapshot, args.exclude_index)
+        logger.info("DB {}: Rebuilding {} index(es) from the plan".format(database, len(to_rebuild)))
+    else:
+        to_rebuild = choose_indexes(cursor, db) or []
+
+    if run.history is not None:
+        for obj in to_rebuild:
+            obj['past_build_rate'] = run.history.build_rate(database, obj['schemaname'], obj['name'])
+
+    return conn, cursor, db, to_rebuild
+
+
+def record_changes(db, candidates):
+    """--skip-unchanged: remember how much bloat is left in db, after rebuilding (some of) candidates."""
+    if db.counters is None or db.run.args.dry_run:
+        return
+    # Indexes which weren't rebuilt (deferred, or failed) still have their bloat
+    bloat_left = max([db.bloat_left] + [obj.get('wasted', 0) for obj in candidates if (obj['schemaname'], obj['name']) not in db.rebuilt])
+    db.run.change_tracker.record(db.name, db.counters, bloat_left)
+
+
+def _process_database(database, run):
+    args = run.args
+    prepared = prepare_database(database, run)
+    if prepared is None:
+        return
+    conn, cursor, db, to_rebuild = prepared
+    if len(to_rebuild) == 0:
+        record_changes(db, to_rebuild)
+        run.release_connection(database, conn)
+        return
+    candidates = to_rebuild
+
+    if run.budget is not None:
+        chosen = run.budget.plan(to_rebuild, args.jobs)
+        logger.info("{} left of the time budget. Planning to rebuild {} index(es) in this order: {}".format(humanfriendly.format_timespan(run.budget.remaining()), len(chosen), ", ".join(x['name'] for x in chosen)))
+        if run.plan is not None:
+            for obj in to_rebuild:
+                if not any(obj is x for x in chosen):
+                    run.plan.add(database, obj, db.snapshot.get(obj['schemaname'], obj['name']), skip_reason="time budget")
+        to_rebuild = chosen
+
+    if args.rebuild_order == 'table':
+        to_rebuild = group_by_table(to_rebuild)
+
+    if run.plan is not None:
+        add_to_plan(cursor, db, to_rebuild)
+        run.release_connection(database, conn)
+        return
+
+    # How much of the heap the builds read from disk
+    table_oids = set(entry['table_oid'] for entry in (db.snapshot.get(obj['schemaname'], obj['name']) for obj in to_rebuild) if entry is not None)
+    if not args.dry_run:
+        io_before = heap_io(cursor, table_oids)
+
+    rebuild_indexes(cursor, db, to_rebuild)
+
+    if len(db.deferred_for_space) > 0:
+        logger.info("Trying again to rebuild {} index(es) which there was not enough free space for: {}".format(len(db.deferred_for_space), ", ".join(x['name'] for x in db.deferred_for_space)))
+        db.final_pass = True
+        rebuild_indexes(cursor, db, db.deferred_for_space)
+
+    if not args.dry_run:
+        read, hit = (after - before for after, before in zip(heap_io(cursor, table_oids), io_before))
+        logger.info("DB {}: Heap blocks of the rebuilt indexes' tables: {:,} read from disk, {:,} found in shared buffers ({} hit rate)".format(database, read, hit, "N/A" if read + hit == 0 else "{:.0%}".format(hit / (read + hit))))
+        if run.metrics is not None:
+            run.metrics.event('heap_io', database=database, read=read, hit=hit)
+
+    record_changes(db, candidates)
+    run.release_connection(database, conn)
+
+
+def parse_window(value):
+    """argparse type for --window HH:MM-HH:MM. Returns the start & end, in minutes after midnight."""
+    match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', value)
+    if match is None:
+        raise argparse.ArgumentTypeError("{!r} is not a time window like 01:00-05:30".format(value))
+    start_hour, start_minute, end_hour, end_minute = (int(x) for x in match.groups())
+    if start_hour > 24 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+        raise argparse.ArgumentTypeError("{!r} is not a time window like 01:00-05:30".format(value))
+    return (start_hour * 60 + start_minute, end_hour * 60 + end_minute)
+
+
+def in_window(windows, now=None):
+    """Whether now (default: the current local time) is in one of the windows. Always true without any windows."""
+    if not windows:
+        return True
+    now = time.localtime(now)
+    minute = now.tm_hour * 60 + now.tm_min
+    for start, end in windows:
+        if start <= end:
+            if start <= minute < end:
+                return True
+        elif minute >= start or minute < end:
+            # Overnight, e.g. 22:00-04:00
+            return True
+    return False
+
+
+class RebuildQueue(object):
+    """
+    The daemon's indexes to rebuild, from all databases, most wasted space
+    first. Each time a database is estimated again, its indexes replace the
+    ones from the last estimate.
+    """
+    def __init__(self):
+        self.heap = []
+        # Keeps the order stable for indexes with the same waste
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def replace(self, database, objs):
+        self.heap = [item for item in self.heap if item[2] != database]
+        for obj in objs:
+            self.sequence += 1
+            self.heap.append((-int(obj.get('wasted', 0)), self.sequence, database, obj))
+        heapq.heapify(self.heap)
+
+    def queued(self, database):
+        """How many of database's indexes are still queued."""
+        return sum(1 for item in self.heap if item[2] == database)
+
+    def pop(self):
+        """The database & index to rebuild next."""
+        _, _, database, obj = heapq.heappop(self.heap)
+        return database, obj
+
+
+def daemon_estimate(run, database, queue, dbs):
+    """Estimate the bloat in database again, and queue the indexes to rebuild."""
+    try:
+        with log_duration("estimating database {}".format(database)):
+            prepared = prepare_database(database, run)
+    except psycopg2.Error as ex:
+        logger.error("DB {}: Could not estimate the bloat: {!r}".format(database, ex))
+        # The connection may be broken. Start afresh next time
+        run.close_spare_connections(database)
+        return
+    if prepared is None:
+        # Keep what was queued from the last estimate
+        return
+    conn, cursor, db, to_rebuild = prepared
+    run.release_connection(database, conn)
+
+    # Indexes there isn't space for are skipped, and found again next time
+    db.final_pass = True
+    db.candidates = to_rebuild
+    dbs[database] = db
+    queue.replace(database, to_rebuild)
+    if len(to_rebuild) == 0:
+        daemon_finish(run, db)
+
+
+def daemon_finish(run, db):
+    """
+    All the indexes queued for db have been rebuilt (or failed): record what
+    its estimate saw in the history, and the bloat left for --skip-unchanged.
+    """
+    if run.history is not None:
+        run.history.record_observations(db.name, db.observed)
+    if run.change_tracker is not None:
+        record_changes(db, db.candidates)
+        if not run.args.dry_run:
+            run.change_tracker.save()
+
+
+def daemon_rebuild(run, db, obj):
+    try:
+        conn, cursor = run.connect_database(db.name, run.tablespace)
+    except psycopg2.OperationalError as ex:
+        logger.error("Unable to connect to database {}. Error: {!r}".format(db.name, ex))
+        return
+    try:
+        # It may have changed since it was estimated
+        db.snapshot.refresh(cursor, obj['schemaname'], [obj['name']])
+        rebuild_index(cursor, obj, db)
+    except psycopg2.Error as ex:
+        logger.error("DB {}: Rebuilding {} failed: {!r}".format(db.name, obj['name'], ex))
+        conn.close()
+        run.close_spare_connections(db.name)
+        return
+    run.release_connection(db.name, conn)
+
+
+def run_daemon(run, databases):
+    """
+    pgindexrebuild daemon: estimate the bloat in every database every
+    --estimate-interval, and rebuild the queued indexes, one at a time, while
+    inside a --window. Connections are kept open between estimates and
+    rebuilds. Runs until SIGTERM or SIGINT, finishing the current index first.
+    """
+    args = run.args
+    run.keep_connections = True
+    run.daemon = True
+    queue = RebuildQueue()
+    dbs = {}
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info("Received signal {}. Stopping after the current index".format(signum))
+        stop.set()
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    logger.info("Running as a daemon. Estimating the bloat every {}{}".format(humanfriendly.format_timespan(args.estimate_interval), ", rebuilding in the windows {}".format(", ".join("{:02d}:{:02d}-{:02d}:{:02d}".format(start // 60, start % 60, end // 60, end % 60) for start, end in args.window)) if args.window else ""))
+    next_estimate = time.time()
+    while not stop.is_set():
+        if time.time() >= next_estimate:
+            if args.all_databases:
+                # Notice new & dropped databases
+                try:
+                    conn, cursor = run.connect_database('postgres', run.tablespace)
+                    databases = get_all_databases(cursor, args.database_order)
+                    run.release_connection('postgres', conn)
+                except psycopg2.Error as ex:
+                    logger.error("Could not list the databases: {!r}".format(ex))
+                    run.close_spare_connections('postgres')
+                for database in list(dbs):
+                    if database not in databases:
+                        queue.replace(database, [])
+                        del dbs[database]
+                        run.close_spare_connections(database)
+            for database in databases:
+                if stop.is_set():
+                    break
+                daemon_estimate(run, database, queue, dbs)
+            if run.estimator is not None:
+                run.estimator.save()
+            if run.table_cache is not None:
+                run.table_cache.save()
+            next_estimate = time.time() + args.estimate_interval
+            logger.info("{} index(es) queued to rebuild. Estimating again in {}".format(len(queue), humanfriendly.format_timespan(args.estimate_interval)))
+        elif len(queue) > 0 and in_window(args.window):
+            database, obj = queue.pop()
+            daemon_rebuild(run, dbs[database], obj)
+            if queue.queued(database) == 0:
+                daemon_finish(run, dbs[database])
+        else:
+            stop.wait(max(0, min(60, next_estimate - time.time())))
+
+    run.close_spare_connections()
+
+
 def main():
-    parser = argparse.ArgumentParser(prog="pgindexrebuild")
-    parser.add_argument("-v", "--version", action="version", version="%(prog)s {}".format(version()))
+    parser = argparse.ArgumentParser(prog="pgindexrebuild", usage="%(prog)s [daemon] [options]", epilog="With daemon, keep running: estimate the bloat every --estimate-interval, and rebuild the most bloated indexes while in a --window")
+    parser.add_argument("-v", "--version", action=VersionAction)
     parser.add_argument('--hostname', type=str, help="PostgreSQL hostname")
     parser.add_argument('-d', '--database', type=str, help="PostgreSQL database name")
     parser.add_argument('-a', '--all-databases', action="store_true", help="Run on all databases")
@@ -216,24 +3141,120 @@ def main():
     parser.add_argument('--no-concurrent', action="store_false", dest="concurrent", help="Don't building CONCURRENTLY")
 
 
-    parser.add_argument("--tablespaces", required=False, metavar="TABLESPACE,TABLESPACE,", help="Comma separated list of tablespaces to use. The first tablespace which exists will be used. Without this and the default pg_default will be used", default="pg_default");
+    parser.add_argument("--tablespaces", required=False, metavar="TABLESPACE,TABLESPACE,", help="Comma separated list of tablespaces to use. For each index, the first tablespace which exists and has enough free space will be used. Without this and the default pg_default will be used", default="pg_default");
+
+    parser.add_argument("--free-space-check", action="store_true", dest="free_space_check", default=True, help="Before building an index, check there is enough free disk space for it, when running on the database server (default)")
+    parser.add_argument("--no-free-space-check", action="store_false", dest="free_space_check", help="Don't check free disk space")
+    parser.add_argument("--min-free-space", type=humanfriendly.parse_size, default=0, metavar="SIZE", help="Always leave at least this much disk space free (default: 0)")
+    parser.add_argument("--drop-first-if-no-space", action="store_true", help="If there isn't enough space to build an index, even after rebuilding all the others, drop the old index first (like --always-drop-first, but only for that index). THIS WILL DEGRADE DATABASE PERFORMANCE for that index")
+
+    parser.add_argument("--engine", choices=['auto', 'reindex', 'legacy'], default='auto', help="How to rebuild indexes. reindex: REINDEX INDEX CONCURRENTLY, which needs PostgreSQL 12+, and can also rebuild unique & constraint indexes. legacy: create a new index beside the old one, and swap them. auto: reindex where possible (default)")
+
+    parser.add_argument("--build-memory", type=humanfriendly.parse_size, required=False, metavar="SIZE", help="Total maintenance_work_mem for all the index builds running at once, shared evenly between --jobs and --parallel-databases. Each build gets about twice the size of the new index, at least 16MB, up to its share (default: the server's setting)")
+    parser.add_argument("--build-workers", type=int, required=False, metavar="N", help="Total parallel maintenance workers for all the index builds running at once, shared like --build-memory. Indexes over 128MB get one worker, and one more each time the size doubles, up to their share. PostgreSQL 11+ (default: the server's setting)")
+
+    parser.add_argument("--storage-advice", choices=['report', 'apply'], required=False, help="Recommend a fillfactor and deduplicate_items for each btree index before it's rebuilt, from its table's update, delete & insert rates (and the --history), with the predicted time until it's bloated again. report: only log them. apply: set them on the index, so it's rebuilt with them")
+
+    parser.add_argument("--rebuild-order", choices=['wasted', 'table'], default='wasted', help="wasted: rebuild indexes in order of their wasted space (default). table: rebuild the indexes of each table back to back, so its heap is still cached for the next build")
+    parser.add_argument("--prewarm", action="store_true", help="Load each table into shared buffers with pg_prewarm (if it's installed) before rebuilding its indexes, when it's at most half of shared_buffers. Best with --rebuild-order table")
+
+    parser.add_argument("--time-budget", type=humanfriendly.parse_timespan, required=False, metavar="TIMESPAN", help="Finish within this time (e.g. 3h). Indexes which save the most space per second of rebuilding are done first, and no rebuild is started which is expected to overrun")
+    parser.add_argument("--build-rate", type=humanfriendly.parse_size, default=humanfriendly.parse_size("20MB"), metavar="SIZE", help="With --time-budget, how many bytes of index to assume are built per second, until some indexes have been rebuilt and the real rate is known (default: 20MB)")
+
+    parser.add_argument("--history", required=False, metavar="PATH", help="Record the size, bloat, savings and rebuild time of every index, on every run, in this SQLite file")
+    parser.add_argument("--history-report", action="store_true", help="Print a report from the --history file of how fast each index re-bloats and when it will next need rebuilding, and exit")
+    parser.add_argument("--skip-rebuilt-within", type=humanfriendly.parse_timespan, required=False, metavar="TIMESPAN", help="With --history, don't rebuild indexes which were rebuilt less than this long ago (e.g. 7d)")
+    parser.add_argument("--min-bloat-growth", type=humanfriendly.parse_size, required=False, metavar="SIZE", help="With --history, don't rebuild indexes whose bloat grows by less than this much per day")
+
+    parser.add_argument("--max-active-queries", type=int, required=False, metavar="N", help="Don't start rebuilding an index while more than N other queries are active. Wait for the load to drop")
+    parser.add_argument("--max-lock-waits", type=int, required=False, metavar="N", help="Don't start rebuilding an index while more than N queries are waiting for a lock")
+    parser.add_argument("--max-checkpoints-per-hour", type=float, required=False, metavar="N", help="Don't start rebuilding an index while more than N checkpoints per hour are being requested (i.e. not timed checkpoints)")
+    parser.add_argument("--max-load-average", type=float, required=False, metavar="LOAD", help="Don't start rebuilding an index while the 1 minute load average is above LOAD. Only when running on the database server")
+    parser.add_argument("--max-replication-lag", type=humanfriendly.parse_size, required=False, metavar="SIZE", help="Don't start rebuilding an index while a replica (streaming, or logical subscriber, from pg_stat_replication) is more than this much WAL behind")
+    parser.add_argument("--max-wal-per-hour", type=humanfriendly.parse_size, required=False, metavar="SIZE", help="Don't start rebuilding an index if the WAL written while building indexes in the last hour, plus about the size of this index, would be more than this")
+    parser.add_argument("--throttle-interval", type=humanfriendly.parse_timespan, default=10, metavar="TIMESPAN", help="How often to check the load (default: 10s)")
+    parser.add_argument("--throttle-max-wait", type=humanfriendly.parse_timespan, default=humanfriendly.parse_timespan("1h"), metavar="TIMESPAN", help="Skip an index if the database is still overloaded after waiting this long (default: 1h)")
+    parser.add_argument("--throttle-cancel", action="store_true", help="Also check the load while an index is being built, and cancel the build (keeping the old index) if the database stays overloaded")
+
+    parser.add_argument("--lock-timeout", type=humanfriendly.parse_timespan, default=2, metavar="TIMESPAN", help="How long to wait for the lock to rename or drop an index, or swap a constraint, before backing off and trying again. Other queries on the table wait behind us meanwhile (default: 2s)")
+    parser.add_argument("--lock-attempts", type=int, default=10, metavar="N", help="Try to get those locks this many times before giving up on the index (default: 10)")
+    parser.add_argument("--lock-max-backoff", type=humanfriendly.parse_timespan, default=60, metavar="TIMESPAN", help="The longest time to back off between attempts to get a lock. The backoff is random, and doubles each attempt (default: 1m)")
+
+    parser.add_argument("--progress-interval", type=humanfriendly.parse_timespan, default=30, metavar="TIMESPAN", help="While building an index, log its progress and an ETA this often, from pg_stat_progress_create_index (PostgreSQL 12+). 0 turns it off (default: 30s)")
+    parser.add_argument("--metrics-textfile", required=False, metavar="PATH", help="Write metrics (per database counters, and per phase timings) to this file in the Prometheus text format, e.g. for node_exporter's textfile collector. It's replaced after every index")
+    parser.add_argument("--metrics-json", required=False, metavar="PATH", help="Append a JSON line for every event (index progress, phase timings, indexes done) to this file, - for standard out")
+
+    parser.add_argument("--plan-out", required=False, metavar="PATH", help="Don't rebuild anything. Write the plan (every index considered: whether it would be rebuilt, or why not, where, and roughly how long it would take) to this JSON file, to review, and run later with --apply-plan")
+    parser.add_argument("--apply-plan", required=False, metavar="PATH", help="Rebuild the indexes in this plan (from --plan-out), in order, without estimating the bloat again. Indexes which have been changed since the plan was made are skipped. Runs on all the plan's databases, or only the -d one")
+
+    parser.add_argument("--estimator", choices=['sql', 'columns', 'pgstattuple'], default='sql', help="How to measure index bloat. sql: a rough, fast, estimate from the table statistics (default). columns: estimate btree indexes from the statistics of only the columns they index. pgstattuple: measure btree indexes with the pgstattuple extension (and pageinspect for sampling), falling back to sql where that's not possible")
+    parser.add_argument("--exact-estimate-max-size", type=humanfriendly.parse_size, default=humanfriendly.parse_size("10GiB"), metavar="SIZE", help="With --estimator pgstattuple, indexes bigger than this are sampled rather than read in full (default: 10GiB)")
+    parser.add_argument("--estimate-sample-pages", type=int, default=2000, metavar="N", help="With --estimator pgstattuple, how many pages to read from each sampled index (default: 2000)")
+    parser.add_argument("--estimate-cache", required=False, metavar="PATH", help="With --estimator pgstattuple, cache the measurements in this JSON file")
+    parser.add_argument("--estimate-cache-max-age", type=humanfriendly.parse_timespan, default=humanfriendly.parse_timespan("1d"), metavar="TIMESPAN", help="How long cached measurements are used for (default: 1d)")
+
+    parser.add_argument("--skip-unchanged", required=False, metavar="PATH", help="Remember in this JSON file how many rows each database had written when its bloat was last estimated. On the next run, a database is skipped (after one cheap query) if too few rows have been written since for any index to have crossed --min-bloat. For running often from cron")
+
+    parser.add_argument("--table-estimate-cache", required=False, metavar="PATH", help="Cache the (sql) bloat estimate of each table in this JSON file, and only estimate the tables which have been written to, vacuumed or analysed since (from pg_stat_user_tables). Much faster with many tables")
+
+    parser.add_argument("--parallel-databases", type=int, required=False, default=1, metavar="N", help="With --all-databases, process up to N databases at the same time (default: 1)")
+    parser.add_argument("--database-order", choices=['size', 'size-desc', 'name'], default='size', help="With --all-databases, the order to process databases in. size: smallest first (default), size-desc: largest first, name: alphabetical")
+
+    parser.add_argument("-j", "--jobs", type=int, required=False, default=1, metavar="N", help="Rebuild up to N indexes at the same time, using N connections. Two indexes on the same table are never rebuilt at the same time (default: 1)")
+
+    parser.add_argument("--estimate-interval", type=humanfriendly.parse_timespan, default=humanfriendly.parse_timespan("15m"), metavar="TIMESPAN", help="With daemon, how often to estimate the bloat again (default: 15m)")
+    parser.add_argument("--window", type=parse_window, action="append", metavar="HH:MM-HH:MM", help="With daemon, only rebuild indexes during this time of day (local time, can go over midnight). Can be given many times (default: any time)")
 
     parser.add_argument('--pre-rebuild-command')
     parser.add_argument('--post-rebuild-command')
 
-    args = parser.parse_args()
+    argv = sys.argv[1:]
+    daemon = len(argv) > 0 and argv[0] == 'daemon'
+    if daemon:
+        argv = argv[1:]
+    args = parser.parse_args(argv)
+    args.daemon = daemon
+
+    if args.history_report:
+        if args.history is None:
+            parser.error("--history-report needs --history")
+        history = RunHistory(args.history)
+        print_history_report(history, args.min_bloat)
+        history.close()
+        return
+    if (args.skip_rebuilt_within is not None or args.min_bloat_growth is not None) and args.history is None:
+        parser.error("--skip-rebuilt-within and --min-bloat-growth need --history")
+
+    if args.plan_out is not None and args.apply_plan is not None:
+        parser.error("--plan-out and --apply-plan can't be used together")
+    if args.daemon and any(x is not None for x in (args.plan_out, args.apply_plan, args.time_budget)):
+        parser.error("--plan-out, --apply-plan and --time-budget can't be used with daemon (see --window)")
+    if args.daemon and (args.jobs > 1 or args.parallel_databases > 1):
+        parser.error("daemon rebuilds one index at a time, so --jobs and --parallel-databases can't be used with it")
+    if args.estimate_interval <= 0:
+        parser.error("--estimate-interval must be positive")
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.parallel_databases < 1:
+        parser.error("--parallel-databases must be at least 1")
+
+    if args.jobs > 1 or args.parallel_databases > 1:
+        log_format_thread = "[%(threadName)s] "
+    else:
+        log_format_thread = ""
 
     if args.log_stdout:
         handler = logging.StreamHandler(sys.stdout)
         handler.setLevel(logging.DEBUG)
-        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: ' + log_format_thread + '%(message)s'))
         logger.addHandler(handler)
 
     if args.log_syslog:
         handler = logging.handlers.SysLogHandler("/dev/log")
         handler.setLevel(logging.DEBUG)
         # Unix convention of the PID & process at the start. syslog already has datetime so don't need to include that
-        handler.setFormatter(logging.Formatter('pgindexrebuild[{pid}]: %(levelname)s: %(message)s'.format(pid=os.getpid())))
+        handler.setFormatter(logging.Formatter('pgindexrebuild[{pid}]: %(levelname)s: {thread}%(message)s'.format(pid=os.getpid(), thread=log_format_thread)))
         logger.addHandler(handler)
 
     # Ensure we always have at least one handler. Otherwise with
@@ -278,19 +3299,26 @@ def main():
 
     conn = None
     databases = []
-    if args.all_databases:
+    plan_to_apply = None
+    if args.apply_plan is not None:
+        try:
+            plan_to_apply = Plan.load(args.apply_plan)
+        except (IOError, ValueError, KeyError) as ex:
+            logger.error("Could not read the plan {}: {!r}".format(args.apply_plan, ex))
+            return
+        databases = [d for d in plan_to_apply.databases() if args.database is None or args.all_databases or d == args.database]
+        connect_args['database'] = 'postgres'
+        logger.info("Applying the plan {} to {} database(s): {}".format(args.apply_plan, len(databases), ", ".join(databases)))
+    elif args.all_databases:
         # work on all database
 
         # psycopg2 requires that we have at least one argument in the
         # connect_args, so set this to a database that we know works
         connect_args['database'] = 'postgres'
 
-        conn = psycopg2.connect(**connect_args)
+        conn = connect(connect_args)
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        # TODO Find out sizes (like \l+) and sort by that. Work on smallest dbs first
-        cursor.execute("SELECT datname from pg_database where datistemplate = false order by datname")
-        databases = [row[0] for row in cursor.fetchall()]
-        conn.close()
+        databases = get_all_databases(cursor, args.database_order)
         logger.info("Running on all databases: Found {} database: {}".format(len(databases), ", ".join(databases)))
     elif args.database is not None:
         logger.info("Only operating on one database: {}".format(args.database))
@@ -300,7 +3328,14 @@ def main():
         logger.error("What do you want to do? You must provide either a database name (with -d) or --all-databases to work on all databases")
         return
 
-    total_savings = 0
+    if args.estimator == 'pgstattuple':
+        logger.info("Measuring bloat with pgstattuple")
+        estimator = PgstattupleEstimator(args.exact_estimate_max_size, args.estimate_sample_pages, args.estimate_cache, args.estimate_cache_max_age)
+    elif args.estimator == 'columns':
+        logger.info("Estimating btree index bloat from the indexed columns' statistics")
+        estimator = ColumnEstimator()
+    else:
+        estimator = None
 
     always_drop_first = args.always_drop_first
     if always_drop_first:
@@ -313,12 +3348,44 @@ def main():
     else:
         logger.info("Not repairing invalid indexes")
 
-    if args.dry_run:
+    if args.plan_out is not None:
+        logger.info("Writing a plan to {}, no changes will be made".format(args.plan_out))
+        args.dry_run = True
+    elif args.dry_run:
         logger.info("Running in dry-run mode, no changes will be made")
 
-    connect_args['database'] = 'postgres'
-    conn = psycopg2.connect(**connect_args)
+    if args.jobs > 1:
+        logger.info("Rebuilding up to {} indexes in parallel".format(args.jobs))
+    if args.parallel_databases > 1:
+        logger.info("Processing up to {} databases in parallel".format(args.parallel_databases))
+
+    # One connection for the server wide settings. It's kept, and reused for
+    # processing its database, so a run on one database only connects once
+    if conn is None:
+        if 'database' not in connect_args:
+            connect_args['database'] = 'postgres'
+        try:
+            conn = connect(connect_args)
+        except psycopg2.OperationalError as ex:
+            logger.error("Unable to connect to database {}. Error: {!r}".format(connect_args['database'], ex))
+            return
     all_tablespaces = get_all_tablespaces(conn.cursor())
+    server_version = conn.server_version
+    if args.free_space_check and is_local_connection(args.hostname) and not args.always_drop_first:
+        paths = tablespace_paths(conn.cursor())
+    else:
+        paths = None
+
+    try:
+        args.engine = choose_engine(args.engine, server_version, args.concurrent, args.always_drop_first)
+    except ValueError as ex:
+        logger.error(str(ex))
+        return
+    if args.engine == 'reindex':
+        logger.info("Rebuilding indexes with REINDEX INDEX CONCURRENTLY")
+    else:
+        logger.info("Rebuilding indexes by creating a new index and swapping it with the old one")
+
     tablespaces = [possible_tablespace for possible_tablespace in args.tablespaces.split(",") if possible_tablespace in all_tablespaces]
     if len(tablespaces) == 0:
         logger.error("No valid tablespace usable")
@@ -328,217 +3395,98 @@ def main():
         logger.debug("Using default pg_default tablespace")
     else:
         logger.info("Using special tablespace {}".format(tablespace))
-
-    with log_duration("processing all databases"):
+        if args.engine == 'reindex':
+            logger.info("REINDEX CONCURRENTLY rebuilds indexes in their own tablespace, so the tablespace {} will not be used. Use --engine legacy to build in it".format(tablespace))
+
+    run = Run(args, connect_args, tablespaces)
+    run.server_version = server_version
+    run.spare_connections[connect_args['database']] = [conn]
+    run.plan_to_apply = plan_to_apply
+    if args.plan_out is not None:
+        run.plan = Plan()
+    if paths is not None:
+        logger.info("Checking for free disk space before building each index")
+        run.free_space = FreeSpace(paths, args.min_free_space)
+    run.estimator = estimator
+    if args.table_estimate_cache is not None:
+        run.table_cache = TableEstimateCache(args.table_estimate_cache)
+    if args.skip_unchanged is not None:
+        run.change_tracker = ChangeTracker(args.skip_unchanged)
+    if args.history is not None:
+        logger.info("Recording run history in {}".format(args.history))
+        run.history = RunHistory(args.history)
+    if args.max_load_average is not None and not is_local_connection(args.hostname):
+        logger.info("Not running on the database server, so ignoring --max-load-average")
+        args.max_load_average = None
+    if any(x is not None for x in (args.max_active_queries, args.max_lock_waits, args.max_checkpoints_per_hour, args.max_load_average, args.max_replication_lag, args.max_wal_per_hour)):
+        logger.info("Throttling rebuilds when the database is overloaded")
+        run.throttle = LoadThrottle(args.max_active_queries, args.max_lock_waits, args.max_checkpoints_per_hour, args.max_load_average, args.throttle_interval, args.throttle_max_wait, args.throttle_cancel, args.max_replication_lag, args.max_wal_per_hour)
+    run.lock_retry = LockRetry(args.lock_timeout, args.lock_attempts, args.lock_max_backoff)
+    if args.metrics_textfile is not None or args.metrics_json is not None:
+        if args.metrics_json == '-':
+            json_stream = sys.stdout
+        elif args.metrics_json is not None:
+            json_stream = open(args.metrics_json, 'a')
+        else:
+            json_stream = None
+        run.metrics = Metrics(args.metrics_textfile, json_stream)
+        run.lock_retry.metrics = run.metrics
+    if args.progress_interval and server_version >= 120000 and not args.dry_run:
+        run.progress = ProgressMonitor(args.progress_interval, run.metrics)
+    if (args.build_memory is not None or args.build_workers is not None) and not args.dry_run:
+        run.build_tuning = BuildTuning(args.build_memory, args.build_workers, args.jobs * args.parallel_databases, server_version)
+        if args.build_workers is not None and run.build_tuning.workers is None:
+            logger.info("Parallel index builds need PostgreSQL 11+, so ignoring --build-workers")
+    if args.storage_advice is not None or plan_to_apply is not None:
+        # With --apply-plan, the plan says what to set
+        run.storage_advisor = StorageAdvisor(args.storage_advice == 'apply', args.min_bloat, server_version, run.history)
+    if args.time_budget is not None:
+        logger.info("Time budget of {}".format(humanfriendly.format_timespan(args.time_budget)))
+        run.budget = TimeBudget(args.time_budget, args.build_rate)
+    savings_counter = run.savings_counter
+
+    if args.daemon:
+        run_daemon(run, databases)
+    elif args.parallel_databases > 1:
+        import concurrent.futures
+        with log_duration("processing all databases"), concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_databases) as executor:
+            futures = [executor.submit(process_database_in_thread, database, run) for database in databases]
+            for future in futures:
+                future.result()
+    else:
+        with log_duration("processing all databases"):
+            for database in databases:
+                process_database(database, run)
+
+    run.close_spare_connections()
+    if estimator is not None:
+        estimator.save()
+    if run.table_cache is not None:
+        run.table_cache.save()
+    if run.change_tracker is not None and not args.dry_run:
+        run.change_tracker.save()
+    if run.history is not None:
+        run.history.close()
+    if run.metrics is not None:
+        run.metrics.write(run)
+        run.metrics.event('finish', saved=savings_counter.total, lock_wait=run.lock_retry.total)
+    if run.plan is not None:
+        run.plan.save(args.plan_out)
+        rebuilds = [e for e in run.plan.entries if e['action'] == 'rebuild']
+        logger.info("Wrote the plan to {}: rebuild {} index(es), wasting {}, in about {}. Skip {} index(es)".format(args.plan_out, len(rebuilds), format_size(sum(e['wasted'] for e in rebuilds)), humanfriendly.format_timespan(sum(e['estimated_seconds'] for e in rebuilds)), len(run.plan.entries) - len(rebuilds)))
+
+    if len(databases) > 1 and not args.dry_run:
         for database in databases:
-            with log_duration("processing database {}".format(database)):
-                if conn:
-                    conn.close()
-                connect_args['database'] = database
-                try:
-                    conn = psycopg2.connect(**connect_args)
-                except psycopg2.OperationalError as ex:
-                    logger.error("Unable to connect to database {}. Error: {!r}".format(database, ex))
-                    continue
-
-                logger.info("Connected to database {}{}".format(database, (" as user {}".format(args.user) if args.user else " as unspecified user")))
-
-
-                # Need this transaction isolation level for CREATE INDEX CONCURRENTLY
-                # cf. http://stackoverflow.com/questions/3413646/postgres-raises-a-active-sql-transaction-errcode-25001
-                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-
-                cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            logger.info("DB {}: Saved {}. Waited {} for locks".format(database, format_size(savings_counter.by_database.get(database, 0)), humanfriendly.format_timespan(run.lock_retry.by_database.get(database, 0))))
 
-                # what's the default tablespace for this database?
-                cursor.execute("select t.* from pg_database d join pg_tablespace t ON t.oid = d.dattablespace where datname = %s;", (database,))
-                database_tablespace = cursor.fetchone()[0]
-                logger.info("Default tablespace for database {} is {}".format(database, database_tablespace))
-
-                cursor.execute("SET default_tablespace = %s;", (tablespace,))
-
-                with log_duration("calculating index sizes"):
-                    objs = indexsizes(cursor)
-
-                if args.repair_invalid:
-                    with log_duration("calculating invalid indexes"):
-                        invalid_indexes = calculate_invalid_indexes(cursor)
-                else:
-                    invalid_indexes = []
-
-
-                if len(objs) == 0 and len(invalid_indexes) == 0:
-                    logger.info("No bloated or invalid indexes found for database {}. Either you have no permission to read them, or there is no index bloat or invalid indexes in this database.".format(database))
-                    continue
-
-                total_used = sum(Decimal(x['size']) for x in objs)
-                total_wasted = sum(Decimal(x['wasted']) for x in objs)
-                percent_wasted = "N/A" if total_used == 0 else "{:.0%}".format(float(total_wasted)/float(total_used))
-                logger.info("DB {}: Used space: {} Wasted space: {} {} wasted space".format(database, format_size(total_used), format_size(total_wasted), percent_wasted))
-                logger.info("DB {}: {} invalid index(es): {}".format(database, len(invalid_indexes), ", ".join(x['name'] for x in invalid_indexes)))
-
-
-                min_bloat = args.min_bloat
-                logger.info("Ignoring all tables with a bloat less than {}".format(format_size(min_bloat)))
-
-                total_savings_this_database = 0
-
-                for obj in objs+invalid_indexes:
-                    if args.exclude_index is not None and ( (obj['name'] in args.exclude_index) or (database+"."+obj['name'] in args.exclude_index) ):
-                        logger.info("Skipping index {} because it has been excluded".format(obj['name']))
-                        continue
-
-                    if not obj['invalid_index']:
-                        # This is a bloated index
-                        if obj['wasted'] == 0:
-                            logger.info("Skipping Index {name} size {size} wasted {wasted}".format(name=obj['name'], size=format_size(obj['size']), wasted=format_size(obj['wasted'])))
-                            continue
-                        if obj['wasted'] <= min_bloat:
-                            logger.info("Skipping Index {name} size {size} wasted {wasted} which is less than min bloat {min_bloat}".format(name=obj['name'], size=format_size(obj['size']), wasted=format_size(obj['wasted']), min_bloat=format_size(min_bloat)))
-                            continue
-
-                    if ' UNIQUE ' in obj['indexdef'].upper():
-                        # FIXME Better unique index detection
-                        # FIXME Don't skip unique indexes, instead figure out how to
-                        # recreate the unique contraint, like we do with PRIMARY KEYS
-                        logger.info("Skipping Index {} size {} wasted {} because it has a unique constraint".format(obj['name'], format_size(obj['size']), format_size(obj['wasted'])))
-                        continue
-
-                    if obj['invalid_index']:
-                        logger.info("Reindexing invalid index {}".format(obj['name']))
-                    else:
-                        oldsize = index_size(cursor, obj['name'])
-                        logger.info("Reindexing {} size {} wasted {} {:.0%}".format(obj['name'], format_size(obj['size']), format_size(obj['wasted']), float(obj['wasted']) / obj['size']))
-
-                    # what's the tablespace for this index?
-                    cursor.execute("SELECT tablespace FROM pg_indexes WHERE indexname = %s;", (obj['name'],));
-                    index_tablespace = cursor.fetchone()[0] or database_tablespace
-                    logger.info("index {} is on tablespace {}".format(obj['name'], index_tablespace));
-
-                    if not args.dry_run:
-                        old_index_name = "{t}_old".format(t=obj['name'])
-
-                        if does_index_exist(cursor, old_index_name):
-                            logger.info("The index {old} already exists. This can happen when a previous run of this has been interrupted. You can delete this old index with:  DROP INDEX {old};  Processing will continue with the rest of the indexes".format(old=old_index_name))
-                            continue
-
-                        # TODO For invalid indexes, you could drop the old one
-                        # first, since it's invalid and unusable. However that
-                        # means if there's a problem later, you have lost the
-                        # information that something is wrong with your
-                        # database
-                        if not always_drop_first:
-                            # Move old index out of the way
-                            # If it takes more than 10 minutes (600,000 ms), abort.
-                            # Sometimes this statement has been blocked for days.
-                            with postgres_timeout(cursor, 10 * 60 * 1000):
-                                cursor.execute("ALTER INDEX {t} RENAME TO {old};".format(t=obj['name'], old=old_index_name))
-                            logger.debug("Renamed index {t} to {t}_old".format(t=obj['name']))
-                        else:
-                            # Super slim mode, delete it
-                            cursor.execute("DROP INDEX {t};".format(t=obj['name']))
-                            logger.debug("Dropped index {t}".format(t=obj['name']))
-
-                        # (Re-)Create the new index
-                        logger.debug("Index creation SQL: {}".format(obj['indexdef']))
-                        if args.pre_rebuild_command:
-                            logger.debug("About to run pre-rebuild command: {}".format(args.pre_rebuild_command))
-                            (status, output) = subprocess.getstatusoutput(args.pre_rebuild_command)
-
-                            logger.debug("Pre-rebuild command of {}, status code: {} output: {}".format(args.pre_rebuild_command, status, output))
-                        try:
-
-                            index_attempt = 1
-                            successful_recreation = False
-                            while not successful_recreation and index_attempt <= MAX_INDEX_ATTEMPTS:
-                                logger.debug("Starting attempt {} of {} for {}".format(index_attempt, MAX_INDEX_ATTEMPTS, obj['name']))
-
-                                if args.concurrent:
-                                    index_creation_sql = make_indexdef_concurrent(obj['indexdef'])
-                                else:
-                                    index_creation_sql = obj['indexdef']
-
-
-                                # Create the new index
-                                with log_duration("recreating index"):
-                                    cursor.execute(index_creation_sql)
-
-
-                                # check if the new index is valid
-                                new_index_is_valid = is_index_valid(cursor, obj['name'])
-                                if not new_index_is_valid:
-                                    logger.error("New index {} is not valid. Deleting and retrying. That was attempt {} of {}".format(obj['name'], index_attempt, MAX_INDEX_ATTEMPTS))
-                                    cursor.execute("DROP INDEX {}".format(obj['name']))
-                                    successful_recreation = False
-                                else:
-                                    # Index is valid, so break out
-                                    logger.debug("New index {} is valid. That was attempt {} of {}".format(obj['name'], index_attempt, MAX_INDEX_ATTEMPTS))
-                                    successful_recreation = True
-
-                                index_attempt += 1
-
-                            # Could not recreate index successfully after MAX_INDEX_ATTEMPTS attempts
-                            if not successful_recreation:
-                                logger.error("Could not recreate {}. Attempted {} times. Ignoring this index".format(obj['name'], MAX_INDEX_ATTEMPTS))
-                                # Remame _old index back to new name
-                                logger.debug("Renaming old index ({old}) back to original name ({t})".format(old=old_index_name, t=obj['name']))
-                                cursor.execute("ALTER INDEX {old} RENAME TO {t};".format(t=obj['name'], old=old_index_name))
-
-                                # bailout
-                                continue
-
-                        except psycopg2.OperationalError as e:
-                            logger.error("Error occured: {!r}".format(e))
-                            # drop newly created, and invalid index
-                            logger.debug("Deleting the invalid index {}".format(obj['name']))
-                            cursor.execute("DROP INDEX {t};".format(t=obj['name']))
-                            logger.debug("Renaming old index ({old}) back to original name ({t})".format(old=old_index_name, t=obj['name']))
-                            cursor.execute("ALTER INDEX {old} RENAME TO {t};".format(t=obj['name'], old=old_index_name))
-                            raise
-
-                        finally:
-                            if args.post_rebuild_command:
-                                logger.debug("About to run post-rebuild command: {}".format(args.post_rebuild_command))
-                                (status, output) = subprocess.getstatusoutput(args.post_rebuild_command)
-
-                                logger.debug("Post-rebuild command of {}, status code: {} output: {}".format(args.post_rebuild_command, status, output))
-
-
-                        # Analyze the new index.
-                        cursor.execute("ANALYSE {t};".format(t=obj['name']))
-
-                        if obj.get('primary', False):
-                            if not always_drop_first:
-                                cursor.execute("ALTER TABLE {table} DROP CONSTRAINT {t}_old;".format(t=obj['name'], table=obj['table']))
-
-                            cursor.execute("ALTER TABLE {table} ADD CONSTRAINT {t} PRIMARY KEY USING INDEX {t};".format(t=obj['name'], table=obj['table']))
-
-                        if not always_drop_first:
-
-                            if tablespace != index_tablespace:
-                                with log_duration("moving old index to the working tablespace {} from {}".format(tablespace, index_tablespace)):
-                                    cursor.execute("ALTER INDEX {old} SET TABLESPACE {t};".format(old=old_index_name, t=tablespace))
-
-                                with log_duration("moving new index to the proper tablespace ({}) from the working tablespace {}".format(index_tablespace, tablespace)):
-                                    cursor.execute("ALTER INDEX {new} SET TABLESPACE {t};".format(new=obj['name'], t=tablespace))
-
-                            logger.debug("Dropped index {old}".format(old=old_index_name))
-                            cursor.execute("DROP INDEX {old};".format(old=old_index_name))
-
-                        if not obj['invalid_index']:
-                            newsize = index_size(cursor, obj['name'])
-                            savings = oldsize - newsize
-                            total_savings += savings
-                            logger.info("Saved {} {:.0%} - Total savings so far: {}".format(format_size(savings), savings/oldsize, format_size(total_savings)))
 
+    if run.budget is not None and len(run.budget.deferred) > 0:
+        logger.info("Deferred {} index(es), wasting {}, to a later run because of the time budget: {}".format(len(run.budget.deferred), format_size(sum(x.get('wasted', 0) for x in run.budget.deferred)), ", ".join(x['name'] for x in run.budget.deferred)))
 
     if args.dry_run:
         logger.info("Finish. Ran in dry-run so no space saved")
     else:
-        logger.info("Finish. Saved {} in total".format(format_size(total_savings)))
-
-    if conn:
-        conn.close()
+        logger.info("Finish. Saved {} in total. Waited {} for locks".format(format_size(savings_counter.total), humanfriendly.format_timespan(run.lock_retry.total)))
 
 
 if __name__ == '__main__':
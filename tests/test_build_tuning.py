@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+def test_nothing_set_by_default():
+    assert pgindexrebuild.BuildTuning().settings(10 * GB) == {}
+
+
+def test_memory_from_index_size():
+    tuning = pgindexrebuild.BuildTuning(memory=1 * GB, server_version=160000)
+    # At least MIN_MEMORY, about twice the index, at most the limit
+    assert tuning.settings(1 * MB) == {'maintenance_work_mem': "16384kB"}
+    assert tuning.settings(100 * MB) == {'maintenance_work_mem': "204800kB"}
+    assert tuning.settings(10 * GB) == {'maintenance_work_mem': "1048576kB"}
+
+
+def test_split_between_concurrent_builds():
+    tuning = pgindexrebuild.BuildTuning(memory=1 * GB, workers=8, concurrent_builds=4, server_version=160000)
+    assert tuning.memory == 256 * MB
+    assert tuning.workers == 2
+
+
+def test_workers_from_index_size():
+    tuning = pgindexrebuild.BuildTuning(workers=8, server_version=160000)
+    assert tuning.settings(100 * MB) == {'max_parallel_maintenance_workers': 0}
+    # One more each time the index doubles
+    assert tuning.settings(128 * MB) == {'max_parallel_maintenance_workers': 1}
+    assert tuning.settings(512 * MB) == {'max_parallel_maintenance_workers': 3}
+    assert tuning.settings(100 * GB) == {'max_parallel_maintenance_workers': 8}
+
+
+def test_workers_need_32mb_each():
+    tuning = pgindexrebuild.BuildTuning(memory=128 * MB, workers=8, server_version=160000)
+    # 128MB is enough for the leader & 3 workers
+    assert tuning.settings(10 * GB) == {'maintenance_work_mem': "131072kB", 'max_parallel_maintenance_workers': 3}
+
+
+def test_no_workers_before_postgresql_11():
+    tuning = pgindexrebuild.BuildTuning(workers=8, server_version=100000)
+    assert tuning.workers is None
+    assert tuning.settings(10 * GB) == {}
@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+def counters(changes, invalid_indexes=0, stats_reset='2024-01-01'):
+    return {'stats_reset': stats_reset, 'changes': changes, 'invalid_indexes': invalid_indexes, 'max_entry_bytes': 100.0}
+
+
+def make_tracker(tmp_path):
+    tracker = pgindexrebuild.ChangeTracker(str(tmp_path / "state.json"))
+    tracker.record('db', counters(1000), 10000)
+    return tracker
+
+
+def test_unchanged_when_too_few_rows_written(tmp_path):
+    tracker = make_tracker(tmp_path)
+    # 10000 + 2 * 100 * 100 bytes
+    assert tracker.unchanged('db', counters(1100), 30000) is not None
+    assert tracker.unchanged('db', counters(1101), 30000) is None
+
+
+def test_checked_when_never_seen_or_stats_reset(tmp_path):
+    tracker = make_tracker(tmp_path)
+    assert tracker.unchanged('other', counters(1000), 30000) is None
+    assert tracker.unchanged('db', counters(1000, stats_reset='2024-02-01'), 30000) is None
+    assert tracker.unchanged('db', counters(10), 30000) is None
+
+
+def test_invalid_indexes_only_matter_with_repair_invalid(tmp_path):
+    tracker = make_tracker(tmp_path)
+    assert tracker.unchanged('db', counters(1000, invalid_indexes=1), 30000) is not None
+    assert tracker.unchanged('db', counters(1000, invalid_indexes=1), 30000, repair_invalid=True) is None
+
+
+def test_save_and_load(tmp_path):
+    tracker = make_tracker(tmp_path)
+    tracker.save()
+    loaded = pgindexrebuild.ChangeTracker(str(tmp_path / "state.json"))
+    assert loaded.unchanged('db', counters(1000), 30000) is not None
@@ -0,0 +1,77 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+def column(attlen, attalign, avg_width, null_frac=0.0, indexrelid=1, reltuples=1000, attnum=1):
+    return {'indexrelid': indexrelid, 'reltuples': reltuples, 'attnum': attnum, 'attlen': attlen, 'attalign': attalign, 'avg_width': avg_width, 'null_frac': null_frac}
+
+
+def int4(**kwargs):
+    return column(4, 'i', 4, **kwargs)
+
+
+def test_tuple_bytes():
+    estimator = pgindexrebuild.ColumnEstimator()
+    # 8 byte header + int4, MAXALIGNed, + line pointer
+    assert estimator.tuple_bytes([int4()]) == 20
+    assert estimator.tuple_bytes([column(8, 'd', 8)]) == 20
+    assert estimator.tuple_bytes([int4(), int4()]) == 20
+    # A short varlena has a 1 byte header, and isn't aligned
+    assert estimator.tuple_bytes([int4(), column(-1, 'i', 10)]) == 28
+
+
+def test_tuple_bytes_with_nulls():
+    estimator = pgindexrebuild.ColumnEstimator()
+    # Half have the null bitmap & no second column (16 + 4 + 4 aligned to 24)
+    assert estimator.tuple_bytes([int4(), int4(null_frac=0.5)]) == 0.5 * 16 + 0.5 * 24 + 4
+
+
+def test_layout_bytes():
+    estimator = pgindexrebuild.ColumnEstimator()
+    assert estimator.layout_bytes([], 8) == 8
+    # int2 then int8: 8 + 2, aligned to 16 + 8
+    assert estimator.layout_bytes([column(2, 's', 2), column(8, 'd', 8)], 8) == 24
+    # A long varlena has a 4 byte header, so is aligned
+    assert estimator.layout_bytes([column(2, 's', 2), column(-1, 'i', 200)], 8) == 216
+
+
+def test_expected_bytes():
+    estimator = pgindexrebuild.ColumnEstimator()
+    # 365 tuples per leaf page (one is the high key) at fillfactor 90, so 3
+    # leaves, a root, and the metapage
+    assert estimator.expected_bytes(1000, 20, 0.9, 8192) == 5 * 8192
+    assert estimator.expected_bytes(0, 20, 0.9, 8192) == 2 * 8192
+    # A lower fillfactor needs more leaves
+    assert estimator.expected_bytes(1000, 20, 0.5, 8192) == 7 * 8192
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return (8192,)
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_estimate():
+    objs = [
+        {'oid': 1, 'amname': 'btree', 'size': 100 * 8192, 'reloptions': None, 'wasted': 1},
+        # Never analysed
+        {'oid': 2, 'amname': 'btree', 'size': 100 * 8192, 'reloptions': None, 'wasted': 2},
+        {'oid': 3, 'amname': 'gin', 'size': 100 * 8192, 'reloptions': None, 'wasted': 3},
+    ]
+    rows = [int4(indexrelid=1), column(4, 'i', None, indexrelid=2)]
+    pgindexrebuild.ColumnEstimator().estimate(FakeCursor(rows), objs)
+    assert objs[0]['wasted'] == 95 * 8192
+    assert objs[0]['estimated_by'] == 'columns'
+    assert [obj['wasted'] for obj in objs[1:]] == [2, 3]
+    assert 'estimated_by' not in objs[1]
@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+def index(name, wasted):
+    return {'schemaname': 'public', 'name': name, 'wasted': wasted}
+
+
+def test_parse_window():
+    assert pgindexrebuild.parse_window("01:00-05:30") == (60, 330)
+    assert pgindexrebuild.parse_window("22:00-4:00") == (1320, 240)
+    for value in ["1-5", "01:00-25:00", "01:60-05:00", "01:00"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            pgindexrebuild.parse_window(value)
+
+
+def at(hour, minute):
+    return time.mktime((2024, 6, 1, hour, minute, 0, 0, 0, -1))
+
+
+def test_in_window():
+    assert pgindexrebuild.in_window([], at(12, 0))
+    windows = [(60, 330)]
+    assert pgindexrebuild.in_window(windows, at(1, 0))
+    assert not pgindexrebuild.in_window(windows, at(5, 30))
+    assert not pgindexrebuild.in_window(windows, at(0, 59))
+
+
+def test_in_window_overnight():
+    windows = [pgindexrebuild.parse_window("22:00-04:00")]
+    assert pgindexrebuild.in_window(windows, at(23, 0))
+    assert pgindexrebuild.in_window(windows, at(3, 59))
+    assert not pgindexrebuild.in_window(windows, at(4, 0))
+    assert not pgindexrebuild.in_window(windows, at(12, 0))
+
+
+def test_rebuild_queue_most_wasted_first():
+    queue = pgindexrebuild.RebuildQueue()
+    queue.replace('a', [index('a1', 100), index('a2', 300)])
+    queue.replace('b', [index('b1', 200), index('b2', 200)])
+    assert queue.queued('a') == 2
+    assert [(database, obj['name']) for database, obj in (queue.pop() for _ in range(len(queue)))] == [('a', 'a2'), ('b', 'b1'), ('b', 'b2'), ('a', 'a1')]
+
+
+def test_rebuild_queue_replace():
+    queue = pgindexrebuild.RebuildQueue()
+    queue.replace('a', [index('a1', 100), index('a2', 300)])
+    queue.replace('b', [index('b1', 200)])
+    # A new estimate of a replaces its old indexes
+    queue.replace('a', [index('a3', 50)])
+    assert queue.queued('a') == 1
+    assert [queue.pop()[1]['name'] for _ in range(len(queue))] == ['b1', 'a3']
+
+
+def test_history_recorded_once_queued_rebuilds_finish(tmp_path, monkeypatch):
+    args = argparse.Namespace(dry_run=False)
+    run = pgindexrebuild.Run(args, {}, ['pg_default'])
+    run.daemon = True
+    run.history = pgindexrebuild.RunHistory(str(tmp_path / "history.sqlite"))
+    db = pgindexrebuild.DatabaseRun(run, 'a', 'pg_default', pgindexrebuild.CatalogSnapshot())
+    db.observed = [dict(index('a1', 300), size=1000)]
+    conn = types.SimpleNamespace(closed=False, close=lambda: None)
+    monkeypatch.setattr(pgindexrebuild, 'prepare_database', lambda database, run: (conn, None, db, db.observed))
+    queue = pgindexrebuild.RebuildQueue()
+    dbs = {}
+
+    def observations():
+        return run.history._rows("SELECT COUNT(*) FROM index_history WHERE event = 'observed';", ())[0][0]
+
+    pgindexrebuild.daemon_estimate(run, 'a', queue, dbs)
+    assert observations() == 0
+    assert queue.pop()[1]['name'] == 'a1'
+    pgindexrebuild.daemon_finish(run, dbs['a'])
+    assert observations() == 1
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import psycopg2
+import psycopg2.errorcodes
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+class LockNotAvailable(psycopg2.OperationalError):
+    pgcode = psycopg2.errorcodes.LOCK_NOT_AVAILABLE
+
+
+class FakeCursor(object):
+    """Fails to get the lock for the first `failures` statements, and records the SQL."""
+    def __init__(self, failures=0, error=LockNotAvailable):
+        self.failures = failures
+        self.error = error
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        if sql.startswith("ALTER") or sql.startswith("DROP"):
+            if self.failures > 0:
+                self.failures -= 1
+                raise self.error("could not obtain lock")
+
+    def fetchone(self):
+        return ('0',)
+
+
+def statements(cursor):
+    return [sql for sql in cursor.executed if not sql.startswith("SELECT")]
+
+
+def test_backoff_delay():
+    for attempt in range(1, 10):
+        delay = pgindexrebuild.backoff_delay(attempt, 1, 5)
+        assert 0 <= delay <= min(5, 2 ** (attempt - 1))
+
+
+def test_retries_until_the_lock_is_granted(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(pgindexrebuild.time, 'sleep', sleeps.append)
+    lock_retry = pgindexrebuild.LockRetry(2, 5, 60)
+    cursor = FakeCursor(failures=2)
+    assert lock_retry.execute(cursor, "DROP INDEX x;", 'db', 'drop')
+    assert statements(cursor) == ["DROP INDEX x;"] * 3
+    assert len(sleeps) == 2
+    assert lock_retry.retries_by_database['db'] == 2
+    # lock_timeout is set for each attempt, and put back
+    assert cursor.executed.count("SELECT set_config(%s, %s, false);") == 6
+
+
+def test_gives_up_after_attempts(monkeypatch):
+    monkeypatch.setattr(pgindexrebuild.time, 'sleep', lambda seconds: None)
+    lock_retry = pgindexrebuild.LockRetry(2, 3, 60)
+    cursor = FakeCursor(failures=10)
+    assert not lock_retry.execute(cursor, "DROP INDEX x;", 'db')
+    assert statements(cursor) == ["DROP INDEX x;"] * 3
+
+
+def test_other_errors_are_raised(monkeypatch):
+    monkeypatch.setattr(pgindexrebuild.time, 'sleep', lambda seconds: None)
+    lock_retry = pgindexrebuild.LockRetry(2, 3, 60)
+    cursor = FakeCursor(failures=1, error=psycopg2.OperationalError)
+    with pytest.raises(psycopg2.OperationalError):
+        lock_retry.execute(cursor, "DROP INDEX x;", 'db')
+    assert statements(cursor) == ["DROP INDEX x;"]
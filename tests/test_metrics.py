@@ -0,0 +1,33 @@
+import os
+import sys
+import threading
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+def test_write_from_several_threads(tmp_path):
+    textfile = str(tmp_path / "pgindexrebuild.prom")
+    metrics = pgindexrebuild.Metrics(textfile)
+    run = types.SimpleNamespace(savings_counter=pgindexrebuild.SavingsCounter(), lock_retry=None)
+    errors = []
+
+    def write():
+        try:
+            for _ in range(50):
+                metrics.inc('rebuilt', 'db')
+                metrics.write(run)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=write) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with open(textfile) as fp:
+        assert "pgindexrebuild_indexes_rebuilt_total" in fp.read()
+    assert os.listdir(str(tmp_path)) == ["pgindexrebuild.prom"]
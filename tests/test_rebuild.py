@@ -0,0 +1,102 @@
+import argparse
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+class FakeCursor(object):
+    """Records the SQL, and fails the test if anything's run."""
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        raise AssertionError("Unexpected SQL: {}".format(sql))
+
+
+def make_args(**kwargs):
+    args = dict(min_bloat=0, repair_invalid=False, exclude_index=None, concurrent=True, engine='legacy', always_drop_first=False, dry_run=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def make_db(args, entries):
+    run = pgindexrebuild.Run(args, {}, ['pg_default'])
+    run.server_version = 160000
+    snapshot = pgindexrebuild.CatalogSnapshot()
+    for entry in entries:
+        snapshot._add(entry)
+    return pgindexrebuild.DatabaseRun(run, 'db', 'pg_default', snapshot)
+
+
+def entry(name, **kwargs):
+    e = dict(oid=hash(name) % 100000, relfilenode=1, relkind='i', schemaname='public', name=name, table='b', table_oid=1, size=100000,
+             tablespace=None, indisvalid=True, indisprimary=False, indisunique=False, contype=None, condeferrable=False, condeferred=False,
+             referenced_by_fk=False, parent_schema=None, parent_index=None)
+    e.update(kwargs)
+    return e
+
+
+def obj(name):
+    return {'schemaname': 'public', 'name': name, 'table': 'b', 'size': 100000, 'wasted': 50000, 'invalid_index': False, 'indexdef': "CREATE INDEX {} ON b (x)".format(name), 'table_oid': 1}
+
+
+def test_choose_indexes_skips_unique_index_referenced_by_foreign_key(monkeypatch):
+    # A plain unique index (no constraint) which a foreign key depends on
+    db = make_db(make_args(), [entry('b_x_uidx', indisunique=True, referenced_by_fk=True), entry('b_y')])
+    monkeypatch.setattr(pgindexrebuild, 'indexsizes', lambda *args, **kwargs: [obj('b_x_uidx'), obj('b_y')])
+    chosen = pgindexrebuild.choose_indexes(FakeCursor(), db)
+    assert [o['name'] for o in chosen] == ['b_y']
+
+
+def test_rebuild_index_skips_index_referenced_by_foreign_key():
+    old_entry = entry('b_x_uidx', indisunique=True, referenced_by_fk=True)
+    db = make_db(make_args(), [old_entry])
+    cursor = FakeCursor()
+    assert pgindexrebuild._rebuild_index(cursor, obj('b_x_uidx'), db, old_entry, 'pg_default', False) is None
+    assert cursor.executed == []
+
+
+def test_rebuild_index_exclusion_constraint_needs_no_concurrent():
+    old_entry = entry('c_r_excl', contype='x')
+    db = make_db(make_args(concurrent=True), [old_entry])
+    cursor = FakeCursor()
+    assert pgindexrebuild._rebuild_index(cursor, obj('c_r_excl'), db, old_entry, 'pg_default', False) is None
+    assert cursor.executed == []
+
+
+def test_is_reindex_leftover():
+    snapshot = pgindexrebuild.CatalogSnapshot()
+    for e in [entry('b_x'), entry('b_x_ccnew', indisvalid=False), entry('b_x_ccold2', indisvalid=False),
+              entry('mine_ccnew', indisvalid=False), entry('b_y', indisvalid=False), entry('b_y_ccnew', indisvalid=False)]:
+        snapshot._add(e)
+    leftovers = [e['name'] for e in snapshot.entries() if pgindexrebuild.is_reindex_leftover(snapshot, e)]
+    # No valid "mine" or "b_y" index, so those weren't made by REINDEX
+    assert sorted(leftovers) == ['b_x_ccnew', 'b_x_ccold2']
+
+
+def test_make_indexdef_concurrent():
+    assert pgindexrebuild.make_indexdef_concurrent("CREATE INDEX b_x ON public.b USING btree (x)") == "CREATE INDEX CONCURRENTLY b_x ON public.b USING btree (x)"
+    assert pgindexrebuild.make_indexdef_concurrent("CREATE UNIQUE INDEX b_x ON public.b USING btree (x)") == "CREATE UNIQUE INDEX CONCURRENTLY b_x ON public.b USING btree (x)"
+    # Only the start is changed
+    assert pgindexrebuild.make_indexdef_concurrent("CREATE INDEX b_x ON public.b USING btree (x) WHERE (y = 'CREATE INDEX ')") == "CREATE INDEX CONCURRENTLY b_x ON public.b USING btree (x) WHERE (y = 'CREATE INDEX ')"
+    with pytest.raises(ValueError):
+        pgindexrebuild.make_indexdef_concurrent("ALTER INDEX b_x RENAME TO b_y")
+
+
+def test_constraint_swap_sql():
+    o = obj('b_pkey')
+    assert pgindexrebuild.constraint_swap_sql(o, entry('b_pkey', contype='p'), 'b_pkey_old') == "ALTER TABLE b DROP CONSTRAINT b_pkey_old, ADD CONSTRAINT b_pkey PRIMARY KEY USING INDEX b_pkey;"
+    assert pgindexrebuild.constraint_swap_sql(o, entry('b_pkey', contype='u', condeferrable=True), 'b_pkey_old') == "ALTER TABLE b DROP CONSTRAINT b_pkey_old, ADD CONSTRAINT b_pkey UNIQUE USING INDEX b_pkey DEFERRABLE;"
+    assert pgindexrebuild.constraint_swap_sql(o, entry('b_pkey', contype='u', condeferrable=True, condeferred=True), 'b_pkey_old') == "ALTER TABLE b DROP CONSTRAINT b_pkey_old, ADD CONSTRAINT b_pkey UNIQUE USING INDEX b_pkey DEFERRABLE INITIALLY DEFERRED;"
+
+
+def test_can_drop_first():
+    assert pgindexrebuild.can_drop_first(obj('b_x'), entry('b_x'))
+    assert not pgindexrebuild.can_drop_first(obj('b_x'), entry('b_x', indisunique=True))
+    assert not pgindexrebuild.can_drop_first(obj('b_x'), entry('b_x', contype='x'))
+    assert not pgindexrebuild.can_drop_first(obj('b_x'), entry('b_x', parent_index='p_x'))
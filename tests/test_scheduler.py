@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+def index(name, table):
+    return {'schemaname': 'public', 'name': name, 'table': table}
+
+
+def test_in_order_skipping_busy_tables():
+    scheduler = pgindexrebuild.TableScheduler([index('a1', 'a'), index('a2', 'a'), index('b1', 'b')])
+    first = scheduler.next()
+    assert first['name'] == 'a1'
+    # a is being worked on, so b1 comes before a2
+    assert scheduler.next()['name'] == 'b1'
+    scheduler.done(first)
+    assert scheduler.next()['name'] == 'a2'
+    assert scheduler.next() is None
+
+
+def test_waits_for_a_busy_table():
+    scheduler = pgindexrebuild.TableScheduler([index('a1', 'a'), index('a2', 'a')])
+    first = scheduler.next()
+    got = []
+    thread = threading.Thread(target=lambda: got.append(scheduler.next()))
+    thread.start()
+    time.sleep(0.1)
+    assert got == []
+    scheduler.done(first)
+    thread.join(5)
+    assert [obj['name'] for obj in got] == ['a2']
+
+
+def test_abort_wakes_waiting_workers():
+    scheduler = pgindexrebuild.TableScheduler([index('a1', 'a'), index('a2', 'a')])
+    scheduler.next()
+    got = []
+    thread = threading.Thread(target=lambda: got.append(scheduler.next()))
+    thread.start()
+    time.sleep(0.1)
+    scheduler.abort()
+    thread.join(5)
+    assert got == [None]
+
+
+def test_never_two_indexes_on_one_table_at_once():
+    objs = [index("{}{}".format(table, i), table) for table in 'abcd' for i in range(5)]
+    scheduler = pgindexrebuild.TableScheduler(objs)
+    lock = threading.Lock()
+    busy = set()
+    done = []
+    errors = []
+
+    def worker():
+        while True:
+            obj = scheduler.next()
+            if obj is None:
+                return
+            with lock:
+                if obj['table'] in busy:
+                    errors.append(obj['name'])
+                busy.add(obj['table'])
+            time.sleep(0.001)
+            with lock:
+                busy.discard(obj['table'])
+                done.append(obj['name'])
+            scheduler.done(obj)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(done) == sorted(obj['name'] for obj in objs)
@@ -0,0 +1,125 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+def stats(**kwargs):
+    s = dict(reloptions=None, amname='btree', reltuples=100000, indisunique=False, has_include=False,
+             n_tup_ins=100000, n_tup_upd=0, n_tup_hot_upd=0, n_tup_del=0, stats_age=86400, correlation=0.0, n_distinct=-1)
+    s.update(kwargs)
+    return s
+
+
+def obj(**kwargs):
+    o = {'schemaname': 'public', 'name': 'b_x', 'table': 'b', 'size': 10000000, 'wasted': 2000000, 'invalid_index': False}
+    o.update(kwargs)
+    return o
+
+
+def advisor(server_version=160000):
+    return pgindexrebuild.StorageAdvisor(True, 1000000, server_version)
+
+
+def test_appended_index_is_filled():
+    advice = advisor().advise('db', obj(), stats(correlation=1.0))
+    assert advice['fillfactor'] == 100
+    assert advice['old_fillfactor'] == 90
+    assert advice['deduplicate_items'] is True
+    # With fillfactor 100 there's no unused space, so it never re-bloats
+    assert advice['new_rebloat_seconds'] is None
+    assert advice['rebloat_seconds'] is not None
+
+
+def test_updated_index_gets_free_space():
+    advice = advisor().advise('db', obj(), stats(n_tup_ins=10000, n_tup_upd=90000, n_tup_hot_upd=0))
+    assert advice['fillfactor'] == 70
+    assert advice['new_rebloat_seconds'] > advice['rebloat_seconds']
+
+
+def test_fillfactor_only_lowered():
+    assert advisor().advise('db', obj(), stats(reloptions=['fillfactor=50'], n_tup_ins=10000, n_tup_upd=90000)) is None
+
+
+def test_explicit_fillfactor_not_raised_with_updates():
+    assert advisor().advise('db', obj(), stats(reloptions=['fillfactor=70'], correlation=1.0, n_tup_upd=10)) is None
+    assert advisor().advise('db', obj(), stats(reloptions=['fillfactor=70'], correlation=1.0))['fillfactor'] == 100
+
+
+def test_deduplication_turned_back_on():
+    advice = advisor().advise('db', obj(), stats(reloptions=['deduplicate_items=off'], n_distinct=100))
+    assert advice['fillfactor'] == 90
+    assert advice['deduplicate_items'] is True
+    assert advisor(120000).advise('db', obj(), stats(reloptions=['deduplicate_items=off'], n_distinct=100)) is None
+
+
+def test_nothing_to_advise():
+    assert advisor().advise('db', obj(), None) is None
+    assert advisor().advise('db', obj(), stats(amname='hash', correlation=1.0)) is None
+    assert advisor().advise('db', obj(), stats(n_tup_ins=0)) is None
+
+
+class FakeCursor(object):
+    """Answers the queries set_options() runs, and records the SQL."""
+    def __init__(self, reloptions):
+        self.reloptions = reloptions
+        self.executed = []
+        self.result = None
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        if sql.startswith("SELECT reloptions"):
+            self.result = (self.reloptions,)
+        elif sql.startswith("SELECT current_setting"):
+            self.result = ('0',)
+        elif sql.startswith("SELECT pg_get_indexdef"):
+            self.result = ("CREATE INDEX b_x ON public.b USING btree (x) WITH (fillfactor='70')",)
+
+    def fetchone(self):
+        return self.result
+
+
+def make_db():
+    run = pgindexrebuild.Run(argparse.Namespace(dry_run=False), {}, ['pg_default'])
+    run.lock_retry = pgindexrebuild.LockRetry(1, 1, 1)
+    return pgindexrebuild.DatabaseRun(run, 'db', 'pg_default', pgindexrebuild.CatalogSnapshot())
+
+
+def alters(cursor):
+    return [sql for sql in cursor.executed if sql.startswith("ALTER")]
+
+
+def test_set_options_only_sets_what_differs():
+    cursor = FakeCursor(None)
+    advice = {'fillfactor': 70, 'deduplicate_items': True}
+    revert = advisor().set_options(cursor, make_db(), obj(), {'oid': 1}, advice)
+    assert alters(cursor) == ["ALTER INDEX public.b_x SET (fillfactor = 70);"]
+    assert revert == "ALTER INDEX public.b_x RESET (fillfactor);"
+
+
+def test_set_options_reverts_to_old_values():
+    cursor = FakeCursor(['fillfactor=80', 'deduplicate_items=off'])
+    advice = {'fillfactor': 70, 'deduplicate_items': True}
+    revert = advisor().set_options(cursor, make_db(), obj(), {'oid': 1}, advice)
+    assert alters(cursor) == ["ALTER INDEX public.b_x SET (fillfactor = 70, deduplicate_items = on);"]
+    assert revert == "ALTER INDEX public.b_x SET (fillfactor = 80, deduplicate_items = off);"
+
+
+def test_set_options_nothing_to_set():
+    cursor = FakeCursor(['fillfactor=70'])
+    assert advisor().set_options(cursor, make_db(), obj(), {'oid': 1}, {'fillfactor': 70, 'deduplicate_items': True}) is None
+    assert alters(cursor) == []
+
+
+def test_planned_advice_is_used():
+    cursor = FakeCursor(None)
+    planned = {'fillfactor': 70, 'deduplicate_items': True, 'apply': True, 'rebloat_seconds': 10, 'new_rebloat_seconds': 20}
+    revert = advisor().run(cursor, make_db(), obj(storage_advice=planned), {'oid': 1})
+    assert alters(cursor) == ["ALTER INDEX public.b_x SET (fillfactor = 70);"]
+    assert revert is not None
+    # Nothing was advised when the plan was made
+    cursor = FakeCursor(None)
+    assert advisor().run(cursor, make_db(), obj(storage_advice=None), {'oid': 1}) is None
+    assert cursor.executed == []
@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgindexrebuild
+
+
+def index(name, size, wasted, **kwargs):
+    obj = {'schemaname': 'public', 'name': name, 'size': size, 'wasted': wasted}
+    obj.update(kwargs)
+    return obj
+
+
+def test_plan_most_saved_per_second_first():
+    # 1000 bytes per second
+    budget = pgindexrebuild.TimeBudget(100, 1000)
+    objs = [
+        index('big', 60000, 20000),      # 40s, 500 B/s
+        index('small', 12000, 10000),    # 2s, 5000 B/s
+        index('medium', 40000, 20000),   # 20s, 1000 B/s
+    ]
+    assert [obj['name'] for obj in budget.plan(objs)] == ['small', 'medium', 'big']
+    assert budget.deferred == []
+
+
+def test_plan_defers_what_does_not_fit():
+    budget = pgindexrebuild.TimeBudget(40, 1000)
+    objs = [index('big', 60000, 20000), index('small', 12000, 10000), index('medium', 40000, 20000)]
+    assert [obj['name'] for obj in budget.plan(objs)] == ['small', 'medium']
+    assert [obj['name'] for obj in budget.deferred] == ['big']
+    # With 2 jobs, twice as much can be rebuilt
+    budget = pgindexrebuild.TimeBudget(40, 1000)
+    assert len(budget.plan(objs, jobs=2)) == 3
+
+
+def test_plan_uses_past_build_rate():
+    budget = pgindexrebuild.TimeBudget(30, 1000)
+    # 40s at the default rate, but it was rebuilt at 10000 B/s before
+    objs = [index('big', 60000, 20000, past_build_rate=10000)]
+    assert [obj['name'] for obj in budget.plan(objs)] == ['big']
+
+
+def test_build_rate_from_what_was_rebuilt():
+    budget = pgindexrebuild.TimeBudget(30, 1000)
+    assert budget.build_rate() == 1000
+    budget.record(50000, 10)
+    assert budget.build_rate() == 5000
+    assert budget.estimate_seconds(index('x', 60000, 10000)) == 10
+
+
+def test_fits():
+    budget = pgindexrebuild.TimeBudget(30, 1000)
+    assert budget.fits(index('small', 12000, 10000))
+    assert not budget.fits(index('big', 60000, 20000))
+    assert [obj['name'] for obj in budget.deferred] == ['big']